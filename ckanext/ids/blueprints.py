@@ -4,16 +4,19 @@ import json
 import logging
 import uuid
 from collections import defaultdict
+from concurrent.futures import as_completed
 from urllib.parse import urlsplit
 
 import ckan.lib.base as base
 import ckan.lib.helpers as h
+import ckan.lib.jobs as jobs
 import ckan.lib.navl.dictization_functions as dict_fns
 import ckan.logic as logic
 import ckan.model as model
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 import requests
+import rq
 import yaml
 from ckan.common import _, config
 from dateutil import tz
@@ -21,7 +24,7 @@ from flask import Blueprint, request
 from flask import Response, stream_with_context
 from werkzeug.datastructures import ImmutableMultiDict
 
-from ckanext.ids.dataspaceconnector.connector import Connector
+from ckanext.ids.dataspaceconnector.connector import get_connector
 from ckanext.ids.dataspaceconnector.contract import Contract
 from ckanext.ids.dataspaceconnector.offer import Offer
 from ckanext.ids.dataspaceconnector.resource import Resource
@@ -29,7 +32,16 @@ from ckanext.ids.dataspaceconnector.subscribe import Subscription
 from ckanext.ids.metadatabroker.client import graphs_to_artifacts
 from ckanext.ids.metadatabroker.client import graphs_to_ckan_result_format
 from ckanext.ids.metadatabroker.client import graphs_to_contracts
+from ckanext.ids.metadatabroker.cache import cache_stats
+from ckanext.ids.metadatabroker.mirror import mirror_sync_stats
 from ckanext.ids.model import IdsResource, IdsAgreement, IdsSubscription, WorkflowExecution
+from ckanext.ids.push_jobs import create_push_job, update_push_job, \
+    start_push_job, finish_push_job, fail_push_job, push_job_status, \
+    latest_push_job_status, FAILED
+from ckanext.ids.sync_records import PackageSync, content_hash, \
+    store_sync_record
+from ckanext.ids.broker_publication import publish_to_broker, \
+    broker_publications, start_publication_retrier
 from ckanext.ids.activity import create_pushed_to_dataspace_connector_activity, create_created_contract_activity
 
 #dtheiler start
@@ -78,6 +90,13 @@ trusts_blockchain = Blueprint(
 
 log = logging.getLogger(__name__)
 
+
+@ids_actions.before_app_request
+def _start_background_threads():
+    # Only the web workers retry the broker publications, each from its
+    # first request on, i.e. after the fork and never in the CLI
+    start_publication_retrier()
+
 trusts_recommender_plugin_name = "trusts_recommender"
 trusts_blockchain_plugin_name = "trusts_blockchain"
 
@@ -152,8 +171,23 @@ def delete(id):
     return "deleted"
 
 
-def push_package_task(dataset_dict):
-    return push_to_dataspace_connector(dataset_dict)
+def push_package_task(dataset_dict, user=None, push_id=None, force=False):
+    """
+    user pushes the package, push_id is the PushJob that records the
+    progress when this runs as a background job. With force everything is
+    pushed again, even what did not change since the last push.
+    """
+    start_push_job(push_id)
+    try:
+        result = push_to_dataspace_connector(dataset_dict, user, push_id,
+                                             force)
+    except Exception as e:
+        log.exception("Pushing package " + str(dataset_dict.get("id")) +
+                      " failed")
+        fail_push_job(push_id, str(e))
+        raise
+    finish_push_job(push_id, result)
+    return result
 
 
 def push_organization_task(organization_dict):
@@ -171,15 +205,27 @@ def push_to_central(data, action):
     assert response.status_code == 200
 
 
-def push_to_dataspace_connector(data):
+def push_to_dataspace_connector(data, user=None, push_id=None, force=False,
+                                announce=True):
     """
     If data is already in dataspace connector, nothing will be added
+
+    Without a user the one of the request is used; a background job has no
+    request and gets the name of the user who asked for the push.
+
+    Without announce the offer is not sent to the broker, the result has
+    instead what is needed to do it later ("announce"), see push_all.
     """
-    c = plugins.toolkit.g
-    context = {'model': model, 'session': model.Session,
-               'user': c.user or c.author, 'auth_user_obj': c.userobj,
-               }
-    local_connector = Connector()
+    if user is None:
+        c = plugins.toolkit.g
+        context = {'model': model, 'session': model.Session,
+                   'user': c.user or c.author, 'auth_user_obj': c.userobj,
+                   }
+    else:
+        context = {'model': model, 'session': model.Session,
+                   'user': user, 'auth_user_obj': model.User.get(user),
+                   }
+    local_connector = get_connector()
     local_dsc_api = local_connector.get_resource_api()
     # sync calls to the dataspace connector to create the appropriate objects
     # this will be constant.
@@ -187,23 +233,50 @@ def push_to_dataspace_connector(data):
     catalog = config.get("ckanext.ids.connector_catalog_iri")
     # try to populate this with fields from the package
     offer = Offer(data)
+    offer_hash = content_hash(offer.to_dictionary())
+    sync = PackageSync(data["id"], force)
+
+    # If this is a service, we must add a new resource which points to the
+    # access URL. It is not stored in CKAN, its objects are only known from
+    # the last push.
+    extraresources = []
+    if offer.access_url is not None:
+        newresource = {"service_accessURL": offer.access_url,
+                       "description": "service_base_access_url",
+                       "resource_type": "service_base_access_url"}
+        synced = sync.resource_synced(offer.offer_iri,
+                                      "service_base_access_url")
+        if synced:
+            newresource["representation"] = synced.get("representation")
+            newresource["artifact"] = synced.get("artifact")
+        extraresources.append(newresource)
+    all_resources = data["resources"] + extraresources
 
     # If the offer has, for some reason an IRI, but this does not exist in the
-    # local dataspace connector, we just create a new IRI for it
-    # FIXME: check to merge with code below
-    if offer.offer_iri is not None and not \
-            local_dsc_api.resource_exists(
-                offer.offer_iri):
-        offer.offer_iri = None
-        for value in data["resources"]:
-            rep_iri = value["representation"]
-            if not local_dsc_api.resource_exists(rep_iri):
+    # local dataspace connector, we just create a new IRI for it. The same
+    # for the representations and artifacts.
+    if offer.offer_iri is not None:
+        # The offer and all its objects are probed at once
+        iris = [offer.offer_iri]
+        for value in all_resources:
+            iris += [x for x in (value.get("representation"),
+                                 value.get("artifact")) if x]
+        exists = local_dsc_api.resources_exist(
+            iris, executor=local_connector.get_dsc_executor())
+        if not exists[offer.offer_iri]:
+            offer.offer_iri = None
+        for value in all_resources:
+            rep_iri = value.get("representation")
+            if rep_iri and not exists[rep_iri]:
                 value["representation"] = None
-            art_iri = value["artifact"]
-            if not local_dsc_api.resource_exists(art_iri):
+            art_iri = value.get("artifact")
+            if art_iri and not exists[art_iri]:
                 value["artifact"] = None
 
-    if offer.offer_iri is not None:
+    if sync.offer_unchanged(offer.offer_iri, offer_hash):
+        log.info("Offer unchanged since the last push:" + offer.offer_iri)
+        offers = offer.offer_iri
+    elif offer.offer_iri is not None:
         log.info("Checking if offer can be updated:" + offer.offer_iri)
         if local_dsc_api.update_offered_resource(
                 offer.offer_iri, offer.to_dictionary()):
@@ -227,82 +300,114 @@ def push_to_dataspace_connector(data):
                                               offers)
     # adding resources
 
-    # If this is a service, we must add a new resource which points to the
-    # access URL
-    extraresources = []
-    if offer.access_url is not None:
-        newresource = {"service_accessURL": offer.access_url,
-                       "description": "service_base_access_url",
-                       "resource_type": "service_base_access_url"}
-        extraresources.append(newresource)
-
-    for value in data["resources"] + extraresources:
-        log.debug(
-            "--- CREATING RESOURCE ------\n" + json.dumps(value, indent=1))
-        # this has also to run for every resource
-        resource = Resource(value)
-        if resource.service_accessURL is None:
-            internal_resource_url = transform_url_internal_network(
-                value["url"])
-        else:
-            internal_resource_url = resource.service_accessURL
-        representation_metadata = {"title": resource.title,
-                                   "mediaType": resource.mediaType}
-        artifact_metadata = {"accessUrl": internal_resource_url,
-                             "title": resource.title,
-                             "description": resource.description}
-        if resource.representation_iri is None:
-            representation = local_dsc_api.create_representation(
-                representation_metadata)
-        else:
-            local_dsc_api.update_representation(
-                representation_iri=resource.representation_iri,
-                data=representation_metadata)
-            representation = resource.representation_iri
-
-        local_dsc_api.add_representation_to_resource(
-                offers, representation)
-
-        # The site_url of CKAN is accessible to the whole world, but not to the
-        # DSC. This is specially true if the deployment is local and then
-        # CKAN is something like localhost:5000 which won't resolve well in
-        # the DSC. Thus we re-write the url to take into account the name by
-        # which the CKAN is accessible from the DSC.
-
-        if resource.artifact_iri is None:
-            artifact = local_dsc_api.create_artifact(
-                data=artifact_metadata)
+    # The objects of each resource only depend on the offer, so they are
+    # created on a pool of threads. The CKAN side is left for the end, the
+    # database session must not be shared with those threads.
+    update_push_job(push_id, stage=u"resources",
+                    resources_total=len(all_resources))
+    executor = local_connector.get_dsc_executor()
+    futures = {executor.submit(push_resource_to_dataspace_connector,
+                               local_dsc_api, offers, value,
+                               sync.resource_synced(offers,
+                                                    _sync_key(value))): value
+               for value in all_resources}
+    resource_hashes = {}
+    changed_resources = {}
+    failed_resources = []
+    for index, future in enumerate(as_completed(futures)):
+        value = futures[future]
+        try:
+            pushed = future.result()
+        except Exception as e:
+            log.error("Pushing resource " + str(value.get("id")) +
+                      " failed: " + str(e))
+            failed_resources.append({"id": value.get("id"),
+                                     "name": value.get("name"),
+                                     "error": str(e)})
         else:
-            local_dsc_api.update_artifact(
-                resource.artifact_iri,
-                data=artifact_metadata)
-            artifact = resource.artifact_iri
-            local_dsc_api.add_artifact_to_representation(representation, artifact)
-        if "id" in value:
-            # add these on the resource meta
-            patch_data = {"id": value["id"], "representation": representation,
-                          "artifact": artifact}
-            logic.action.patch.resource_patch(context, data_dict=patch_data)
-
-
-    toolkit.get_action("package_patch")(context,
-                                        {"id": data["id"],
-                                         "catalog_iri": catalog,
-                                         "offer_iri": offers})
+            resource_hashes[_sync_key(value)] = pushed
+            if "id" in value and (
+                    pushed["representation"] != value.get("representation") or
+                    pushed["artifact"] != value.get("artifact")):
+                changed_resources[value["id"]] = {
+                    "representation": pushed["representation"],
+                    "artifact": pushed["artifact"]}
+        update_push_job(push_id, resources_done=index + 1)
+
+    # add these on the resource meta, all in a single update of the package,
+    # if any IRI changed. The package is read again, it may have changed
+    # while the job waited.
+    if changed_resources or offers != data.get("offer_iri") or \
+            catalog != data.get("catalog_iri"):
+        package = toolkit.get_action("package_show")(dict(context),
+                                                     {"id": data["id"]})
+        for value in package["resources"]:
+            value.update(changed_resources.get(value["id"], {}))
+        toolkit.get_action("package_patch")(context,
+                                            {"id": data["id"],
+                                             "catalog_iri": catalog,
+                                             "offer_iri": offers,
+                                             "resources": package["resources"]})
+
+    if failed_resources:
+        store_sync_record(data["id"], offers, offer_hash, resource_hashes,
+                          None)
+        message = "Pushing " + str(len(failed_resources)) + " of " + \
+                  str(len(all_resources)) + " resources failed: " + \
+                  ", ".join(str(x["name"] or x["id"]) + " (" + x["error"] +
+                            ")" for x in failed_resources)
+        result = {"pushed": False, "message": message,
+                  "failed_resources": failed_resources}
+        log.warn(message)
+        return result
 
     contracts = local_dsc_api.get_contracts(offers)
 
     if contracts["page"]["totalElements"] > 0:
-        # push to the broker if the package has a contract
-        local_connector.send_resource_to_broker(resource_uri=offer.offer_iri)
+        # What the broker shows of the offer: its metadata, its objects and
+        # its contracts
+        broker_hash = content_hash([offers, offer_hash, resource_hashes,
+                                    contracts.get("_embedded")])
+        if sync.broker_unchanged(broker_hash):
+            store_sync_record(data["id"], offers, offer_hash,
+                              resource_hashes, broker_hash)
+            message = "Nothing changed since the last push to the Metadata Broker"
+            result = {"pushed": True, "message": message}
+            log.info(message)
+            return result
 
-        if trusts_recommender_plugin_name in toolkit.g.plugins:
+        # no toolkit.g.plugins in a background job
+        if plugins.plugin_loaded(trusts_recommender_plugin_name):
             #dtheiler start
             recomm_store_publish_interaction(
-                offer.offer_iri, #entityId
+                offers, #entityId
                 data["type"]) #entityType
             #dtheiler end
+
+        if not announce:
+            store_sync_record(data["id"], offers, offer_hash,
+                              resource_hashes, None)
+            message = "Asset's metadata pushed, to be sent to the Metadata Broker"
+            result = {"pushed": True, "message": message,
+                      "announce": {"offer_iri": offers,
+                                   "broker_hash": broker_hash}}
+            log.info(message)
+            return result
+
+        # push to the broker if the package has a contract. If the broker
+        # does not take it now, it is retried in the background
+        update_push_job(push_id, stage=u"broker")
+        store_sync_record(data["id"], offers, offer_hash, resource_hashes,
+                          None)
+        if not publish_to_broker(offers, data["id"], broker_hash):
+            message = "Asset's metadata pushed to the Dataspace Connector, " \
+                      "the Metadata Broker will be retried"
+            result = {"pushed": True, "message": message}
+            log.warn(message)
+            return result
     else:
+        store_sync_record(data["id"], offers, offer_hash, resource_hashes,
+                          None)
         message = "This resource doesn't have any contracts, not pushing to broker"
         result = {"pushed" : False, "message": message}
         log.warn(message)
@@ -315,6 +420,77 @@ def push_to_dataspace_connector(data):
     return result
 
 
+def _sync_key(resource_dict):
+    # The resource of the access URL of a service has no id
+    return resource_dict.get("id") or resource_dict.get("resource_type")
+
+
+def push_resource_to_dataspace_connector(local_dsc_api, offers, value,
+                                         synced=None):
+    """
+    Creates or updates the representation and the artifact of a resource and
+    links them to the offer. Runs in the threads of the DSC executor, so it
+    must not touch the CKAN database.
+
+    synced is what was pushed of the resource to the same offer the last
+    time: the objects with the same IRI and content are left alone. Returns
+    the IRIs of the objects and the hashes of their content.
+    """
+    synced = synced or {}
+    log.debug(
+        "--- CREATING RESOURCE ------\n" + json.dumps(value, indent=1))
+    resource = Resource(value)
+    # The site_url of CKAN is accessible to the whole world, but not to the
+    # DSC. This is specially true if the deployment is local and then
+    # CKAN is something like localhost:5000 which won't resolve well in
+    # the DSC. Thus we re-write the url to take into account the name by
+    # which the CKAN is accessible from the DSC.
+    if resource.service_accessURL is None:
+        internal_resource_url = transform_url_internal_network(
+            value["url"])
+    else:
+        internal_resource_url = resource.service_accessURL
+    representation_metadata = {"title": resource.title,
+                               "mediaType": resource.mediaType}
+    artifact_metadata = {"accessUrl": internal_resource_url,
+                         "title": resource.title,
+                         "description": resource.description}
+    representation_hash = content_hash(representation_metadata)
+    artifact_hash = content_hash(artifact_metadata)
+
+    if resource.representation_iri is None:
+        representation = local_dsc_api.create_representation(
+            representation_metadata)
+    else:
+        representation = resource.representation_iri
+    if representation != synced.get("representation") or \
+            representation_hash != synced.get("representation_hash"):
+        if resource.representation_iri is not None:
+            local_dsc_api.update_representation(
+                representation_iri=resource.representation_iri,
+                data=representation_metadata)
+        local_dsc_api.add_representation_to_resource(
+            offers, representation)
+
+    if resource.artifact_iri is None:
+        artifact = local_dsc_api.create_artifact(
+            data=artifact_metadata)
+    else:
+        artifact = resource.artifact_iri
+    if artifact != synced.get("artifact") or \
+            artifact_hash != synced.get("artifact_hash") or \
+            representation != synced.get("representation"):
+        if resource.artifact_iri is not None:
+            local_dsc_api.update_artifact(
+                resource.artifact_iri,
+                data=artifact_metadata)
+        local_dsc_api.add_artifact_to_representation(representation, artifact)
+    return {"representation": representation,
+            "representation_hash": representation_hash,
+            "artifact": artifact,
+            "artifact_hash": artifact_hash}
+
+
 def transform_url_internal_network(url: str,
                                    container_name: str = "local-ckan",
                                    container_port: str = "5000"):
@@ -330,7 +506,7 @@ def delete_from_dataspace_connector(data):
     context = {'model': model, 'session': model.Session,
                'user': c.user or c.author, 'auth_user_obj': c.userobj,
                }
-    local_resource_dataspace_connector = Connector().get_resource_api()
+    local_resource_dataspace_connector = get_connector().get_resource_api()
     offer = Offer(data)
     for value in data["resources"]:
         # this has also to run for every resource
@@ -368,11 +544,43 @@ def push_package(id):
     # for index, resource in enumerate(package_meta['resources']):
     #    package_meta['resources'][index]['url_type'] = ''
     #    package_meta['resources'][index]['url'] = transform_url(resource['url'])
-    # this is the asynchronous task
-    # response = toolkit.enqueue_job(push_package_task, [package_meta])
-    # this is the synchronous task
-    return push_package_task(package_meta)
-    # return json.dumps(response.id)
+    # ?force=true pushes again what did not change, e.g. after the broker
+    # lost its index
+    force = toolkit.asbool(request.args.get("force", False))
+    if not toolkit.asbool(config.get("ckanext.ids.push_in_background",
+                                     "true")):
+        return push_package_task(package_meta, force=force)
+
+    c = plugins.toolkit.g
+    user = c.user or c.author
+    push_id = str(uuid.uuid4())
+    create_push_job(push_id, package_meta["id"], user)
+    if not _job_worker_running():
+        # Queued, the push would wait for a worker that never comes
+        fail_push_job(push_id, "No background job worker is running: start "
+                               "`ckan jobs worker`, or set "
+                               "ckanext.ids.push_in_background = false")
+        return push_job_status(push_id)
+    try:
+        job = toolkit.enqueue_job(
+            push_package_task, [package_meta, user, push_id, force],
+            title="Push " + package_meta["name"],
+            rq_kwargs={"timeout": int(config.get(
+                "ckanext.ids.push_job_timeout", 3600))})
+    except Exception as e:
+        fail_push_job(push_id, "Could not enqueue the push: " + str(e))
+        raise
+    update_push_job(push_id, job_id=job.id)
+    return push_job_status(push_id)
+
+
+def _job_worker_running() -> bool:
+    try:
+        return len(rq.Worker.all(queue=jobs.get_queue())) > 0
+    except Exception as e:
+        # If the workers cannot be listed, the job is enqueued anyway
+        log.warning("Could not look for background job workers: " + str(e))
+        return True
 
 
 def push_to_smart_contract_component(package_meta, id):
@@ -424,13 +632,51 @@ def push_to_smart_contract_component(package_meta, id):
 @ids_actions.route('/ids/view/push_package/<id>', methods=['GET'])
 def push_package_view(id):
     response = push_package(id)
-    if response["pushed"]:
+    if response.get("status") == FAILED:
+        h.flash_error(response["message"])
+    elif response.get("status") is not None:
+        h.flash_notice(_("The push to the dataspace connector has started, "
+                         "its status is at ") +
+                       h.url_for("ids_actions.push_status",
+                                 push_id=response["id"]))
+    elif response["pushed"]:
         h.flash_success(response["message"])
     else:
         h.flash_error(response["message"])
     return toolkit.redirect_to('dataset.read', id=id)
 
 
+def _require_package_update(package_id):
+    c = plugins.toolkit.g
+    context = {'model': model, 'session': model.Session,
+               'user': c.user or c.author, 'auth_user_obj': c.userobj}
+    try:
+        toolkit.check_access('package_update', context, {"id": package_id})
+    except toolkit.ObjectNotFound:
+        toolkit.abort(404, _('Dataset not found'))
+    except toolkit.NotAuthorized:
+        toolkit.abort(403, _('Unauthorized to edit package %s') % package_id)
+
+
+@ids_actions.route('/ids/actions/push_status/<push_id>', methods=['GET'])
+def push_status(push_id):
+    status = push_job_status(push_id)
+    if status is None:
+        return toolkit.abort(404, _("Push not found"))
+    _require_package_update(status["package_id"])
+    return status
+
+
+@ids_actions.route('/ids/actions/push_status/package/<id>', methods=['GET'])
+def latest_push_status(id):
+    _require_package_update(id)
+    package_meta = toolkit.get_action("package_show")(None, {"id": id})
+    status = latest_push_job_status(package_meta["id"])
+    if status is None:
+        return toolkit.abort(404, _("The package was never pushed"))
+    return status
+
+
 @ids_actions.route('/ids/actions/push_organization/<id>', methods=['GET'])
 def push_organization(id):
     organization_meta = toolkit.get_action("organization_show")(None,
@@ -451,7 +697,7 @@ def push_organization_view(id):
 
 @ids_actions.route('/ids/actions/publish/<id>', methods=['POST'])
 def publish_action(id):
-    local_connector = Connector()
+    local_connector = get_connector()
     local_connector_resource_api = local_connector.get_resource_api()
     c = plugins.toolkit.g
     context = {'model': model, 'session': model.Session,
@@ -541,7 +787,7 @@ def publish(id, offering_info=None, errors=None):
 
 @ids_actions.route('/ids/view/contracts/<id>', methods=['GET'])
 def contracts(id, offering_info=None, errors=None):
-    local_connector = Connector()
+    local_connector = get_connector()
     local_dsc_api = local_connector.get_resource_api()
     c = plugins.toolkit.g
     context = {'model': model, 'session': model.Session,
@@ -597,7 +843,7 @@ def contract_accept():
         providing_base_url = "/".join(data["resourceId"].split("/")[:3])
         data["provider_url"] = providing_base_url
 
-    local_connector = Connector()
+    local_connector = get_connector()
     local_dsc_api = local_connector.get_resource_api()
     # get the description of the contract
 
@@ -701,7 +947,7 @@ def contract_accept():
 @ids_actions.route('/ids/actions/get_data', methods=['GET'])
 def get_data():
 
-    local_connector = Connector()
+    local_connector = get_connector()
     local_connector_resource_api = local_connector.get_resource_api()
 
     url = local_connector_resource_api.recipient + "/api/artifacts/" + request.args.get(
@@ -719,14 +965,14 @@ def get_data():
 
 @ids_actions.route('/ids/actions/get_representations', methods=['GET'])
 def get_representations():
-    local_connector = Connector()
+    local_connector = get_connector()
     local_connector_resource_api = local_connector.get_resource_api()
     resource_uri= request.args.get("resource_uri")
     return local_connector_resource_api.get_representations_for_resource(resource_uri)
 
 @ids_actions.route('/ids/actions/get_artifacts', methods=['GET'])
 def get_artifacts():
-    local_connector = Connector()
+    local_connector = get_connector()
     local_connector_resource_api = local_connector.get_resource_api()
     representation_uri= request.args.get("representation_uri")
     return local_connector_resource_api.get_artifacts_for_representation(representation_uri)
@@ -738,7 +984,7 @@ def subscribe():
     offer_url= request.args.get("offer_url")
     subscriber_email= g.userobj.email
 
-    local_connector = Connector()
+    local_connector = get_connector()
 
     graphs = local_connector.ask_broker_for_description(
         element_uri=offer_url)
@@ -779,7 +1025,7 @@ def unsubscribe():
 @ids_actions.route('/ids/actions/agreement/<id>/workflow/configure')
 def workflow_configuration(id):
     resources = []
-    local_connector = Connector()
+    local_connector = get_connector()
     local_dsc_api = local_connector.get_resource_api()
     agreement_uri = local_connector.url + "/api/agreements/" + id
     artifacts = local_dsc_api.get_artifacts_for_agreement(agreement_uri)
@@ -805,7 +1051,7 @@ def workflow_configuration(id):
 
 @ids_actions.route('/ids/actions/agreement/<id>/workflows', methods=['GET'])
 def workflow_executions_view(id):
-    local_connector = Connector()
+    local_connector = get_connector()
     local_dsc_api = local_connector.get_resource_api()
     agreement_uri = local_connector.url + "/api/agreements/" + id
     agreement = IdsAgreement.get(agreement_uri)
@@ -843,7 +1089,7 @@ def dataset_resource_filter(resource):
 @ids_actions.route('/ids/actions/trigger_workflow', methods=['POST'])
 def workflow_trigger():
 
-    local_connector = Connector()
+    local_connector = get_connector()
     local_dsc_api = local_connector.get_resource_api()
 
     agreement_id = request.form["agreementId"]
@@ -881,7 +1127,7 @@ def service_access():
     service_access_url = request.args["service_access_url"]
     workflow_name = request.args["workflowname"]
     proxy_path = request.args["proxypath"]
-    local_connector = Connector()
+    local_connector = get_connector()
     local_dsc_api = local_connector.get_resource_api()
     parameters = {"workflowname":workflow_name}
     data_response = local_dsc_api.get_data(service_access_url,proxyPath=proxy_path, parameters=parameters)
@@ -894,6 +1140,35 @@ def service_access():
     return response
 
 
+def _require_sysadmin():
+    c = plugins.toolkit.g
+    context = {'model': model, 'session': model.Session,
+               'user': c.user or c.author, 'auth_user_obj': c.userobj}
+    try:
+        toolkit.check_access('sysadmin', context)
+    except toolkit.NotAuthorized:
+        toolkit.abort(403, _('Need to be system administrator to administer'))
+
+
+@ids_actions.route('/ids/actions/broker_cache_stats', methods=['GET'])
+def broker_cache_stats():
+    _require_sysadmin()
+    return cache_stats()
+
+
+@ids_actions.route('/ids/actions/broker_mirror_stats', methods=['GET'])
+def broker_mirror_stats():
+    _require_sysadmin()
+    return mirror_sync_stats()
+
+
+@ids_actions.route('/ids/actions/broker_publications', methods=['GET'])
+def broker_publications_status():
+    # They show package ids and the errors of the broker
+    _require_sysadmin()
+    return {"publications": broker_publications()}
+
+
 def create_external_package(data):
     # get clean data from the form, data will hold the common meta for all resources
 
@@ -917,7 +1192,7 @@ def create_external_package(data):
 
 
 def create_or_get_catalog_id():
-    local_connector_resource_api = Connector().get_resource_api()
+    local_connector_resource_api = get_connector().get_resource_api()
     title = config.get("ckanext.ids.local_node_name")
     catalogs = local_connector_resource_api.get_catalogs()
     found = False
@@ -960,7 +1235,7 @@ def contracts_remote():
 
     # Ger from broker info for this ID
     resource_uri = request.args.get("uri")
-    local_connector = Connector()
+    local_connector = get_connector()
 
     graphs = local_connector.ask_broker_for_description(
         element_uri=resource_uri)
@@ -0,0 +1,230 @@
+"""
+Sending offers to the broker without waiting for it.
+
+publish_to_broker() asks the broker to index an offer once. If the broker
+rejects it or cannot be reached, the offer is queued in
+ids_broker_publication and retried in the background (by every web worker
+in turn, from its first request on) with an exponential backoff with jitter, from
+ckanext.ids.broker_publication_backoff seconds up to
+ckanext.ids.broker_publication_backoff_max. That budget is its own, not the
+broker_knows_us_limit of the announce. After
+ckanext.ids.broker_publication_retries attempts the offer stays there as
+dead, until `ckan ids publications retry --dead` queues it again.
+"""
+import datetime
+import logging
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+import ckan.model as model
+from ckan.common import config
+from ckan.lib.redis import connect_to_redis
+
+from ckanext.ids.dataspaceconnector.connector import get_connector
+from ckanext.ids.model import BrokerPublication
+from ckanext.ids.sync_records import mark_announced
+
+log = logging.getLogger("ckanext")
+
+PENDING = u"pending"
+DEAD = u"dead"
+
+PUBLICATION_RETRY_LOCK_KEY = "ckanext-ids:broker_publication_retry_lock"
+
+_retrier_pid = None
+_retrier_lock = threading.Lock()
+
+
+def _retries() -> int:
+    return int(config.get("ckanext.ids.broker_publication_retries", 8))
+
+
+def _retry_interval() -> float:
+    return float(config.get("ckanext.ids.broker_publication_retry_interval",
+                            30))
+
+
+def _lock_timeout() -> int:
+    # Long enough for a single publication, the lock is refreshed before
+    # each one
+    return int(_retry_interval()) + 60
+
+
+def _refresh_lock(redis_conn):
+    if redis_conn is None:
+        return
+    try:
+        redis_conn.expire(PUBLICATION_RETRY_LOCK_KEY, _lock_timeout())
+    except Exception as e:
+        log.debug("Could not refresh the broker publication retry lock: " +
+                  str(e))
+
+
+def backoff(attempts: int) -> float:
+    """
+    Seconds to wait after the given number of failed attempts: doubling
+    from the base up to the maximum, half of it random so that the offers
+    rejected together are not retried together
+    """
+    base = float(config.get("ckanext.ids.broker_publication_backoff", 5))
+    maximum = float(config.get("ckanext.ids.broker_publication_backoff_max",
+                               3600))
+    # The exponent is capped, a float cannot hold 2 ** 1024
+    delay = min(maximum, base * 2 ** min(max(attempts - 1, 0), 64))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _published(resource_uri: str, package_id: Optional[str],
+               broker_hash: Optional[str]):
+    publication = BrokerPublication.get(resource_uri)
+    if publication is not None:
+        model.Session.delete(publication)
+        model.Session.commit()
+    if package_id is not None and broker_hash is not None:
+        mark_announced(package_id, broker_hash)
+
+
+def _failed(resource_uri: str, package_id: Optional[str],
+            broker_hash: Optional[str], error: str):
+    now = datetime.datetime.utcnow()
+    publication = BrokerPublication.get(resource_uri)
+    if publication is None:
+        publication = BrokerPublication(resource_uri, package_id)
+        publication.attempts = 0
+        publication.created = now
+        model.Session.add(publication)
+    if package_id is not None:
+        publication.package_id = package_id
+    if broker_hash is not None:
+        publication.broker_hash = broker_hash
+    publication.attempts += 1
+    publication.last_error = error
+    publication.updated = now
+    if publication.attempts >= _retries():
+        publication.status = DEAD
+        publication.next_attempt = None
+        log.error("Giving up sending " + resource_uri + " to the broker "
+                  "after " + str(publication.attempts) + " attempts: " +
+                  error)
+    else:
+        publication.status = PENDING
+        publication.next_attempt = now + datetime.timedelta(
+            seconds=backoff(publication.attempts))
+        log.warning("Sending " + resource_uri + " to the broker failed, "
+                    "retrying at " + publication.next_attempt.isoformat() +
+                    ": " + error)
+    model.Session.commit()
+
+
+def publish_to_broker(resource_uri: str, package_id: Optional[str] = None,
+                      broker_hash: Optional[str] = None) -> bool:
+    """
+    Sends the offer to the broker once. If that fails it is queued for a
+    retry and False is returned. Once the broker accepts it, the sync record
+    of the package gets the broker_hash.
+    """
+    try:
+        get_connector().send_resource_to_broker(resource_uri=resource_uri)
+    except Exception as e:
+        _failed(resource_uri, package_id, broker_hash, str(e))
+        return False
+    _published(resource_uri, package_id, broker_hash)
+    return True
+
+
+def retry_due_publications() -> Optional[Dict]:
+    """
+    Sends again the queued offers whose backoff is over. Only one worker at
+    a time does it; if another one is, returns None.
+    """
+    try:
+        redis_conn = connect_to_redis()
+        locked = redis_conn.set(PUBLICATION_RETRY_LOCK_KEY, str(os.getpid()),
+                                nx=True, ex=_lock_timeout())
+    except Exception as e:
+        log.debug("Could not lock the broker publication retries: " + str(e))
+        redis_conn = None
+        locked = True
+    if not locked:
+        return None
+    try:
+        due = [(x.resource_uri, x.package_id, x.broker_hash)
+               for x in model.Session.query(BrokerPublication)
+               .filter(BrokerPublication.status == PENDING,
+                       BrokerPublication.next_attempt <=
+                       datetime.datetime.utcnow())
+               .order_by(BrokerPublication.next_attempt)]
+        if not due:
+            return {"retried": 0, "published": 0}
+        # Rejections mostly mean that the broker forgot us, e.g. after a
+        # restart: announce again once for all of them
+        try:
+            get_connector().announce_to_broker(force=True)
+        except Exception as e:
+            log.error("Announcing to the broker failed: " + str(e))
+        published = 0
+        for publication in due:
+            # A long pass must not lose the lock to another worker
+            _refresh_lock(redis_conn)
+            published += publish_to_broker(*publication)
+        log.info("Broker publications retried: " + str(published) + " of " +
+                 str(len(due)) + " accepted")
+        return {"retried": len(due), "published": published}
+    finally:
+        if redis_conn is not None:
+            try:
+                redis_conn.delete(PUBLICATION_RETRY_LOCK_KEY)
+            except Exception as e:
+                log.debug("Could not unlock the broker publication "
+                          "retries: " + str(e))
+
+
+def _retry_loop():
+    while True:
+        time.sleep(_retry_interval())
+        try:
+            retry_due_publications()
+        except Exception as e:
+            log.error("Retrying the broker publications failed: " + str(e))
+            model.Session.rollback()
+        finally:
+            model.Session.remove()
+
+
+def start_publication_retrier():
+    """
+    Starts the thread that retries the queued publications in this
+    process, once. Called on the requests to the web workers only.
+    """
+    global _retrier_pid
+    # Checking the pid restarts the thread in forked workers
+    if _retrier_pid == os.getpid():
+        return
+    with _retrier_lock:
+        if _retrier_pid == os.getpid():
+            return
+        _retrier_pid = os.getpid()
+        threading.Thread(target=_retry_loop, name="broker-publication-retry",
+                         daemon=True).start()
+
+
+def requeue_dead_publications() -> int:
+    """ Gives the dead publications a new retry budget, retried at once """
+    dead = model.Session.query(BrokerPublication) \
+        .filter(BrokerPublication.status == DEAD).all()
+    now = datetime.datetime.utcnow()
+    for publication in dead:
+        publication.status = PENDING
+        publication.attempts = 0
+        publication.next_attempt = now
+        publication.updated = now
+    model.Session.commit()
+    return len(dead)
+
+
+def broker_publications() -> List[Dict]:
+    return [x.as_dict() for x in model.Session.query(BrokerPublication)
+            .order_by(BrokerPublication.created)]
@@ -0,0 +1,107 @@
+import json
+
+import click
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.ids.metadatabroker.mirror import sync_mirror, sync_mirror_job, \
+    mirror_sync_stats
+from ckanext.ids.push_all import push_all, push_all_job
+from ckanext.ids.broker_publication import retry_due_publications, \
+    requeue_dead_publications, broker_publications
+
+
+@click.group(short_help="TRUSTS IDS commands")
+def ids():
+    pass
+
+
+@ids.group(short_help="Local mirror of the broker catalog")
+def mirror():
+    pass
+
+
+@mirror.command("sync", short_help="Update the mirror from the broker")
+@click.option("--full", is_flag=True,
+              help="Fetch every resource again, not only the modified ones")
+@click.option("--background", is_flag=True,
+              help="Enqueue a background job instead of syncing here")
+def sync(full, background):
+    if background:
+        job = toolkit.enqueue_job(sync_mirror_job, [full],
+                                  title="Broker mirror sync")
+        click.secho("Enqueued job " + job.id, fg="green")
+        return
+    stats = sync_mirror(full)
+    if stats is None:
+        click.secho("Another sync is already running", fg="yellow")
+        return
+    click.secho("Listed {listed}, fetched {stored} of {changed} changed, "
+                "deleted {deleted} in {duration}s".format(**stats), fg="green")
+
+
+@mirror.command("stats", short_help="Lag and figures of the last syncs")
+def stats():
+    click.echo(json.dumps(mirror_sync_stats(), indent=2))
+
+
+@ids.command("push-all",
+             short_help="Push every package with an offer to the DSC again")
+@click.option("--force", is_flag=True,
+              help="Push even what did not change since the last push, "
+                   "e.g. after the broker lost its index")
+@click.option("--resume", is_flag=True,
+              help="Continue an interrupted run from its checkpoint")
+@click.option("--concurrency", type=int, default=None,
+              help="Packages pushed at once "
+                   "(ckanext.ids.push_all_concurrency)")
+@click.option("--background", is_flag=True,
+              help="Enqueue a background job instead of pushing here")
+def push_all_command(force, resume, concurrency, background):
+    if background:
+        job = toolkit.enqueue_job(
+            push_all_job, [force, resume], title="Push all packages",
+            rq_kwargs={"timeout": int(toolkit.config.get(
+                "ckanext.ids.push_all_timeout", 4 * 3600))})
+        click.secho("Enqueued job " + job.id, fg="green")
+        return
+    stats = push_all(force, resume, concurrency)
+    if stats is None:
+        click.secho("Another push of all packages is already running",
+                    fg="yellow")
+        return
+    for package_id, error in stats["failures"].items():
+        click.secho(package_id + ": " + error, fg="red")
+    click.secho("Pushed {pushed}, failed {failed}, sent {announced} to the "
+                "broker ({not_announced} rejected) in {duration}s, "
+                "{packages_per_second} packages/s".format(**stats),
+                fg="green" if not stats["failures"] else "yellow")
+
+
+@ids.group(short_help="Offers the broker did not accept yet")
+def publications():
+    pass
+
+
+@publications.command("list", short_help="Offers waiting or given up on")
+def list_publications():
+    click.echo(json.dumps(broker_publications(), indent=2))
+
+
+@publications.command("retry", short_help="Send the due offers again now")
+@click.option("--dead", is_flag=True,
+              help="Also those given up on, with a new retry budget")
+def retry_publications(dead):
+    if dead:
+        click.secho("Requeued {} dead publications".format(
+            requeue_dead_publications()), fg="green")
+    stats = retry_due_publications()
+    if stats is None:
+        click.secho("Another worker is retrying them already", fg="yellow")
+        return
+    click.secho("Retried {retried}, accepted {published}".format(**stats),
+                fg="green")
+
+
+def get_commands():
+    return [ids]
@@ -1,17 +1,38 @@
+import copy
 import datetime
 import json
 import logging
+import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from os.path import join as pathjoin
 
+import ckan.plugins.toolkit as toolkit
 import requests
 from ckan.common import config
+from ckan.lib.redis import connect_to_redis
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 from ckanext.ids.dataspaceconnector.resourceapi import ResourceApi
+from ckanext.ids.metadatabroker import sparql_queries
+from ckanext.ids.metadatabroker.sparql_results import parse_sparql_results, \
+    iter_tsv_rows, SparqlResults
+from ckanext.ids.metadatabroker.cache import invalidate_search_cache, \
+    description_cache, description_fresh_seconds
 
 log = logging.getLogger("ckanext")
 
+_connector = None
+_connector_lock = threading.Lock()
+_announce_refresher_lock = threading.Lock()
+
+# Shared by all the CKAN workers, so that only one of them announces us to
+# the broker and the others just read the flag
+BROKER_KNOWS_US_KEY = "ckanext-ids:broker_knows_us"
+BROKER_ANNOUNCE_LOCK_KEY = "ckanext-ids:broker_announce_lock"
+
 
 class ConnectorException(Exception):
     def __init__(self, m):
@@ -24,6 +45,18 @@ class ConnectorException(Exception):
 class Connector:
     url = None
     auth = ()
+    # Shared by every Connector in the process, so that constructing a
+    # Connector does not spawn new threads
+    _query_executor = None
+    _query_executor_lock = threading.Lock()
+    # Same for the HTTP connections to the broker, which are kept alive and
+    # reused instead of opening a new one for each call
+    _broker_session = None
+    _broker_session_lock = threading.Lock()
+    # And for the calls to the REST API of the local dataspace connector
+    # that a push makes for each resource
+    _dsc_executor = None
+    _dsc_executor_lock = threading.Lock()
 
     # def __init__(self, url, username, password):
     #     self.url = url
@@ -48,11 +81,48 @@ class Connector:
                                      'http://central-core:8282/infrastructure')
         # self.broker_url = 'http://central-core:8080/infrastructure'
         self.broker_knows_us_timestamp = None
-        self.broker_knows_us_limit = 10
+        self.broker_knows_us_limit = int(config.get(
+            'ckanext.ids.broker_knows_us_limit', 10))
+        self.broker_announce_interval = float(config.get(
+            'ckanext.ids.broker_announce_interval',
+            self.broker_knows_us_limit / 2))
+        self._announce_lock = threading.Lock()
+        self._announce_refresher_pid = None
         self.my_catalog_ids = []
-        self.resourceAPI = ResourceApi(self.url, self.auth)
+        self.dsc_workers = int(config.get('ckanext.ids.push_workers', 8))
+        # Without a timeout a hung broker would block the web worker forever
+        self.timeout = (
+            float(config.get('ckanext.ids.broker_connect_timeout', 5)),
+            float(config.get('ckanext.ids.broker_read_timeout', 60)))
+        # Same for the local connector, e.g. while holding _announce_lock
+        self.connector_timeout = (
+            float(config.get('ckanext.ids.connector_connect_timeout',
+                             self.timeout[0])),
+            float(config.get('ckanext.ids.connector_read_timeout',
+                             self.timeout[1])))
+        self.resourceAPI = ResourceApi(self.url, self.auth,
+                                       pool_size=self.dsc_workers,
+                                       timeout=self.connector_timeout)
+
+    def _get_redis(self):
+        try:
+            return connect_to_redis()
+        except Exception as e:
+            log.debug("Redis not available for the announce state: " + str(e))
+            return None
 
     def broker_knows_us(self):
+        self.start_announce_refresher()
+        redis_conn = self._get_redis()
+        if redis_conn is not None:
+            try:
+                if redis_conn.exists(BROKER_KNOWS_US_KEY):
+                    log.debug("\n________ BROKER STILLS KNOWS US _______________")
+                    return True
+                return False
+            except Exception as e:
+                log.debug("Could not read the announce state: " + str(e))
+
         if self.broker_knows_us_timestamp is None:
             return False
         tnow = datetime.datetime.now()
@@ -62,9 +132,91 @@ class Connector:
         log.debug("\n________ BROKER STILLS KNOWS US _______________")
         return True
 
+    def _mark_broker_knows_us(self):
+        self.broker_knows_us_timestamp = datetime.datetime.now()
+        redis_conn = self._get_redis()
+        if redis_conn is not None:
+            try:
+                redis_conn.set(BROKER_KNOWS_US_KEY, "1",
+                               ex=self.broker_knows_us_limit)
+            except Exception as e:
+                log.debug("Could not store the announce state: " + str(e))
+
+    def _announce_is_fresh(self):
+        """
+        Whether the shared flag outlives the next refresh, i.e. another
+        worker checked with the broker recently enough
+        """
+        redis_conn = self._get_redis()
+        if redis_conn is None:
+            return False
+        try:
+            return redis_conn.ttl(BROKER_KNOWS_US_KEY) > \
+                self.broker_announce_interval
+        except Exception as e:
+            log.debug("Could not read the announce state: " + str(e))
+            return False
+
+    def start_announce_refresher(self):
+        """
+        Starts the thread that keeps the announce state fresh, so that
+        requests only have to read it. After a fork (gunicorn workers) the
+        thread does not exist anymore in the child, thus we check the pid.
+        """
+        if not toolkit.asbool(config.get(
+                'ckanext.ids.broker_announce_refresh', True)):
+            return
+        if self._announce_refresher_pid == os.getpid():
+            return
+        with _announce_refresher_lock:
+            if self._announce_refresher_pid == os.getpid():
+                return
+            self._announce_refresher_pid = os.getpid()
+            refresher = threading.Thread(target=self._announce_refresher_loop,
+                                         name="broker-announce",
+                                         daemon=True)
+            refresher.start()
+
+    def _announce_refresher_loop(self):
+        while True:
+            try:
+                # Every worker has this thread, but only the one that finds
+                # the flag about to expire checks with the broker
+                if not self._announce_is_fresh():
+                    self._refresh_announce()
+            except Exception as e:
+                log.error("Refreshing the broker announce failed: " + str(e))
+            time.sleep(self.broker_announce_interval)
+
     def get_resource_api(self):
         return self.resourceAPI
 
+    def get_broker_session(self):
+        if Connector._broker_session is None:
+            with Connector._broker_session_lock:
+                if Connector._broker_session is None:
+                    pool_size = int(config.get(
+                        'ckanext.ids.broker_pool_size', 10))
+                    adapter = HTTPAdapter(pool_connections=pool_size,
+                                          pool_maxsize=pool_size)
+                    session = requests.Session()
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    Connector._broker_session = session
+        return Connector._broker_session
+
+    def _post(self, url: str, **kwargs):
+        try:
+            return self.get_broker_session().post(
+                url=url,
+                auth=HTTPBasicAuth(self.auth[0], self.auth[1]),
+                timeout=self.timeout,
+                **kwargs)
+        except requests.exceptions.RequestException as e:
+            log.error("Request to " + url + " failed: " + str(e))
+            raise ConnectorException("Request to " + url + " failed: " +
+                                     str(e))
+
     def search_broker(self, search_string: str,
                       limit: int = 100,
                       offset: int = 0):
@@ -77,11 +229,9 @@ class Connector:
 
         url = pathjoin(self.url, "api/ids/search")
         data = search_string.encode("utf-8")
-        response = requests.post(url=url,
-                                 params=params,
-                                 data=data,
-                                 auth=HTTPBasicAuth(self.auth[0],
-                                                    self.auth[1]))
+        response = self._post(url=url,
+                              params=params,
+                              data=data)
         if response.status_code > 299 or response.text is None:
             log.error("Got code " + str(response.status_code) + " in search")
             log.error("Response Text: " + str(response.text))
@@ -101,11 +251,9 @@ class Connector:
         url = pathjoin(self.url, "api/ids/query")
         data = query_string.encode("utf-8")
 
-        response = requests.post(url=url,
-                                 params=params,
-                                 data=data,
-                                 auth=HTTPBasicAuth(self.auth[0],
-                                                    self.auth[1]))
+        response = self._post(url=url,
+                              params=params,
+                              data=data)
         if return_if_417:
             return response
         if response.status_code > 299 or response.text is None:
@@ -116,19 +264,144 @@ class Connector:
 
         return response.text
 
-    def ask_broker_for_description(self, element_uri: str):
+    def query_broker_results(self, query_string: str) -> SparqlResults:
+        """
+        Like query_broker, but the rows are parsed from the response as it
+        arrives instead of from its whole text. The connection goes back to
+        the pool once all the rows are read.
+        """
+        self.announce_to_broker()
+        params = {"recipient": self.broker_url}
+        url = pathjoin(self.url, "api/ids/query")
+        data = query_string.encode("utf-8")
+        response = self._post(url=url,
+                              params=params,
+                              data=data,
+                              stream=True)
+        if response.status_code > 299:
+            text = response.text
+            response.close()
+            log.error("Got code " + str(response.status_code) + " in search")
+            log.error("Provided Data: " + data.decode("utf-8"))
+            raise ConnectorException("Code: " + str(response.status_code) +
+                                     " Text: " + str(text))
+
+        content_type = response.headers.get("Content-Type")
+        if content_type is not None and "json" in content_type:
+            try:
+                return parse_sparql_results(response.content, content_type)
+            finally:
+                response.close()
+
+        variables, rows = iter_tsv_rows(
+            response.iter_lines(chunk_size=65536))
+
+        def closing_rows():
+            try:
+                yield from rows
+            finally:
+                response.close()
+
+        return SparqlResults(variables, closing_rows())
+
+    def get_query_executor(self):
+        if Connector._query_executor is None:
+            with Connector._query_executor_lock:
+                if Connector._query_executor is None:
+                    workers = int(config.get(
+                        'ckanext.ids.broker_query_workers', 4))
+                    Connector._query_executor = ThreadPoolExecutor(
+                        max_workers=workers,
+                        thread_name_prefix="broker-query")
+        return Connector._query_executor
+
+    def get_dsc_executor(self):
+        if Connector._dsc_executor is None:
+            with Connector._dsc_executor_lock:
+                if Connector._dsc_executor is None:
+                    Connector._dsc_executor = ThreadPoolExecutor(
+                        max_workers=self.dsc_workers,
+                        thread_name_prefix="dsc-call")
+        return Connector._dsc_executor
+
+    def query_broker_concurrently(self, query_strings: list):
+        """
+        Sends several SPARQL queries to the broker at once and returns the
+        responses in the same order as the queries. If any of them fails the
+        ConnectorException is raised after all of them are done.
+        """
+        # Announce once here, so that the parallel queries don't race to do it
         self.announce_to_broker()
-        resource_contract_tuples = []
+        executor = self.get_query_executor()
+        futures = [executor.submit(self.query_broker, q)
+                   for q in query_strings]
+        wait(futures)
+        return [f.result() for f in futures]
 
+    def ask_broker_for_description(self, element_uri: str):
         if len(element_uri) < 5 or ":" not in element_uri:
             return {}
+
+        entry = description_cache.get(element_uri)
+        if entry is not None:
+            age = time.monotonic() - entry["checked"]
+            if age < description_fresh_seconds or (
+                    entry["modified"] is not None and
+                    self._broker_resource_modified(element_uri) ==
+                    entry["modified"]):
+                if age >= description_fresh_seconds:
+                    description_cache.set(element_uri, dict(
+                        entry, checked=time.monotonic()))
+                return copy.deepcopy(entry["description"])
+
+        graphs = self._fetch_description(element_uri)
+        description_cache.set(element_uri, {
+            "description": copy.deepcopy(graphs),
+            "modified": self._description_modified(graphs),
+            "checked": time.monotonic()})
+        return graphs
+
+    def _description_modified(self, graphs):
+        try:
+            for node in graphs["@graph"]:
+                if node["@type"] == "ids:Resource":
+                    modified = node.get("modified")
+                    if isinstance(modified, dict):
+                        modified = modified.get("@value")
+                    return str(modified) if modified is not None else None
+        except (KeyError, TypeError):
+            pass
+        return None
+
+    def _broker_resource_modified(self, element_uri: str):
+        """
+        Asks the broker only for the ids:modified of a resource. That is much
+        cheaper than the whole description, and tells us whether our copy
+        is still good. Returns None if it could not be found out.
+        """
+        try:
+            query = sparql_queries.modified_query(element_uri)
+        except ValueError:
+            # Not an IRI that can go into a query: a cache miss, the
+            # description endpoint takes it as a parameter
+            log.debug("Not revalidating " + element_uri + ", not an IRI")
+            return None
+        try:
+            results = self.query_broker_results(query)
+        except ConnectorException as e:
+            log.debug("Could not revalidate " + element_uri + ": " + str(e))
+            return None
+        for row in results:
+            return row[0]
+        return None
+
+    def _fetch_description(self, element_uri: str):
+        self.announce_to_broker()
         params = {"recipient": self.broker_url,
                   "elementId": element_uri}
         url = pathjoin(self.url, "api/ids/description")
-        response = requests.post(url=url,
-                                 params=params,
-                                 auth=HTTPBasicAuth(self.auth[0],
-                                                    self.auth[1]))
+        response = self._post(url=url,
+                              params=params)
         if response.status_code > 299 or response.text is None:
             log.error("Got code " + str(response.status_code) + " in describe")
             raise ConnectorException("Code: " + str(response.status_code) +
@@ -173,11 +446,48 @@ class Connector:
             log.debug("\t|---BROKER KNOWS US 1")
             return True
 
+        return self._refresh_announce(force=force)
+
+    def _refresh_announce(self, force=False):
+        # Only one thread of this process and one worker at a time checks
+        # with the broker. Everybody else goes on, the check is under way.
+        if not self._announce_lock.acquire(blocking=force):
+            log.debug("\t|---ANNOUNCE ALREADY RUNNING")
+            return True
+        try:
+            redis_conn = self._get_redis()
+            if redis_conn is not None and not force:
+                try:
+                    if not redis_conn.set(BROKER_ANNOUNCE_LOCK_KEY,
+                                          str(os.getpid()), nx=True,
+                                          ex=int(self.timeout[1]) + 10):
+                        log.debug("\t|---ANNOUNCE RUNNING IN OTHER WORKER")
+                        return True
+                except Exception as e:
+                    log.debug("Could not lock the announce: " + str(e))
+                    redis_conn = None
+            try:
+                # The worker that held the lock before may have just done it
+                if redis_conn is not None and not force and \
+                        self._announce_is_fresh():
+                    log.debug("\t|---ANNOUNCE JUST REFRESHED")
+                    return True
+                return self._check_and_announce(force)
+            finally:
+                if redis_conn is not None and not force:
+                    try:
+                        redis_conn.delete(BROKER_ANNOUNCE_LOCK_KEY)
+                    except Exception as e:
+                        log.debug("Could not unlock the announce: " + str(e))
+        finally:
+            self._announce_lock.release()
+
+    def _check_and_announce(self, force=False):
         self.fetch_catalog_ids()
         q = self._build_query_my_resources()
         r = self.query_broker(q, return_if_417=True)
 
-        self.broker_knows_us_timestamp = datetime.datetime.now()
+        self._mark_broker_knows_us()
 
         need_to_announce = force
         if force:
@@ -201,56 +511,57 @@ class Connector:
         if need_to_announce:
             params = {"recipient": self.broker_url}
             url = pathjoin(self.url, "api/ids/connector/update")
-            response = requests.post(url=url,
-                                     params=params,
-                                     auth=HTTPBasicAuth(self.auth[0],
-                                                        self.auth[1]))
+            response = self._post(url=url,
+                                  params=params)
             log.debug("\t|--- /connector/update response was " + str(
                 response.status_code))
             if response.status_code < 299:
-                self.broker_knows_us_timestamp = datetime.datetime.now()
+                self._mark_broker_knows_us()
         else:
             log.debug("\t---____ NO NEED TO ANNOUNCE US _______________")
             log.debug("\t---" + str(r.status_code) + "  with lines: " + str(
                 numlines))
-            self.broker_knows_us_timestamp = datetime.datetime.now()
+            self._mark_broker_knows_us()
 
         return True
 
     def send_resource_to_broker(self, resource_uri: str):
-        sent_succesfully = False
-        attempts = 0
-        while not sent_succesfully:
-            attempts += 1
-            sent_succesfully = True
-            self.announce_to_broker()
-            params = {"recipient": self.broker_url,
-                      "resourceId": resource_uri}
-            url = pathjoin(self.url, "api/ids/resource/update")
-            response = requests.post(url=url,
-                                     params=params,
-                                     auth=HTTPBasicAuth(self.auth[0],
-                                                        self.auth[1]))
-            log.debug("------ \n\n REQUEST TO ADD TO BROKER " + url + " :")
-            log.debug(json.dumps(params, indent=1))
-            log.debug("------ RESPONSE OF SEND RESOURCE TO BROKER IS :  ")
-            log.debug(response.text)
-            log.debug("\n\n\n\n ----------------------\n -----------------\n")
-            if (response.status_code > 299 or ("RejectionMessage" in
-                                               response.text)):
-                sent_succesfully = False
-                log.error("\n\n----- THE BROKER REJECTED THE ASSET " +str(
-                    attempts)+" TIMES")
-                log.error("Connector returned: " + str(response.status_code))
-                log.error("Something went wrong when sending announcment to "
-                          "broker, retrying in 1s")
-                log.debug("\n| Will first force announce")
-                self.announce_to_broker(force=True)
-                log.debug("----------------\n|\n|\n")
-                time.sleep(1)
-
-            if attempts > self.broker_knows_us_limit:
-                log.error("{} attempts not push to broker failed", str(self.broker_knows_us_limit))
-                return False
+        """
+        Asks the broker to index the resource, once. Raises a
+        ConnectorException if the broker rejects it or cannot be reached;
+        the retries are left to ckanext.ids.broker_publication, which does
+        not hold the caller in a sleep loop.
+        """
+        self.announce_to_broker()
+        params = {"recipient": self.broker_url,
+                  "resourceId": resource_uri}
+        url = pathjoin(self.url, "api/ids/resource/update")
+        response = self._post(url=url,
+                              params=params)
+        log.debug("------ \n\n REQUEST TO ADD TO BROKER " + url + " :")
+        log.debug(json.dumps(params, indent=1))
+        log.debug("------ RESPONSE OF SEND RESOURCE TO BROKER IS :  ")
+        log.debug(response.text)
+        if response.status_code > 299 or "RejectionMessage" in response.text:
+            log.error("The broker rejected the asset " + str(resource_uri) +
+                      ", connector returned: " + str(response.status_code))
+            raise ConnectorException("Code: " + str(response.status_code) +
+                                     " Text: " + str(response.text))
+
+        # A new or updated asset changes what the broker search returns
+        invalidate_search_cache()
+        return True
+
 
-        return response.status_code < 299
+def get_connector():
+    """
+    Returns the Connector of this process. It is created on first use and
+    then shared by all requests, so that its sessions, the announce state
+    and the caches are not thrown away at the end of each request.
+    """
+    global _connector
+    if _connector is None:
+        with _connector_lock:
+            if _connector is None:
+                _connector = Connector()
+    return _connector
@@ -20,19 +20,44 @@
 import requests
 import json
 import cachetools.func
+from requests.adapters import HTTPAdapter
 
 # Suppress ssl verification warning
 requests.packages.urllib3.disable_warnings()
 
 
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """ An HTTPAdapter with a (connect, read) timeout for every request """
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, timeout=timeout, **kwargs)
+
+
 class ResourceApi:
     session = None
     recipient = None
+    # Cleared when the connector answers HEAD with 405 or 501
+    head_supported = True
 
-    def __init__(self, recipient, auth=("admin", "password")):
+    def __init__(self, recipient, auth=("admin", "password"), pool_size=10,
+                 timeout=None):
         self.session = requests.Session()
         self.session.auth = auth
         self.session.verify = False
+        # Enough kept-alive connections for the calls made in parallel. A
+        # connector that hangs must not block the caller (and the locks it
+        # holds) forever
+        adapter = TimeoutHTTPAdapter(timeout=timeout,
+                                     pool_connections=pool_size,
+                                     pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
         self.recipient = recipient
 
@@ -46,6 +71,30 @@ class ResourceApi:
         response = self.session.get(offer_uri)
         return response.status_code < 399
 
+    def _probe(self, uri):
+        if self.head_supported:
+            response = self.session.head(uri)
+            if response.status_code not in (405, 501):
+                return response.status_code < 399
+            self.head_supported = False
+        # Only the status is needed, the body is not downloaded
+        with self.session.get(uri, stream=True) as response:
+            return response.status_code < 399
+
+    def resources_exist(self, uris, executor=None):
+        """
+        Checks at once whether the given entities (offers, representations,
+        artifacts...) exist, with HEAD requests run on the executor (one
+        after the other without it). Returns a dict uri -> exists.
+        """
+        uris = list(dict.fromkeys(uris))
+        for uri in uris:
+            if not uri.startswith(self.recipient + "/api/"):
+                raise ValueError(uri)
+        if executor is None:
+            return {uri: self._probe(uri) for uri in uris}
+        return dict(zip(uris, executor.map(self._probe, uris)))
+
     @cachetools.func.ttl_cache(3)
     def get_catalogs(self, data={}):
         response = self.session.get(self.recipient + "/api/catalogs")
@@ -1,10 +1,10 @@
-from ckanext.ids.dataspaceconnector.connector import Connector
+from ckanext.ids.dataspaceconnector.connector import get_connector
 from ckanext.ids.dataspaceconnector.offer import Offer
 from ckanext.ids.dataspaceconnector.resource import Resource
 
 
 def delete_from_dataspace_connector(data):
-    local_resource_dataspace_connector = Connector().get_resource_api()
+    local_resource_dataspace_connector = get_connector().get_resource_api()
     offer = Offer(data)
     for value in data["resources"]:
         # this has also to run for every resource
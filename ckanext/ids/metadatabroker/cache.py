@@ -0,0 +1,150 @@
+import copy
+import logging
+import threading
+
+import cachetools
+from ckan.common import config
+
+log = logging.getLogger("ckanext")
+
+default_search = "*:*"
+
+
+class BrokerCache:
+    """
+    A bounded TTL/LRU cache for answers of the broker, safe to use from
+    several threads, which keeps hit/miss counters so that it can be sized.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: int,
+                 copy_values: bool = True):
+        self.name = name
+        # The plugin decorates search results in place (labels, tracking),
+        # so mutable values are copied on their way in and out
+        self.copy_values = copy_values
+        # A size of 0 (or less) turns the cache off: everything misses
+        self.enabled = maxsize > 0
+        self._cache = cachetools.TTLCache(maxsize=max(maxsize, 1), ttl=ttl)
+        self._lock = threading.RLock()
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, key):
+        with self._lock:
+            value = self._cache.get(key) if self.enabled else None
+            if value is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+        return copy.deepcopy(value) if self.copy_values else value
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        if self.copy_values:
+            value = copy.deepcopy(value)
+        with self._lock:
+            self._cache[key] = value
+
+    def invalidate(self):
+        with self._lock:
+            self._cache.clear()
+            self._stats["invalidations"] += 1
+        log.debug("Broker cache '" + self.name + "' invalidated")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = self._cache.currsize
+            stats["maxsize"] = self._cache.maxsize if self.enabled else 0
+            stats["ttl"] = self._cache.ttl
+        return stats
+
+
+# Pages of broker_package_search. The broker is queried through the local
+# connector, so every page view costs several SPARQL round-trips. The same
+# first pages are requested over and over, so we keep them for a while.
+search_cache = BrokerCache(
+    "search",
+    maxsize=int(config.get("ckanext.ids.broker_search_cache_size", 256)),
+    ttl=int(config.get("ckanext.ids.broker_search_cache_ttl", 60)))
+
+# Total number of hits of a search. It does not depend on the page, so it
+# is kept longer than the pages themselves.
+count_cache = BrokerCache(
+    "count",
+    maxsize=int(config.get("ckanext.ids.broker_search_cache_size", 256)),
+    ttl=int(config.get("ckanext.ids.broker_count_cache_ttl", 300)),
+    copy_values=False)
+
+# Descriptions of broker resources (ask_broker_for_description), used by the
+# external asset page and the recommender. The entries live long, but after
+# broker_description_cache_fresh seconds they are revalidated against the
+# ids:modified of the resource before being used again.
+description_cache = BrokerCache(
+    "description",
+    maxsize=int(config.get("ckanext.ids.broker_description_cache_size", 512)),
+    ttl=int(config.get("ckanext.ids.broker_description_cache_ttl", 3600)),
+    copy_values=False)
+# Facet counts of a search. They are the most expensive query we send, and
+# barely change with the page or the search text.
+facet_cache = BrokerCache(
+    "facets",
+    maxsize=int(config.get("ckanext.ids.broker_search_cache_size", 256)),
+    ttl=int(config.get("ckanext.ids.broker_facet_cache_ttl", 300)))
+
+# Facet counts of the whole catalog (no text, no facet filter) per asset
+# type, recomputed in the background every broker_facet_precompute_interval
+# seconds. They expire if the recomputation stops.
+facet_precompute_interval = int(config.get(
+    "ckanext.ids.broker_facet_precompute_interval", 600))
+base_facet_cache = BrokerCache(
+    "base_facets",
+    maxsize=64,
+    ttl=2 * max(facet_precompute_interval, 1))
+
+description_fresh_seconds = int(config.get(
+    "ckanext.ids.broker_description_cache_fresh", 30))
+
+
+def search_cache_key(q, fq, facet_fields, start, rows):
+    """
+    Normalizes the search parameters, so that equivalent searches share the
+    same cache entry.
+    """
+    if q is None or q == "" or q == default_search:
+        q = None
+    fq = tuple(sorted(fq)) if fq is not None else ()
+    facet_fields = tuple(sorted(facet_fields)) \
+        if facet_fields is not None else ()
+    return (q, fq, facet_fields, int(start or 0), int(rows or 0))
+
+
+def count_cache_key(q, fq, facet_fields):
+    return search_cache_key(q, fq, facet_fields, 0, 0)[:3]
+
+
+def facet_cache_key(q, fq, facet_properties, resource_type):
+    """
+    Only the fq entries of the facets shown filter the facet counts, the
+    rest of the fq (and the page) does not matter
+    """
+    if q is None or q == "" or q == default_search:
+        q = None
+    properties = dict(facet_properties)
+    selected = tuple(sorted(x for x in fq or ()
+                            if x.split(":", 1)[0] in properties))
+    return (q, selected, resource_type, tuple(facet_properties))
+
+
+def invalidate_search_cache():
+    search_cache.invalidate()
+    count_cache.invalidate()
+    facet_cache.invalidate()
+
+
+def cache_stats():
+    return {"search": search_cache.stats(),
+            "count": count_cache.stats(),
+            "facets": facet_cache.stats(),
+            "base_facets": base_facet_cache.stats(),
+            "description": description_cache.stats()}
@@ -2,24 +2,33 @@ import datetime
 import hashlib
 import json
 import logging
+import os
+import threading
+import time
 import urllib.parse
 from copy import deepcopy
-from typing import Set, List, Dict
+from functools import partial
+from typing import Set, List, Dict, Tuple
 from urllib.parse import urlparse
 import re
 
 import ckan.lib.dictization
 import ckan.logic as logic
 import ckan.lib.helpers as h
-from ckanext.scheming.helpers import scheming_get_schema, scheming_field_by_name
+from ckanext.ids.schema_index import get_schema_index
 import rdflib
-from rdflib.plugins.sparql.results.tsvresults import TSVResultParser
-from rdflib.term import Variable
-from io import StringIO
 from ckan.common import config
 
 
-from ckanext.ids.dataspaceconnector.connector import Connector, ConnectorException
+from ckanext.ids.dataspaceconnector.connector import get_connector, ConnectorException
+from ckanext.ids.metadatabroker.cache import search_cache, count_cache, \
+    search_cache_key, count_cache_key, facet_cache, base_facet_cache, \
+    facet_cache_key, facet_precompute_interval
+from ckanext.ids.metadatabroker import sparql_queries
+from ckanext.ids.metadatabroker.providers import get_provider_registry
+from ckanext.ids.metadatabroker.search_hit import LazySearchHit
+from ckanext.ids.metadatabroker.sparql_results import parse_sparql_results
+from ckanext.ids.metadatabroker.text_index import get_text_index
 from ckanext.ids.metadatabroker.translations_broker_ckan import URI, \
     empty_result
 
@@ -37,11 +46,17 @@ _get_or_bust = logic.get_or_bust
 # log = logging.getLogger('ckan.logic')
 log = logging.getLogger("ckanext")
 
-connector = Connector()
+connector = get_connector()
 log.info("Using " + connector.broker_url + " as broker URL")
 
 idsresource = rdflib.URIRef("https://w3id.org/idsa/core/Resource")
 
+# None is the search over all asset types
+BASE_FACET_ASSET_TYPES = (None, "Dataset", "Service", "Application")
+_base_facet_fields = ()
+_facet_precompute_pid = None
+_facet_precompute_lock = threading.Lock()
+
 rdftype = rdflib.namespace.RDF["type"]
 
 
@@ -64,11 +79,7 @@ def _grouping_from_table_to_dict(triples_list: List[Dict],
 
 
 def _parse_broker_tabular_response(raw_text):
-    parser = TSVResultParser()
-    input = StringIO(raw_text)
-
-    result = parser.parse(source=input)
-    return result
+    return parse_sparql_results(raw_text)
 
 
 def _sparql_describe_many_resources(resources: Set[rdflib.URIRef]) -> str:
@@ -89,134 +100,74 @@ def _sparql_describe_many_resources(resources: Set[rdflib.URIRef]) -> str:
     return query
 
 
-# ToDo uncomment filter statement
-def _sparl_get_all_resources(resource_type: str, fts_query: str, fq: list, facet_fields: list,
-                             limit: int, offset: int, type_pred="https://www.trusts-data.eu/ontology/asset_type"):
-    catalogiri = URI(config.get("ckanext.ids.connector_catalog_iri")).n3()
+def _facet_properties(facet_fields) -> Tuple[Tuple[str, str], ...]:
+    """
+    (field name, property) of the facets that can be asked to the broker
+    """
     #TODO: make this resource type specific
-    dataset_schema = scheming_get_schema("dataset", "dataset", True)
-    query = """
-      PREFIX owl: <http://www.w3.org/2002/07/owl#>
-      PREFIX ids: <https://w3id.org/idsa/core/>
-      SELECT ?resultUri ?type ?title ?description ?assettype ?externalname ?license ?creationDate
-      WHERE
-      { ?resultUri a ?type . 
-        ?conn <https://w3id.org/idsa/core/offeredResource> ?resultUri .
-        ?resultUri ids:title ?title .
-        ?resultUri ids:description ?description .
-        ?resultUri owl:sameAs ?externalname .
-        OPTIONAL {  ?resultUri ids:standardLicense ?license . }
-        OPTIONAl {  ?resultUri ids:created ?creationDateTemp . }
-        BIND (str(coalesce(?creationDateTemp, "Not Specified")) as ?creationDate)
-        FILTER (!regex(str(?externalname),\"""" + config.get(
-        'ckanext.ids.local_node_name') + """\",\"i\"))
-        """
-    facet_filters = build_facet_filters(fq, facet_fields, dataset_schema)
-    for facet_filter in facet_filters:
-        query += facet_filter
-
-    if resource_type is None or resource_type == "None":
-        query += "\n ?resultUri " + URI(type_pred).n3() + " ?assettype."
-    else:
-        typeuri = URI("https://www.trusts-data.eu/ontology/" + \
-                      resource_type.capitalize())
-        query += "\n ?resultUri " + URI(
-            type_pred).n3() + " ?assettype ."
-        query += "\nvalues ?assettype { " + typeuri.n3() + " } "
-    if fts_query is not None:
-        query += "FILTER regex(concat(?title, \" \",?description, \" \",str(?externalname)), \"" + fts_query + "\", \"i\")"
-    query += "\n}"
-    query += " LIMIT " + str(limit) + " OFFSET " + str(offset)
-    return query
+    schema_index = get_schema_index("dataset")
+    facet_properties = []
+    for facet_field in facet_fields or []:
+        schema_field = schema_index.field_by_name(facet_field)
+        if schema_field is not None and "display_property" in schema_field:
+            facet_properties.append((facet_field,
+                                     schema_field["display_property"]))
+    return tuple(facet_properties)
 
 
-def build_facet_filters(fq: list, facet_fields: list, schema: dict):
-    facets = dictionize_facet_query(fq, facet_fields, schema)
-    facet_filters = []
-    for facet in facets:
-        facet_dict = facets[facet]
-        facet_filter = "?resultUri <" + facet_dict["property"] + "> ?" + facet + ". values ?" + facet +" { " + " ".join(facet_dict["values"]) + " }"
-        facet_filters.append(facet_filter)
-    return facet_filters
-
-
-def dictionize_facet_query(fq: list, facet_fields: list, schema: dict):
-    facets = {}
-    for facet in fq:
-        facet_item = facet.split(":", 1)
-        facet_key = facet_item[0]
-        if facet_key in facet_fields:
-            facet_value = sanitize_facet_value(facet_item[1])
-            if facet_key in facets.keys():
-                facets[facet_key]["values"].append(facet_value)
-            else:
-                scheming_field_by_name(schema["dataset_fields"], facet_key)
-                facets[facet_key] = {
-                    "property" : scheming_field_by_name(schema["dataset_fields"], facet_key)["display_property"],
-                    "values" : [facet_value]
-                }
-    return facets
-
-
-def sanitize_facet_value(value: str):
-    result = value
-    if "http" in value:
-        result = value.lstrip('"').rstrip('"')
-        result = "<" + result + ">"
-    elif value.startswith('"'):
-        result = value.replace('"', '')
+def _search_text_mode(search_string):
+    """
+    How the search text is matched in the broker, see
+    ckanext.ids.broker_search_mode. Returns the mode and, for the local
+    index, the URIs of the matching resources.
+    """
+    text_mode = config.get("ckanext.ids.broker_search_mode",
+                           sparql_queries.TEXT_MODE_REGEX)
+    if search_string is None or \
+            text_mode != sparql_queries.TEXT_MODE_LOCAL_INDEX:
+        return text_mode, None
+    matches = get_text_index().search(search_string)
+    if matches is None:
+        # No index to look in, let the broker do the matching
+        return sparql_queries.TEXT_MODE_REGEX, None
+    return text_mode, tuple(sorted(matches))
 
-    return result
 
-def _sparl_get_facets(resource_type: str, fts_query: str, fq: str, facet_fields, type_pred="https://www.trusts-data.eu/ontology/asset_type"):
-    catalogiri = URI(config.get("ckanext.ids.connector_catalog_iri")).n3()
-    #TODO: make this resource type specific
-    dataset_schema = scheming_get_schema("dataset", "dataset", True)
-    facet_properties = []
-    for facet_field in facet_fields:
-        schema_field = scheming_field_by_name(dataset_schema["dataset_fields"], facet_field)
-        if schema_field is not None:
-            property = schema_field["display_property"]
-            if "://" in property:
-                facet_properties.append(URI(property).n3())
-            else:
-                facet_properties.append(property)
-
-
-    query = """
-          PREFIX  owl:  <http://www.w3.org/2002/07/owl#>
-          PREFIX  ids:  <https://w3id.org/idsa/core/>
-          SELECT  (count(?resultUri) as ?facet_count) (str(?facet) as ?facet_string) (str(?facet_value) as ?facet_value_string)
-          WHERE
-          { graph ?g
-            {  
-                ?conn     ids:offeredResource   ?resultUri .
-                ?resultUri  owl:sameAs            ?externalname .
-                FILTER (!regex(str(?externalname),\"""" + config.get('ckanext.ids.local_node_name') + """\",\"i\"))               
-                OPTIONAL { ?resultUri ?facet ?facet_value }
-                OPTIONAL { ?resultUri ids:description ?description }
-                VALUES ?facet { """ + " ".join(facet_properties) + """ } """
-    facet_filters = build_facet_filters(fq, facet_fields, dataset_schema)
-    for facet_filter in facet_filters:
-        query += facet_filter
-    if resource_type is None or resource_type == "None":
-        query += "\n ?resultUri " + URI(type_pred).n3() + " ?assettype."
-    else:
-        typeuri = URI("https://www.trusts-data.eu/ontology/" + \
-                      resource_type.capitalize())
-        query += "\n ?resultUri " + URI(
-            type_pred).n3() + " ?assettype ."
-        query += "\nvalues ?assettype { " + typeuri.n3() + " } "
-    if fts_query is not None:
-        query += "FILTER regex(concat(?title, \" \",?description, \" \",str(?externalname)), \"" + fts_query + "\", \"i\")"
-    query += """ 
-            }
-          }
-          group by ?facet ?facet_value
-          order by ?facet DESC(?facet_count) ?facet_value
-        """
-    # query += " LIMIT " + str(limit) + " OFFSET " + str(offset)
-    return query
+def _sparl_get_all_resources(resource_type: str, fts_query: str, fq: list, facet_fields: list,
+                             limit: int, offset: int, type_pred=sparql_queries.ASSET_TYPE_PREDICATE,
+                             text_mode=sparql_queries.TEXT_MODE_REGEX, text_matches=None):
+    return sparql_queries.results_query(
+        resource_type, fts_query, tuple(fq or ()),
+        _facet_properties(facet_fields),
+        config.get('ckanext.ids.local_node_name'), limit, offset, type_pred,
+        text_mode, text_matches)
+
+
+def _sparl_count_resources(resource_type: str, fts_query: str, fq: list, facet_fields: list,
+                           type_pred=sparql_queries.ASSET_TYPE_PREDICATE,
+                           text_mode=sparql_queries.TEXT_MODE_REGEX, text_matches=None):
+    return sparql_queries.count_query(
+        resource_type, fts_query, tuple(fq or ()),
+        _facet_properties(facet_fields),
+        config.get('ckanext.ids.local_node_name'), type_pred,
+        text_mode, text_matches)
+
+
+def _sparl_get_facets(resource_type: str, fts_query: str, fq: list, facet_fields,
+                      type_pred=sparql_queries.ASSET_TYPE_PREDICATE,
+                      text_mode=sparql_queries.TEXT_MODE_REGEX, text_matches=None):
+    return sparql_queries.facets_query(
+        resource_type, fts_query, tuple(fq or ()),
+        _facet_properties(facet_fields),
+        config.get('ckanext.ids.local_node_name'), type_pred,
+        text_mode, text_matches)
+
+
+def _parse_count_response(raw_text):
+    parsed = _parse_broker_tabular_response(raw_text)
+    for binding in parsed.dicts():
+        return int(str(binding["count"]))
+    return 0
 
 
 def listofdicts2graph(lod: List[Dict],
@@ -312,113 +263,135 @@ def rewrite_urls(provider_base, input_url):
     return a._replace(netloc=provider_base).geturl()
 
 
-# We pass the results of a query with
-#    SELECT ?resultUri ?type ?title ?description ?assettype WHERE
-def create_moot_ckan_result(binding):
-
-    license = str(binding[Variable("license")])
-    externalName = str(binding[Variable("externalname")])
-    title = str(binding[Variable("title")])
-    description = str(binding[Variable("description")])
-    resultUri = str(binding[Variable("resultUri")])
-    creationDate = str(binding[Variable("creationDate")])
-    assetType = str(binding[Variable("assettype")])
-
-    theirname = externalName
-    organization_name = theirname.split("/")[2].split(":")[0]
+_moot_resource = {
+    "artifact": "http://artifact.uri/",
+    "cache_last_updated": None,
+    "cache_url": None,
+    "format": "EXTERNAL",
+    "hash": "SOMEHASH",
+    "id": "http://artifact.uri/",
+    "mimetype": "MEDIATYPE",
+    "mimetype_inner": None,
+    "position": 0,
+    "representation": "http://artifact.uri/",
+    "resource_type": "resource",
+    "size": 999,
+    "state": "active",
+    "url": "http://artifact.uri/",
+    "url_type": "upload"
+}
+
+# Everything of a moot result that does not depend on the broker row, shared
+# by a shallow copy. The mutable fields are built by each LazySearchHit, the
+# organization comes from the provider registry.
+_moot_result = dict(empty_result)
+_moot_result.update({
+    "theme": "THEME",
+    "version": "VERSION",
+    "creator_user_id": "X",
+    "maintainer": None,
+    "maintainer_email": None,
+    "num_tags": 0,
+    "private": False,
+    "state": "active",
+    "dataset_count": 0,
+    "service_count": 0,
+    "application_count": 0,
+    "num_resources": 1
+})
+for _lazy_field in ("organization", "owner_org", "resources",
+                    "relationships_as_object", "relationships_as_subject",
+                    "tags", "groups"):
+    del _moot_result[_lazy_field]
+
+# The variables of the search query used to build a moot result, in the
+# order of the arguments of _build_moot_ckan_result
+MOOT_RESULT_VARIABLES = ("resultUri", "title", "description", "externalname",
+                         "license", "creationDate", "assettype")
+
+
+def _moot_resources(resultUri, title, description, now):
+    ckan_resource = dict(_moot_resource)
+    ckan_resource["created"] = now
+    ckan_resource["description"] = description
+    ckan_resource["last_modified"] = now
+    ckan_resource["metadata_modified"] = now
+    ckan_resource["name"] = title
+    ckan_resource["package_id"] = resultUri
+    return [ckan_resource]
+
+
+def _build_moot_ckan_result(resultUri, title, description, externalName,
+                            license, creationDate, assetType, now,
+                            process_external_url):
+    organization_name = externalName.split("/")[2].split(":")[0]
     providing_base_url = "/".join(organization_name.split("/")[:3])
-    organization_data = {
-        "id": "52bc9332-2ba1-4c4f-bf85-5a141cd68423",
-        "name": organization_name,
-        "title": "Orga1",
-        "type": "organization",
-        "description": "",
-        "image_url": "",
-        "created": "2022-02-02T16:32:58.653424",
-        "is_organization": True,
-        "approval_status": "approved",
-        "state": "active"
-    }
-    resources = []
+    asset_type = assetType.split("/")[-1].lower()
 
-    lictit = ""
-    if "http://" or "https://" in license:
-        lictit = license.split("/")[-1]
-
-    packagemeta = deepcopy(empty_result)
+    packagemeta = dict(_moot_result)
     packagemeta["id"] = resultUri
     packagemeta["license_id"] = license
     packagemeta["license_url"] = license
-    packagemeta["license_title"] = lictit
+    packagemeta["license_title"] = license.split("/")[-1]
     packagemeta["metadata_created"] = creationDate
-    packagemeta["metadata_modified"] = datetime.datetime.now().isoformat()
+    packagemeta["metadata_modified"] = now
     packagemeta["name"] = title
     packagemeta["title"] = title
     packagemeta["description"] = description
-    packagemeta["type"] = assetType.split("/")[
-        -1].lower()
-    packagemeta["theme"] = "THEME"
-    packagemeta["version"] = "VERSION"
+    packagemeta["type"] = asset_type
 
     # These are the values we will use in succesive steps
     packagemeta["external_provider_name"] = organization_name
-    packagemeta["to_process_external"] = config.get(
-        "ckan.site_url") + "/ids/processExternal?uri=" + \
-                                         urllib.parse.quote_plus(
-                                             resultUri)
+    packagemeta["to_process_external"] = process_external_url + \
+        urllib.parse.quote_plus(resultUri)
     packagemeta["provider_base_url"] = providing_base_url
 
-    packagemeta["creator_user_id"] = "X"
-    packagemeta["isopen"]: None
-    packagemeta["maintainer"] = None
-    packagemeta["maintainer_email"] = None
     packagemeta["notes"] = description
-    packagemeta["num_tags"] = 0
-    packagemeta["private"] = False
-    packagemeta["state"] = "active"
-    packagemeta["relationships_as_object"] = []
-    packagemeta["relationships_as_subject"] = []
     packagemeta["url"] = providing_base_url
-    packagemeta["tags"] = []  # (/)
-    packagemeta["groups"] = []  # (/)
-
-    packagemeta["dataset_count"] = 0
-    packagemeta["service_count"] = 0
-    packagemeta["application_count"] = 0
-    packagemeta[packagemeta["type"] + "count"] = 1
-
-    empty_ckan_resource = {
-        "artifact": "http://artifact.uri/",
-        "cache_last_updated": None,
-        "cache_url": None,
-        "created": datetime.datetime.now().isoformat(),
-        "description": description,
-        "format": "EXTERNAL",
-        "hash": "SOMEHASH",
-        "id": "http://artifact.uri/",
-        "last_modified": datetime.datetime.now().isoformat(),
-        "metadata_modified": datetime.datetime.now().isoformat(),
-        "mimetype": "MEDIATYPE",
-        "mimetype_inner": None,
-        "name": title,
-        "package_id": resultUri,
-        "position": 0,
-        "representation": "http://artifact.uri/",
-        "resource_type": "resource",
-        "size": 999,
-        "state": "active",
-        "url": "http://artifact.uri/",
-        "url_type": "upload"
-    }
-    resources.append(empty_ckan_resource)
+    packagemeta[asset_type + "count"] = 1
 
+    # Shared by all the hits of the provider
+    organization_data = get_provider_registry().organization(organization_name)
     packagemeta["organization"] = organization_data
     packagemeta["owner_org"] = organization_data["id"]
-    packagemeta["resources"] = resources
-    packagemeta["num_resources"] = 1
-    # log.error(json.dumps(packagemeta,indent=1)+"\n.\n.\n.\n\n")
 
-    return packagemeta
+    # The search listing hardly reads these, they are built when it does
+    return LazySearchHit(packagemeta, {
+        "resources": partial(_moot_resources, resultUri, title, description,
+                             now),
+        "relationships_as_object": list,
+        "relationships_as_subject": list,
+        "tags": list,  # (/)
+        "groups": list  # (/)
+    })
+
+
+def _process_external_url():
+    return config.get("ckan.site_url") + "/ids/processExternal?uri="
+
+
+# We pass the results of a query with
+#    SELECT ?resultUri ?type ?title ?description ?assettype WHERE
+def create_moot_ckan_result(binding, now=None):
+    if now is None:
+        now = datetime.datetime.now().isoformat()
+    return _build_moot_ckan_result(
+        *[str(binding[x]) for x in MOOT_RESULT_VARIABLES],
+        now=now, process_external_url=_process_external_url())
+
+
+def create_moot_ckan_results(variables, rows):
+    """
+    The moot results of all the rows (tuples in the order of variables) of
+    a page of search results, with one timestamp for the whole page
+    """
+    now = datetime.datetime.now().isoformat()
+    process_external_url = _process_external_url()
+    positions = [variables.index(x) for x in MOOT_RESULT_VARIABLES]
+    return [_build_moot_ckan_result(*[str(row[i]) for i in positions],
+                                    now=now,
+                                    process_external_url=process_external_url)
+            for row in rows]
 
 
 def clean_multilang(astring: str):
@@ -453,18 +426,7 @@ def graphs_to_ckan_result_format(raw_jsonld: Dict):
     theirname = resource_uri
     organization_name = theirname.split("/")[2].split(":")[0]
     providing_base_url = "/".join(organization_name.split("/")[:3])
-    organization_data = {
-        "id": "52bc9332-2ba1-4c4f-bf85-5a141cd68423",
-        "name": organization_name,
-        "title": "Orga1",
-        "type": "organization",
-        "description": "",
-        "image_url": "",
-        "created": "2022-02-02T16:32:58.653424",
-        "is_organization": True,
-        "approval_status": "approved",
-        "state": "active"
-    }
+    organization_data = get_provider_registry().organization(organization_name)
     resources = []
 
     packagemeta = deepcopy(empty_result)
@@ -482,19 +444,8 @@ def graphs_to_ckan_result_format(raw_jsonld: Dict):
     packagemeta["type"] = resource_graphs[0]["asset_type"].split("/")[
         -1].lower()
 
-    schema_fields = scheming_get_schema("dataset", packagemeta["type"], True)
-    excluded_fields = [
-        'id',
-        'title',
-        'name',
-        'notes',
-        'tag_string',
-        'license_id',
-        'owner_org',
-    ]
-    for field in schema_fields["dataset_fields"]:
-        field_name = field["field_name"]
-        if field_name not in excluded_fields and field_name in resource_graphs[0]:
+    for field_name in get_schema_index(packagemeta["type"]).copied_fields:
+        if field_name in resource_graphs[0]:
             packagemeta[field_name] = clean_multilang(resource_graphs[0][field_name])
     packagemeta["version"] = resource_graphs[0]["version"]
 
@@ -563,15 +514,81 @@ def graphs_to_ckan_result_format(raw_jsonld: Dict):
     return packagemeta
 
 
-@ckan.logic.side_effect_free
-def broker_package_search(q=None, start_offset=0, limit=None, fq=None, facet_fields=None):
-    log.debug("\n--- STARTING  BROKER SEARCH  ----------------------------\n")
-    log.debug(str(q))
-    log.debug(str(fq))
-    log.debug("-----------------------------------------------------------\n")
-    default_search = "*:*"
-    search_string = None if q == default_search else q
+def _is_base_facet_key(facet_key):
+    return facet_key[0] is None and len(facet_key[1]) == 0
+
+
+def _get_cached_facets(search_string, fq, facet_fields, requested_type):
+    """
+    Facet counts of a search from the caches, or None. Also returns the key
+    to store them under once they are asked to the broker.
+    """
+    facet_key = facet_cache_key(search_string, fq,
+                                _facet_properties(facet_fields),
+                                requested_type)
+    if _is_base_facet_key(facet_key):
+        start_facet_precompute(facet_fields)
+        facets_result = base_facet_cache.get(facet_key)
+        if facets_result is not None:
+            return facet_key, facets_result
+    return facet_key, facet_cache.get(facet_key)
+
+
+def _set_cached_facets(facet_key, facets_result):
+    if _is_base_facet_key(facet_key):
+        base_facet_cache.set(facet_key, facets_result)
+    else:
+        facet_cache.set(facet_key, facets_result)
+
+
+def precompute_base_facets(facet_fields):
+    """
+    Asks the broker for the facet counts of the whole catalog, for all and
+    for each asset type, and keeps them in base_facet_cache.
+    """
+    facet_properties = _facet_properties(facet_fields)
+    local_node = config.get('ckanext.ids.local_node_name')
+    queries = [sparql_queries.facets_query(x, None, (), facet_properties,
+                                           local_node)
+               for x in BASE_FACET_ASSET_TYPES]
+    responses = connector.query_broker_concurrently(queries)
+    for resource_type, response in zip(BASE_FACET_ASSET_TYPES, responses):
+        base_facet_cache.set(
+            facet_cache_key(None, (), facet_properties, resource_type),
+            refactor_facets_parsed_response(
+                _parse_broker_tabular_response(response)))
+    log.debug("Base facet counts of the broker precomputed")
+
+
+def _facet_precompute_loop():
+    while True:
+        try:
+            precompute_base_facets(_base_facet_fields)
+        except Exception as e:
+            log.error("Precomputing the broker facets failed: " + str(e))
+        time.sleep(facet_precompute_interval)
+
 
+def start_facet_precompute(facet_fields):
+    """
+    The facets shown are only known once somebody searches, from then on
+    the base facet counts are kept up to date by a background thread.
+    """
+    global _base_facet_fields, _facet_precompute_pid
+    _base_facet_fields = tuple(facet_fields or ())
+    # Checking the pid restarts the thread in forked workers
+    if facet_precompute_interval <= 0 or \
+            _facet_precompute_pid == os.getpid():
+        return
+    with _facet_precompute_lock:
+        if _facet_precompute_pid == os.getpid():
+            return
+        _facet_precompute_pid = os.getpid()
+        threading.Thread(target=_facet_precompute_loop,
+                         name="broker-base-facets", daemon=True).start()
+
+
+def requested_asset_type(fq):
     # By default we will search for all sorts of stuff
     requested_type = None
     try:
@@ -583,6 +600,25 @@ def broker_package_search(q=None, start_offset=0, limit=None, fq=None, facet_fie
             requested_type = requested_type[0].split(":")[-1].capitalize()
     except:
         pass
+    return requested_type
+
+
+@ckan.logic.side_effect_free
+def broker_package_search(q=None, start_offset=0, limit=None, fq=None, facet_fields=None):
+    log.debug("\n--- STARTING  BROKER SEARCH  ----------------------------\n")
+    log.debug(str(q))
+    log.debug(str(fq))
+    log.debug("-----------------------------------------------------------\n")
+    cache_key = search_cache_key(q, fq, facet_fields, start_offset, limit)
+    cached_response = search_cache.get(cache_key)
+    if cached_response is not None:
+        log.debug("Broker search served from cache")
+        return cached_response
+
+    default_search = "*:*"
+    search_string = None if q == default_search else q
+
+    requested_type = requested_asset_type(fq)
 
     # log.debug("Requested search type was " + str(requested_type) + "\n\n")
     search_results = []
@@ -594,7 +630,7 @@ def broker_package_search(q=None, start_offset=0, limit=None, fq=None, facet_fie
                                                offset=start_offset, limit=limit)
         parsed_response = _parse_broker_tabular_response(raw_response)
         resource_uris = set([URI(x["resultUri"])
-                             for x in parsed_response
+                             for x in parsed_response.dicts()
                              if URI(x["type"]) == idsresource])
         descriptions = {
             ru.n3(): connector.ask_broker_for_description(ru.n3()[1:-1])
@@ -605,66 +641,85 @@ def broker_package_search(q=None, start_offset=0, limit=None, fq=None, facet_fie
             if pm is not None:
                 search_results.append(pm)
     else:
-        general_query = _sparl_get_all_resources(resource_type=requested_type, fts_query=search_string,
-                                                 fq=fq, facet_fields=facet_fields, limit=limit, offset=start_offset)
+        text_mode, text_matches = _search_text_mode(search_string)
+        if text_matches is not None and len(text_matches) == 0:
+            # Nothing in the catalog has these words
+            search_cache.set(cache_key, search_results)
+            return search_results
+        facet_key, facets_result = _get_cached_facets(search_string, fq, facet_fields, requested_type)
+        try:
+            general_query = _sparl_get_all_resources(resource_type=requested_type, fts_query=search_string,
+                                                     fq=fq, facet_fields=facet_fields, limit=limit, offset=start_offset,
+                                                     text_mode=text_mode, text_matches=text_matches)
+            queries = [general_query]
+            # The facets are only asked for when they aren't cached
+            if facets_result is None:
+                queries.append(_sparl_get_facets(resource_type=requested_type, fts_query=search_string, fq=fq,
+                                                 facet_fields=facet_fields, text_mode=text_mode,
+                                                 text_matches=text_matches))
+            # The total does not depend on the page, so it is cached on its own
+            count_key = count_cache_key(q, fq, facet_fields)
+            total_count = count_cache.get(count_key)
+            if total_count is None:
+                queries.append(_sparl_count_resources(resource_type=requested_type, fts_query=search_string,
+                                                      fq=fq, facet_fields=facet_fields,
+                                                      text_mode=text_mode, text_matches=text_matches))
+        except ValueError as e:
+            # Something in the search parameters can't be a SPARQL term
+            log.warning("Invalid broker search parameters: " + str(e))
+            return search_results
         log.debug("Default search activated---- type:" + str(requested_type))
         # log.debug("QUERY :\n\t" + str(general_query).replace("\n", "\n\t"))
 
+        # Results, facets and count are independent, so all round-trips to
+        # the broker run at the same time
         try:
-            raw_response = connector.query_broker(general_query)
+            responses = connector.query_broker_concurrently(queries)
+            raw_response = responses.pop(0)
+            if facets_result is None:
+                facets_result = refactor_facets_parsed_response(
+                    _parse_broker_tabular_response(responses.pop(0)))
+                _set_cached_facets(facet_key, facets_result)
+            if total_count is None:
+                total_count = _parse_count_response(responses.pop(0))
+                count_cache.set(count_key, total_count)
             parsed_response = _parse_broker_tabular_response(raw_response)
-            size_of_broker_results = len(parsed_response.bindings)
+            rows = list(parsed_response)
+            size_of_broker_results = len(rows)
         except ConnectorException as e:
             log.debug(e.message)
             h.flash_error("It was not possbile to establish connection to the Broker. Please contact your administrator to investigate further.")
-            size_of_broker_results = 0
+            return search_results
 
         if size_of_broker_results > 0:
             log.debug(str(size_of_broker_results) + "   RESOURCES FOUND "
                                                 "<------------------------------------\n")
 
         if size_of_broker_results == 0:
+            search_cache.set(cache_key, search_results)
             return search_results
 
-        for res in parsed_response.bindings:
-            pm = create_moot_ckan_result(res)
-            search_results.append(pm)
-
-        facets_query = _sparl_get_facets(resource_type=requested_type, fts_query=search_string, fq=fq, facet_fields=facet_fields)
-        facets_response = connector.query_broker(facets_query)
-
-        parsed_facets_response = _parse_broker_tabular_response(facets_response)
-        facets_result = refactor_facets_parsed_response(parsed_facets_response)
-
-    # -- SLOW version
-    # descriptions = {
-    #     ru.n3(): connector.ask_broker_for_description(ru.n3()[1:-1])
-    #     for ru in resource_uris}
-    #
-    # for k, v in descriptions.items():
-    #     pm = graphs_to_ckan_result_format(v)
-    #     if pm is not None:
-    #         search_results.append(pm)
+        search_results = create_moot_ckan_results(parsed_response.variables, rows)
 
     # log.debug("---- END BROKER SEARCH ------------\n-----------\n----\n-----")
 #    search_results["facets"] = facets
     response = {}
     response["results"] = search_results
     response["facets"] = facets_result
-    #TODO: this should come from a different query, now it is just wrong
-    response["count"] = len(search_results)
+    response["count"] = total_count
     response["search_facets"] = create_search_facets_object(facets_result)
+    search_cache.set(cache_key, response)
     return response
 
 
 def refactor_facets_parsed_response(facets_response):
     facets_result = {}
-    dataset_schema = scheming_get_schema("dataset", "dataset", True)
-    for facet_response in facets_response.bindings:
-        facet_uri = str(facet_response[Variable("facet_string")])
-        schema_field = scheming_field_by_display_property(dataset_schema["dataset_fields"], facet_uri)
+    schema_index = get_schema_index("dataset")
+    for facet_response in facets_response.dicts():
+        facet_uri = str(facet_response["facet_string"])
+        schema_field = schema_index.field_by_display_property(facet_uri)
         if schema_field is not None:
-            result = {str(facet_response[Variable("facet_value_string")]):int(str(facet_response[Variable("facet_count")]))}
+            result = {str(facet_response["facet_value_string"]):int(str(facet_response["facet_count"]))}
             field_name = schema_field.get("field_name")
             if field_name in facets_result:
                 facets_result[field_name].update(result)
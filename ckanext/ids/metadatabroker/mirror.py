@@ -0,0 +1,428 @@
+"""
+A local mirror of the resources offered in the broker by other connectors.
+
+With ckanext.ids.broker_search_source = mirror, the catalog search is served
+from two tables of the CKAN database (ids_broker_resource and
+ids_broker_resource_facet) instead of a live SPARQL query, so rendering a
+search page does not depend on the latency or availability of the broker.
+The broker is only asked by sync_mirror(), which fetches only the resources
+modified since the watermark of their connector (ids_broker_sync_state).
+It is run with `ckan ids mirror sync`
+(e.g. from cron) or as a background job with sync_mirror_job.
+"""
+import datetime
+import logging
+import os
+import time
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+from ckan.common import config
+from ckan.lib.redis import connect_to_redis
+from ckan.model.meta import Session
+from sqlalchemy import desc, distinct, func, or_
+
+import ckanext.ids.model as ids_model
+from ckanext.ids.dataspaceconnector.connector import get_connector
+from ckanext.ids.metadatabroker import sparql_queries
+from ckanext.ids.metadatabroker.cache import default_search
+from ckanext.ids.metadatabroker.client import create_moot_ckan_result, \
+    refactor_facets_parsed_response, create_search_facets_object, \
+    requested_asset_type, _facet_properties
+from ckanext.ids.metadatabroker.sparql_results import parse_sparql_results, \
+    SparqlResults
+from ckanext.ids.schema_index import get_schema_index
+from ckanext.ids.model import BrokerResource, BrokerResourceFacet, \
+    BrokerSyncState
+
+log = logging.getLogger("ckanext")
+
+MIRROR_SYNC_LOCK_KEY = "ckanext-ids:broker_mirror_sync_lock"
+# A sync that takes longer than this is assumed dead and its lock released
+MIRROR_SYNC_LOCK_TIMEOUT = 900
+
+_mirror_populated = False
+
+
+def mirror_enabled() -> bool:
+    return config.get("ckanext.ids.broker_search_source",
+                      "broker") == "mirror"
+
+
+def mirror_populated() -> bool:
+    """
+    Whether there is anything to search in. Until the first sync the search
+    goes to the broker.
+    """
+    global _mirror_populated
+    if not _mirror_populated:
+        _mirror_populated = \
+            Session.query(BrokerResource.uri).first() is not None
+    return _mirror_populated
+
+
+def _mirrored_properties() -> Tuple[str, ...]:
+    """
+    The properties of the dataset schema that can be used as facets. Only
+    full IRIs, the broker does not know the prefixes of the schema.
+    """
+    return tuple(sorted(x for x in
+                        get_schema_index("dataset").by_display_property
+                        if "://" in x))
+
+
+# -- Sync ---------------------------------------------------------------------
+
+def _parse_modified(value: Optional[str]) -> Optional[datetime.datetime]:
+    if value is None:
+        return None
+    try:
+        modified = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if modified.tzinfo is not None:
+        modified = modified.astimezone(datetime.timezone.utc) \
+            .replace(tzinfo=None)
+    return modified
+
+
+def _list_broker_resources(watermarks=None) -> Dict[str, Dict]:
+    """
+    uri -> row with its connector and ids:modified. Without watermarks all
+    the resources, else only the ones modified since then.
+    """
+    local_node = config.get("ckanext.ids.local_node_name")
+    if watermarks is None:
+        query = sparql_queries.mirror_list_query(local_node)
+    else:
+        query = sparql_queries.mirror_delta_query(local_node, watermarks)
+    listed = {}
+    for row in get_connector().query_broker_results(query).dicts():
+        listed.setdefault(row["resultUri"], row)
+    return listed
+
+
+def _fetch_chunks(uris, properties):
+    """
+    Descriptions and facet values of the given resources, several chunks at
+    once. Yields (resources rows, facets rows) per chunk.
+    """
+    chunk_size = int(config.get("ckanext.ids.broker_mirror_chunk_size", 100))
+    chunks = [tuple(uris[i:i + chunk_size])
+              for i in range(0, len(uris), chunk_size)]
+    queries = []
+    for chunk in chunks:
+        queries.append(sparql_queries.mirror_resources_query(chunk))
+        queries.append(sparql_queries.mirror_facets_query(chunk, properties))
+    responses = get_connector().query_broker_concurrently(queries)
+    for i in range(len(chunks)):
+        yield (parse_sparql_results(responses[2 * i]).dicts(),
+               parse_sparql_results(responses[2 * i + 1]).dicts())
+
+
+def _delete_resources(uris):
+    if len(uris) == 0:
+        return
+    Session.query(BrokerResourceFacet).filter(
+        BrokerResourceFacet.resource_uri.in_(uris)).delete(
+        synchronize_session=False)
+    Session.query(BrokerResource).filter(
+        BrokerResource.uri.in_(uris)).delete(synchronize_session=False)
+
+
+def _store_resources(resource_rows, facet_rows):
+    """
+    Replaces the mirrored resources with the given rows of
+    mirror_resources_query and mirror_facets_query. Returns how many were
+    stored per connector.
+    """
+    now = datetime.datetime.utcnow()
+    resources = {}
+    for row in resource_rows:
+        # Several types or licenses give several rows, the first one wins
+        if row["resultUri"] not in resources:
+            resources[row["resultUri"]] = {
+                "uri": row["resultUri"],
+                "connector": row["conn"],
+                "type": row["type"],
+                "title": row["title"],
+                "description": row["description"],
+                "assettype": row["assettype"],
+                "externalname": row["externalname"],
+                "license": row["license"],
+                "creation_date": row["creationDate"],
+                "modified": row["modified"],
+                "synced": now
+            }
+    facets = set()
+    for row in facet_rows:
+        if row["resultUri"] in resources:
+            facets.add((row["resultUri"], row["facet_string"],
+                        row["facet_value_string"]))
+
+    _delete_resources(list(resources.keys()))
+    if len(resources) > 0:
+        Session.execute(ids_model.ids_broker_resource_table.insert(),
+                        list(resources.values()))
+    if len(facets) > 0:
+        Session.execute(ids_model.ids_broker_resource_facet_table.insert(),
+                        [{"resource_uri": uri, "property": prop,
+                          "value": value} for uri, prop, value in facets])
+    return Counter(x["connector"] for x in resources.values())
+
+
+def _tombstones_due(states) -> bool:
+    interval = int(config.get("ckanext.ids.broker_mirror_tombstone_interval",
+                              3600))
+    listed = [x.listed for x in states.values() if x.listed is not None]
+    if len(states) == 0 or len(listed) < len(states):
+        return True
+    return (datetime.datetime.utcnow() - min(listed)).total_seconds() \
+        >= interval
+
+
+def _sync(full: bool = False) -> Dict:
+    """
+    Asks the broker only for the resources modified since the watermark of
+    their connector. Deleted resources can't be seen that way, so every
+    ckanext.ids.broker_mirror_tombstone_interval seconds (and with full) all
+    the resources are listed and the ones that are gone are deleted.
+    """
+    started = time.monotonic()
+    now = datetime.datetime.utcnow()
+    states = {x.connector: x for x in Session.query(BrokerSyncState).all()}
+    tombstones = full or _tombstones_due(states)
+    if tombstones:
+        listed = _list_broker_resources()
+    else:
+        listed = _list_broker_resources(tuple(
+            (x.connector, x.watermark) for x in states.values()
+            if x.watermark is not None))
+    mirrored = {uri: (modified, connector) for uri, modified, connector in
+                Session.query(BrokerResource.uri, BrokerResource.modified,
+                              BrokerResource.connector).all()}
+
+    removed = []
+    if tombstones:
+        removed = [uri for uri in mirrored if uri not in listed]
+    changed = []
+    for uri, row in listed.items():
+        if full or uri not in mirrored:
+            changed.append(uri)
+        elif row["modified"] is not None and \
+                row["modified"] != mirrored[uri][0]:
+            changed.append(uri)
+
+    stored = Counter()
+    if len(changed) > 0:
+        properties = _mirrored_properties()
+        for resource_rows, facet_rows in _fetch_chunks(changed, properties):
+            stored.update(_store_resources(resource_rows, facet_rows))
+    _delete_resources(removed)
+    deleted = Counter(mirrored[uri][1] for uri in removed)
+
+    # The new watermark of a connector is the newest ids:modified seen
+    newest = {}
+    for row in listed.values():
+        modified = _parse_modified(row["modified"])
+        if modified is not None and (row["conn"] not in newest or
+                                     modified > newest[row["conn"]][0]):
+            newest[row["conn"]] = (modified, row["modified"])
+    duration = round(time.monotonic() - started, 3)
+    if tombstones:
+        connectors = set(x["conn"] for x in listed.values())
+        # Connectors that offer nothing anymore
+        for connector, state in states.items():
+            if connector not in connectors:
+                Session.delete(state)
+    else:
+        connectors = set(states) | set(newest)
+    for connector in connectors:
+        state = states.get(connector)
+        if state is None:
+            state = BrokerSyncState(connector)
+            Session.add(state)
+        watermark = _parse_modified(state.watermark)
+        if connector in newest and (watermark is None or
+                                    newest[connector][0] > watermark):
+            state.watermark = newest[connector][1]
+        state.synced = now
+        if tombstones:
+            state.listed = now
+        state.rows = stored[connector]
+        state.deleted = deleted[connector]
+        state.duration = duration
+    Session.commit()
+
+    stats = {"listed": len(listed),
+             "changed": len(changed),
+             "stored": sum(stored.values()),
+             "deleted": len(removed),
+             "tombstones": tombstones,
+             "duration": duration}
+    log.info("Broker mirror synced: " + str(stats))
+    return stats
+
+
+def sync_mirror(full: bool = False) -> Optional[Dict]:
+    """
+    Brings the mirror up to date with the broker. Only one sync runs at a
+    time across the workers; if another one is under way, returns None.
+    """
+    try:
+        redis_conn = connect_to_redis()
+        locked = redis_conn.set(MIRROR_SYNC_LOCK_KEY, str(os.getpid()),
+                                nx=True, ex=MIRROR_SYNC_LOCK_TIMEOUT)
+    except Exception as e:
+        log.debug("Could not lock the broker mirror sync: " + str(e))
+        redis_conn = None
+        locked = True
+    if not locked:
+        log.info("Broker mirror sync already running")
+        return None
+    try:
+        return _sync(full)
+    except Exception:
+        Session.rollback()
+        raise
+    finally:
+        if redis_conn is not None:
+            try:
+                redis_conn.delete(MIRROR_SYNC_LOCK_KEY)
+            except Exception as e:
+                log.debug("Could not unlock the broker mirror sync: " + str(e))
+
+
+def sync_mirror_job(full: bool = False):
+    """ Entry point for toolkit.enqueue_job """
+    return sync_mirror(full)
+
+
+def _seconds_since(moment: Optional[datetime.datetime], now):
+    if moment is None:
+        return None
+    return round((now - moment).total_seconds(), 3)
+
+
+def mirror_sync_stats() -> Dict:
+    """
+    To tune the sync interval: per connector, how old the mirror is
+    (sync_lag), how old the newest change seen is (watermark_lag) and the
+    rows, deletions and duration of the last sync.
+    """
+    now = datetime.datetime.utcnow()
+    connectors = {}
+    last_run = {"synced": None, "rows": 0, "deleted": 0, "duration": None}
+    states = Session.query(BrokerSyncState).all()
+    last_synced = max([x.synced for x in states if x.synced is not None],
+                      default=None)
+    for state in states:
+        connectors[state.connector] = {
+            "watermark": state.watermark,
+            "watermark_lag": _seconds_since(
+                _parse_modified(state.watermark), now),
+            "sync_lag": _seconds_since(state.synced, now),
+            "tombstones_lag": _seconds_since(state.listed, now),
+            "rows": state.rows,
+            "deleted": state.deleted,
+            "duration": state.duration
+        }
+        if state.synced is not None and state.synced == last_synced:
+            last_run["rows"] += state.rows or 0
+            last_run["deleted"] += state.deleted or 0
+            last_run["duration"] = state.duration
+    if last_synced is not None:
+        last_run["synced"] = last_synced.isoformat()
+    return {"resources": Session.query(BrokerResource).count(),
+            "sync_lag": _seconds_since(last_synced, now),
+            "last_run": last_run,
+            "connectors": connectors}
+
+
+# -- Search -------------------------------------------------------------------
+
+def _like_pattern(text: str) -> str:
+    return "%" + text.replace("\\", "\\\\").replace("%", "\\%") \
+        .replace("_", "\\_") + "%"
+
+
+def _facet_value(value: str) -> str:
+    value = value.strip()
+    if value.startswith('"') and value.endswith('"') and len(value) > 1:
+        value = value[1:-1]
+    return value
+
+
+def _filtered_resources(resource_type, fts_query, fq, facet_properties):
+    """
+    The mirrored resources matching a search, with the same meaning as
+    sparql_queries.resources_where
+    """
+    query = Session.query(BrokerResource)
+    if resource_type is not None and resource_type != "None":
+        query = query.filter(BrokerResource.assettype ==
+                             sparql_queries.ASSET_TYPE_BASE +
+                             resource_type.capitalize())
+    if fts_query is not None:
+        pattern = _like_pattern(fts_query)
+        query = query.filter(or_(
+            BrokerResource.title.ilike(pattern, escape="\\"),
+            BrokerResource.description.ilike(pattern, escape="\\"),
+            BrokerResource.externalname.ilike(pattern, escape="\\")))
+
+    properties = dict(facet_properties)
+    selected = {}
+    for facet in fq or ():
+        facet_item = facet.split(":", 1)
+        if facet_item[0] in properties and len(facet_item) > 1:
+            selected.setdefault(facet_item[0], []).append(
+                _facet_value(facet_item[1]))
+    for facet_key, values in selected.items():
+        query = query.filter(BrokerResource.uri.in_(
+            Session.query(BrokerResourceFacet.resource_uri).filter(
+                BrokerResourceFacet.property == properties[facet_key],
+                BrokerResourceFacet.value.in_(values))))
+    return query
+
+
+def _facet_counts(resources, facet_properties):
+    """
+    Rows like the ones of sparql_queries.facets_query, for
+    refactor_facets_parsed_response
+    """
+    count = func.count(distinct(BrokerResourceFacet.resource_uri))
+    rows = Session.query(BrokerResourceFacet.property,
+                         BrokerResourceFacet.value, count).filter(
+        BrokerResourceFacet.property.in_([p for _, p in facet_properties]),
+        BrokerResourceFacet.resource_uri.in_(
+            resources.with_entities(BrokerResource.uri))).group_by(
+        BrokerResourceFacet.property, BrokerResourceFacet.value).order_by(
+        BrokerResourceFacet.property, desc(count), BrokerResourceFacet.value)
+    return SparqlResults(["facet_string", "facet_value_string", "facet_count"],
+                         iter(rows.all()))
+
+
+def mirror_package_search(q=None, start_offset=0, limit=None, fq=None,
+                          facet_fields=None):
+    """
+    Same as client.broker_package_search, served from the mirror
+    """
+    search_string = None if q is None or q == "" or q == default_search else q
+    facet_properties = _facet_properties(facet_fields)
+    resources = _filtered_resources(requested_asset_type(fq), search_string,
+                                    fq, facet_properties)
+    page = resources.order_by(BrokerResource.uri) \
+        .offset(int(start_offset or 0)).limit(int(limit or 20)).all()
+    if len(page) == 0:
+        return []
+
+    facets_result = refactor_facets_parsed_response(
+        _facet_counts(resources, facet_properties))
+    response = {}
+    now = datetime.datetime.now().isoformat()
+    response["results"] = [create_moot_ckan_result(x.as_binding(), now)
+                           for x in page]
+    response["facets"] = facets_result
+    response["count"] = resources.count()
+    response["search_facets"] = create_search_facets_object(facets_result)
+    return response
@@ -0,0 +1,157 @@
+"""
+The organizations shown for the resources of other connectors.
+
+The broker knows every connector by its self-description (ids:BaseConnector
+with its title, curator, maintainer and endpoint). They are loaded into a
+registry of host -> organization, reloaded in the background every
+ckanext.ids.broker_provider_registry_ttl seconds, and retried sooner
+(ckanext.ids.broker_provider_registry_retry seconds, doubling) if loading
+fails. All the search hits of a
+provider share the same organization dictionary, which must therefore not be
+modified.
+"""
+import logging
+import threading
+import time
+import uuid
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+from ckan.common import config
+
+from ckanext.ids.dataspaceconnector.connector import get_connector
+from ckanext.ids.metadatabroker import sparql_queries
+
+log = logging.getLogger("ckanext")
+
+_organization_template = {
+    "type": "organization",
+    "description": "",
+    "image_url": "",
+    "created": "2022-02-02T16:32:58.653424",
+    "is_organization": True,
+    "approval_status": "approved",
+    "state": "active"
+}
+
+
+def _host(uri: Optional[str]) -> Optional[str]:
+    if uri is None:
+        return None
+    try:
+        return urlparse(uri).hostname
+    except ValueError:
+        return None
+
+
+def _organization(host: str, connector: Dict = None) -> Dict:
+    connector = connector or {}
+    organization = dict(_organization_template)
+    organization["id"] = str(uuid.uuid5(uuid.NAMESPACE_URL,
+                                        connector.get("conn") or host))
+    organization["name"] = host
+    organization["title"] = connector.get("title") or host
+    organization["description"] = connector.get("description") or ""
+    organization["connector"] = connector.get("conn")
+    organization["curator"] = connector.get("curator")
+    organization["maintainer"] = connector.get("maintainer")
+    return organization
+
+
+class ProviderRegistry:
+
+    def __init__(self):
+        self.ttl = int(config.get("ckanext.ids.broker_provider_registry_ttl",
+                                  3600))
+        self.retry_interval = float(config.get(
+            "ckanext.ids.broker_provider_registry_retry", 30))
+        self.organizations: Dict[str, Dict] = {}
+        self.loaded = None
+        # After a failed load, the next one is tried at retry_at, doubling
+        # the wait with every failure up to the ttl
+        self.failures = 0
+        self.retry_at = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def load(self):
+        results = get_connector().query_broker_results(
+            sparql_queries.connectors_query())
+        organizations = {}
+        for row in results.dicts():
+            organization = None
+            # The resources point to the connector by the host of its
+            # endpoint, sometimes by the one of its URI
+            for host in (_host(row["accessUrl"]), _host(row["conn"])):
+                if host is not None and host not in organizations:
+                    if organization is None:
+                        organization = _organization(host, row)
+                    organizations[host] = organization
+        with self._lock:
+            self.organizations = organizations
+            self.loaded = time.monotonic()
+            self.failures = 0
+            self.retry_at = None
+        log.debug("Provider registry loaded with " +
+                  str(len(organizations)) + " hosts")
+
+    def _refresh(self):
+        try:
+            self.load()
+        except Exception as e:
+            # Don't retry on every hit while the broker is failing, but
+            # neither wait the whole ttl without the organizations
+            with self._lock:
+                self.failures += 1
+                delay = min(self.ttl, self.retry_interval *
+                            2 ** min(self.failures - 1, 32))
+                self.retry_at = time.monotonic() + delay
+            log.error("Loading the provider registry failed, retrying in " +
+                      str(round(delay)) + "s: " + str(e))
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _refresh_if_stale(self):
+        now = time.monotonic()
+        if self.retry_at is not None:
+            if now < self.retry_at:
+                return
+        elif self.loaded is not None and now - self.loaded < self.ttl:
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        # Even the first load happens in the background, the search does not
+        # wait for the broker; the organizations are made up until then
+        threading.Thread(target=self._refresh, name="provider-registry",
+                         daemon=True).start()
+
+    def organization(self, host: str) -> Dict:
+        """
+        The organization of the connector at the given host. Hosts the
+        broker does not describe get one made up from the host name, which
+        is kept as well so that it is shared too.
+        """
+        self._refresh_if_stale()
+        organization = self.organizations.get(host)
+        if organization is None:
+            organization = _organization(host)
+            with self._lock:
+                organization = self.organizations.setdefault(host,
+                                                             organization)
+        return organization
+
+
+_provider_registry = None
+_provider_registry_lock = threading.Lock()
+
+
+def get_provider_registry() -> ProviderRegistry:
+    global _provider_registry
+    if _provider_registry is None:
+        with _provider_registry_lock:
+            if _provider_registry is None:
+                _provider_registry = ProviderRegistry()
+    return _provider_registry
@@ -0,0 +1,126 @@
+"""
+Search hits for the results of the broker that only build what is read.
+
+A moot CKAN result has fields (the resources, the relationships, the
+tags...) that the search listing mostly never looks at. A LazySearchHit is
+the dictionary of the result, but those fields are only built the first
+time they are read. Whatever reads all the values (items(), values(),
+json.dumps...) builds them all first, so it sees a plain dictionary. Copies
+(e.g. the deep copies of the search cache) keep the fields not built yet
+lazy.
+"""
+import copy
+from typing import Callable, Dict
+
+_MISSING = object()
+
+
+class LazySearchHit(dict):
+
+    def __init__(self, data: Dict, lazy: Dict[str, Callable]):
+        """
+        data are the fields already computed, lazy the functions (without
+        arguments) that compute the others
+        """
+        super().__init__(data)
+        self._lazy = {key: factory for key, factory in lazy.items()
+                      if not dict.__contains__(self, key)}
+
+    def __missing__(self, key):
+        # dict.__getitem__ comes here for the fields not built yet
+        factory = self._lazy.pop(key)
+        value = factory()
+        dict.__setitem__(self, key, value)
+        return value
+
+    def _build_all(self):
+        for key in list(self._lazy):
+            self[key]
+
+    def __setitem__(self, key, value):
+        self._lazy.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if self._lazy.pop(key, _MISSING) is _MISSING:
+            dict.__delitem__(self, key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._lazy
+
+    def keys(self):
+        return list(dict.keys(self)) + list(self._lazy)
+
+    def __iter__(self):
+        # Reading a lazy field while iterating moves it to the dictionary
+        return iter(self.keys())
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._lazy)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        if key in self._lazy:
+            self[key]
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        self._build_all()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def items(self):
+        self._build_all()
+        return dict.items(self)
+
+    def values(self):
+        self._build_all()
+        return dict.values(self)
+
+    def copy(self) -> Dict:
+        self._build_all()
+        return dict.copy(self)
+
+    def __eq__(self, other):
+        self._build_all()
+        if isinstance(other, LazySearchHit):
+            other._build_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def _copy_with(self, data: Dict) -> "LazySearchHit":
+        # The factories build new values on every call, so they are shared
+        hit = LazySearchHit(data, {})
+        hit._lazy = dict(self._lazy)
+        return hit
+
+    def __copy__(self):
+        return self._copy_with(dict(dict.items(self)))
+
+    def __deepcopy__(self, memo):
+        hit = self._copy_with({})
+        memo[id(self)] = hit
+        for key, value in dict.items(self):
+            dict.__setitem__(hit, key, copy.deepcopy(value, memo))
+        return hit
+
+    def __reduce__(self):
+        return dict, (self.copy(),)
+
+    def __repr__(self):
+        return "<LazySearchHit id=%s>" % dict.get(self, "id")
@@ -0,0 +1,398 @@
+"""
+The SPARQL queries we send to the broker for searching.
+
+The static parts of the queries are compiled once into templates. Everything
+that comes from the user (the search text, the facet filters, the asset
+type, paging) is bound as an escaped SPARQL term, never spliced in as is.
+Rendered queries are memoized, so the same search costs nothing the second
+time. Nothing here needs CKAN, the facet properties are passed in.
+"""
+import functools
+import re
+from string import Template
+from typing import Optional, Tuple
+
+ASSET_TYPE_PREDICATE = "https://www.trusts-data.eu/ontology/asset_type"
+ASSET_TYPE_BASE = "https://www.trusts-data.eu/ontology/"
+
+# How the search text is matched, see text_pattern() and text_filter()
+TEXT_MODE_REGEX = "regex"
+TEXT_MODE_TEXT_INDEX = "text_index"
+TEXT_MODE_LOCAL_INDEX = "local_index"
+
+_PREFIXES = """
+      PREFIX owl: <http://www.w3.org/2002/07/owl#>
+      PREFIX ids: <https://w3id.org/idsa/core/>
+      PREFIX text: <http://jena.apache.org/text#>
+      PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>"""
+
+_RESOURCES_WHERE = Template("""
+      { $text_pattern
+        ?resultUri a ?type .
+        ?conn <https://w3id.org/idsa/core/offeredResource> ?resultUri .
+        ?resultUri ids:title ?title .
+        ?resultUri ids:description ?description .
+        ?resultUri owl:sameAs ?externalname .
+        OPTIONAL {  ?resultUri ids:standardLicense ?license . }
+        OPTIONAl {  ?resultUri ids:created ?creationDateTemp . }
+        BIND (str(coalesce(?creationDateTemp, "Not Specified")) as ?creationDate)
+        FILTER (!regex(str(?externalname),$local_node,"i"))
+        $facet_filters
+        $type_filter
+        $text_filter
+      }""")
+
+_RESULTS_QUERY = Template(_PREFIXES + """
+      SELECT ?resultUri ?type ?title ?description ?assettype ?externalname ?license ?creationDate
+      WHERE$where LIMIT $limit OFFSET $offset""")
+
+_COUNT_QUERY = Template(_PREFIXES + """
+      SELECT (COUNT(DISTINCT ?resultUri) as ?count)
+      WHERE$where""")
+
+_FACETS_QUERY = Template(_PREFIXES + """
+      SELECT  (count(?resultUri) as ?facet_count) (str(?facet) as ?facet_string) (str(?facet_value) as ?facet_value_string)
+      WHERE
+      { graph ?g
+        {
+            $text_pattern
+            ?conn     ids:offeredResource   ?resultUri .
+            ?resultUri  owl:sameAs            ?externalname .
+            FILTER (!regex(str(?externalname),$local_node,"i"))
+            OPTIONAL { ?resultUri ?facet ?facet_value }
+            OPTIONAL { ?resultUri ids:title ?title }
+            OPTIONAL { ?resultUri ids:description ?description }
+            VALUES ?facet { $facet_properties }
+            $facet_filters
+            $type_filter
+            $text_filter
+        }
+      }
+      group by ?facet ?facet_value
+      order by ?facet DESC(?facet_count) ?facet_value
+    """)
+
+_HARVEST_QUERY = Template(_PREFIXES + """
+      SELECT ?resultUri ?title ?description
+      WHERE
+      { ?conn ids:offeredResource ?resultUri .
+        ?resultUri owl:sameAs ?externalname .
+        OPTIONAL { ?resultUri ids:title ?title . }
+        OPTIONAL { ?resultUri ids:description ?description . }
+        FILTER (!regex(str(?externalname),$local_node,"i"))
+      }""")
+
+_MIRROR_LIST_QUERY = Template(_PREFIXES + """
+      SELECT ?resultUri ?conn ?modified
+      WHERE
+      { ?conn ids:offeredResource ?resultUri .
+        ?resultUri owl:sameAs ?externalname .
+        OPTIONAL { ?resultUri ids:modified ?modified . }
+        FILTER (!regex(str(?externalname),$local_node,"i"))
+      }""")
+
+_MIRROR_DELTA_QUERY = Template(_PREFIXES + """
+      SELECT ?resultUri ?conn ?modified
+      WHERE
+      { ?conn ids:offeredResource ?resultUri .
+        ?resultUri owl:sameAs ?externalname .
+        ?resultUri ids:modified ?modified .
+        FILTER (!regex(str(?externalname),$local_node,"i"))
+        OPTIONAL { VALUES (?conn ?watermark) { $watermarks } }
+        FILTER (!bound(?watermark) || xsd:dateTime(str(?modified)) >= ?watermark)
+      }""")
+
+_MIRROR_RESOURCES_QUERY = Template(_PREFIXES + """
+      SELECT ?resultUri ?conn ?type ?title ?description ?assettype ?externalname ?license ?creationDate ?modified
+      WHERE
+      { VALUES ?resultUri { $resources }
+        ?resultUri a ?type .
+        ?conn ids:offeredResource ?resultUri .
+        ?resultUri ids:title ?title .
+        ?resultUri ids:description ?description .
+        ?resultUri owl:sameAs ?externalname .
+        ?resultUri $type_pred ?assettype .
+        OPTIONAL {  ?resultUri ids:standardLicense ?license . }
+        OPTIONAL {  ?resultUri ids:created ?creationDateTemp . }
+        OPTIONAL {  ?resultUri ids:modified ?modified . }
+        BIND (str(coalesce(?creationDateTemp, "Not Specified")) as ?creationDate)
+      }""")
+
+_MIRROR_FACETS_QUERY = Template(_PREFIXES + """
+      SELECT ?resultUri (str(?facet) as ?facet_string) (str(?facet_value) as ?facet_value_string)
+      WHERE
+      { VALUES ?resultUri { $resources }
+        VALUES ?facet { $facet_properties }
+        ?resultUri ?facet ?facet_value .
+      }""")
+
+_CONNECTORS_QUERY = _PREFIXES + """
+      SELECT ?conn ?title ?description ?curator ?maintainer ?accessUrl
+      WHERE
+      { ?conn a ids:BaseConnector .
+        OPTIONAL { ?conn ids:title ?title . }
+        OPTIONAL { ?conn ids:description ?description . }
+        OPTIONAL { ?conn ids:curator ?curator . }
+        OPTIONAL { ?conn ids:maintainer ?maintainer . }
+        OPTIONAL { ?conn ids:hasDefaultEndpoint ?endpoint .
+                   ?endpoint ids:accessURL ?accessUrl . }
+      }"""
+
+_MODIFIED_QUERY = Template(_PREFIXES + """
+      SELECT ?modified WHERE { $resource ids:modified ?modified . }""")
+
+_TEXT_FILTER = Template(
+    'FILTER regex(concat(?title, " ",?description, " ",str(?externalname)), '
+    '$text, "i")')
+
+_IRI_FORBIDDEN = re.compile(r'[\x00-\x20<>"{}|^`\\]')
+_PREFIXED_NAME = re.compile(r'^[A-Za-z][\w\-.]*:[\w\-.]+$')
+_VARIABLE_NAME = re.compile(r'^\w+$')
+_NUMBER_OR_BOOLEAN = re.compile(
+    r'^([+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?|true|false)$')
+_REGEX_SPECIAL = re.compile(r'([.^$*+?()\[\]{}|\\])')
+_LUCENE_SPECIAL = re.compile(r'([+\-!(){}\[\]^"~*?:\\/&|])')
+_STRING_ESCAPES = {"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r",
+                   "\t": "\\t", "\b": "\\b", "\f": "\\f"}
+
+
+def string_literal(value: str) -> str:
+    return '"' + "".join(_STRING_ESCAPES.get(c, c) for c in value) + '"'
+
+
+def regex_literal(value: str) -> str:
+    """
+    A string literal that matches the given text literally when used as
+    pattern in a SPARQL regex()
+    """
+    return string_literal(_REGEX_SPECIAL.sub(r"\\\1", value))
+
+
+def iri(value: str) -> str:
+    value = value.strip()
+    if value.startswith("<") and value.endswith(">"):
+        value = value[1:-1]
+    if value == "" or _IRI_FORBIDDEN.search(value):
+        raise ValueError("Not a valid IRI: " + value)
+    return "<" + value + ">"
+
+
+def property_term(value: str) -> str:
+    if "://" in value:
+        return iri(value)
+    if _PREFIXED_NAME.match(value):
+        return value
+    raise ValueError("Not a valid property: " + value)
+
+
+def variable(name: str) -> str:
+    if not _VARIABLE_NAME.match(name):
+        raise ValueError("Not a valid variable name: " + name)
+    return "?" + name
+
+
+def facet_value_term(value: str) -> str:
+    """
+    The value of a facet filter as it comes in the fq of CKAN, e.g.
+    theme:"https://..." or TimeFrame:2020
+    """
+    value = value.strip()
+    if value.startswith('"') and value.endswith('"') and len(value) > 1:
+        value = value[1:-1]
+    if "http" in value:
+        return iri(value)
+    if _NUMBER_OR_BOOLEAN.match(value):
+        return value
+    return string_literal(value)
+
+
+def facet_filters(fq: Tuple[str, ...],
+                  facet_properties: Tuple[Tuple[str, str], ...]) -> str:
+    """
+    The triple patterns restricting the results to the selected facet
+    values. Only fq entries for the given facets are taken into account.
+    """
+    properties = dict(facet_properties)
+    selected = {}
+    for facet in fq:
+        facet_item = facet.split(":", 1)
+        facet_key = facet_item[0]
+        if facet_key in properties and len(facet_item) > 1:
+            selected.setdefault(facet_key, []).append(
+                facet_value_term(facet_item[1]))
+    filters = []
+    for facet_key, values in selected.items():
+        var = variable(facet_key)
+        filters.append("?resultUri " + property_term(properties[facet_key]) +
+                       " " + var + ". values " + var + " { " +
+                       " ".join(values) + " }")
+    return "\n        ".join(filters)
+
+
+def type_filter(resource_type: Optional[str],
+                type_pred: str = ASSET_TYPE_PREDICATE) -> str:
+    triple = "?resultUri " + iri(type_pred) + " ?assettype ."
+    if resource_type is None or resource_type == "None":
+        return triple
+    if not _VARIABLE_NAME.match(resource_type):
+        raise ValueError("Not a valid asset type: " + resource_type)
+    return triple + "\n        values ?assettype { " + \
+        iri(ASSET_TYPE_BASE + resource_type.capitalize()) + " } "
+
+
+def lucene_literal(value: str) -> str:
+    """
+    A string literal with the search text as a Lucene query in which every
+    word is required, for Jena's text:query
+    """
+    words = [_LUCENE_SPECIAL.sub(r"\\\1", x) for x in value.split()]
+    return string_literal(" AND ".join(words))
+
+
+def text_pattern(fts_query: Optional[str], text_mode: str = TEXT_MODE_REGEX,
+                 text_matches: Optional[Tuple[str, ...]] = None) -> str:
+    """
+    In the index modes the search text selects the resources up front, so
+    that the broker only has to look at the matches.
+    """
+    if fts_query is None:
+        return ""
+    if text_mode == TEXT_MODE_TEXT_INDEX:
+        return "?resultUri text:query (" + lucene_literal(fts_query) + ") ."
+    if text_mode == TEXT_MODE_LOCAL_INDEX:
+        return "VALUES ?resultUri { " + \
+            " ".join(iri(x) for x in text_matches or ()) + " }"
+    return ""
+
+
+def text_filter(fts_query: Optional[str],
+                text_mode: str = TEXT_MODE_REGEX) -> str:
+    if fts_query is None or text_mode != TEXT_MODE_REGEX:
+        return ""
+    return _TEXT_FILTER.substitute(text=regex_literal(fts_query))
+
+
+def harvest_query(local_node: str) -> str:
+    """
+    Titles and descriptions of all the resources of other connectors, to
+    build the local text index
+    """
+    return _HARVEST_QUERY.substitute(local_node=regex_literal(local_node))
+
+
+@functools.lru_cache(maxsize=512)
+def resources_where(resource_type: Optional[str], fts_query: Optional[str],
+                    fq: Tuple[str, ...],
+                    facet_properties: Tuple[Tuple[str, str], ...],
+                    local_node: str,
+                    type_pred: str = ASSET_TYPE_PREDICATE,
+                    text_mode: str = TEXT_MODE_REGEX,
+                    text_matches: Optional[Tuple[str, ...]] = None) -> str:
+    """
+    The WHERE clause selecting the offered resources of other connectors that
+    match a search. Shared by the results and the count queries, so that
+    both always agree.
+    """
+    return _RESOURCES_WHERE.substitute(
+        text_pattern=text_pattern(fts_query, text_mode, text_matches),
+        local_node=regex_literal(local_node),
+        facet_filters=facet_filters(fq, facet_properties),
+        type_filter=type_filter(resource_type, type_pred),
+        text_filter=text_filter(fts_query, text_mode))
+
+
+@functools.lru_cache(maxsize=512)
+def results_query(resource_type, fts_query, fq, facet_properties, local_node,
+                  limit: int, offset: int,
+                  type_pred: str = ASSET_TYPE_PREDICATE,
+                  text_mode: str = TEXT_MODE_REGEX,
+                  text_matches: Optional[Tuple[str, ...]] = None) -> str:
+    return _RESULTS_QUERY.substitute(
+        where=resources_where(resource_type, fts_query, fq, facet_properties,
+                              local_node, type_pred, text_mode, text_matches),
+        limit=int(limit), offset=int(offset))
+
+
+@functools.lru_cache(maxsize=512)
+def count_query(resource_type, fts_query, fq, facet_properties, local_node,
+                type_pred: str = ASSET_TYPE_PREDICATE,
+                text_mode: str = TEXT_MODE_REGEX,
+                text_matches: Optional[Tuple[str, ...]] = None) -> str:
+    return _COUNT_QUERY.substitute(
+        where=resources_where(resource_type, fts_query, fq, facet_properties,
+                              local_node, type_pred, text_mode, text_matches))
+
+
+@functools.lru_cache(maxsize=512)
+def facets_query(resource_type, fts_query, fq, facet_properties, local_node,
+                 type_pred: str = ASSET_TYPE_PREDICATE,
+                 text_mode: str = TEXT_MODE_REGEX,
+                 text_matches: Optional[Tuple[str, ...]] = None) -> str:
+    """
+    facet_properties are the (field name, property) of all the facets
+    shown; their values are counted and the selected ones filter the hits
+    """
+    return _FACETS_QUERY.substitute(
+        text_pattern=text_pattern(fts_query, text_mode, text_matches),
+        local_node=regex_literal(local_node),
+        facet_properties=" ".join(property_term(p)
+                                  for _, p in facet_properties),
+        facet_filters=facet_filters(fq, facet_properties),
+        type_filter=type_filter(resource_type, type_pred),
+        text_filter=text_filter(fts_query, text_mode))
+
+
+def mirror_list_query(local_node: str) -> str:
+    """
+    The resources of other connectors with their ids:modified, to find out
+    which ones the mirror has to fetch again
+    """
+    return _MIRROR_LIST_QUERY.substitute(local_node=regex_literal(local_node))
+
+
+def mirror_delta_query(local_node: str,
+                       watermarks: Tuple[Tuple[str, str], ...]) -> str:
+    """
+    The resources modified since the watermark of their connector, given as
+    (connector, ids:modified) pairs. Connectors without a watermark are
+    listed completely.
+    """
+    if len(watermarks) == 0:
+        return mirror_list_query(local_node)
+    return _MIRROR_DELTA_QUERY.substitute(
+        local_node=regex_literal(local_node),
+        watermarks=" ".join("(" + iri(conn) + " " + string_literal(modified) +
+                            "^^xsd:dateTime)"
+                            for conn, modified in watermarks))
+
+
+def mirror_resources_query(resources: Tuple[str, ...],
+                           type_pred: str = ASSET_TYPE_PREDICATE) -> str:
+    """
+    Same columns as results_query, for the given resources only
+    """
+    return _MIRROR_RESOURCES_QUERY.substitute(
+        resources=" ".join(iri(x) for x in resources),
+        type_pred=iri(type_pred))
+
+
+def mirror_facets_query(resources: Tuple[str, ...],
+                        facet_properties: Tuple[str, ...]) -> str:
+    return _MIRROR_FACETS_QUERY.substitute(
+        resources=" ".join(iri(x) for x in resources),
+        facet_properties=" ".join(property_term(p) for p in facet_properties))
+
+
+def connectors_query() -> str:
+    """
+    The self-descriptions of the connectors known to the broker
+    """
+    return _CONNECTORS_QUERY
+
+
+def modified_query(resource: str) -> str:
+    """
+    Only the ids:modified of a resource, to revalidate a cached description.
+    Raises ValueError if resource is not a valid IRI.
+    """
+    return _MODIFIED_QUERY.substitute(resource=iri(resource))
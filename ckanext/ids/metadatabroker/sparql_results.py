@@ -0,0 +1,125 @@
+"""
+A small and fast reader for the results of SPARQL SELECT queries, as they
+come back from the broker through the dataspace connector.
+
+rdflib's TSVResultParser runs every line through pyparsing and builds rdflib
+terms for every cell before we can read the first row. We only ever need the
+lexical value of each cell, so here the rows are split by hand and yielded
+one by one as plain tuples of strings (None for unbound variables).
+"""
+import json
+import re
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+_ESCAPES = {"t": "\t", "n": "\n", "r": "\r", "b": "\b", "f": "\f",
+            '"': '"', "'": "'", "\\": "\\"}
+_ESCAPE_RE = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+
+
+def _unescape(match):
+    code = match.group(1)
+    if len(code) > 1:
+        return chr(int(code[1:], 16))
+    return _ESCAPES.get(code, code)
+
+
+def tsv_term_value(term: str) -> Optional[str]:
+    """
+    Lexical value of a term in the SPARQL TSV format: <iri>, "literal",
+    "literal"@lang, "literal"^^<datatype>, _:bnode or a bare number/boolean.
+    """
+    if term == "":
+        return None
+    first = term[0]
+    if first == "<" and term[-1] == ">":
+        return term[1:-1]
+    if first == '"':
+        value = term[1:term.rfind('"')]
+        if "\\" in value:
+            value = _ESCAPE_RE.sub(_unescape, value)
+        return value
+    return term
+
+
+def iter_tsv_rows(lines: Iterable[Union[str, bytes]]) -> \
+        Tuple[List[str], Iterator[Tuple[Optional[str], ...]]]:
+    """
+    Returns the variable names of a TSV result and an iterator over its
+    rows. The lines can be a str, or any iterable of lines as str or bytes
+    (e.g. response.iter_lines()), so nothing needs to be read in advance.
+    """
+    if isinstance(lines, str):
+        lines = iter(lines.split("\n"))
+    else:
+        lines = iter(lines)
+
+    header = ""
+    for header in lines:
+        if isinstance(header, bytes):
+            header = header.decode("utf-8")
+        header = header.strip()
+        if header != "":
+            break
+    variables = [x.strip()[1:] for x in header.split("\t") if x.strip()]
+
+    def rows():
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode("utf-8")
+            line = line.rstrip("\r\n")
+            if line == "":
+                continue
+            yield tuple(tsv_term_value(x) for x in line.split("\t"))
+
+    return variables, rows()
+
+
+def iter_json_rows(text: Union[str, bytes]) -> \
+        Tuple[List[str], Iterator[Tuple[Optional[str], ...]]]:
+    """
+    Same as iter_tsv_rows, for application/sparql-results+json
+    """
+    document = json.loads(text)
+    variables = document.get("head", {}).get("vars", [])
+    bindings = document.get("results", {}).get("bindings", [])
+
+    def rows():
+        for binding in bindings:
+            yield tuple(binding[v]["value"] if v in binding else None
+                        for v in variables)
+
+    return variables, rows()
+
+
+class SparqlResults:
+    """
+    The rows of a SELECT result. They can be read only once, as tuples in
+    the order of `variables`, or as dictionaries keyed by variable name.
+    """
+    __slots__ = ("variables", "_rows")
+
+    def __init__(self, variables: List[str], rows: Iterator[Tuple]):
+        self.variables = variables
+        self._rows = rows
+
+    def index(self, variable: str) -> int:
+        return self.variables.index(variable)
+
+    def __iter__(self):
+        return self._rows
+
+    def dicts(self):
+        variables = self.variables
+        for row in self._rows:
+            yield dict(zip(variables, row))
+
+
+def parse_sparql_results(source, content_type: str = None) -> SparqlResults:
+    if content_type is not None and "json" in content_type:
+        return SparqlResults(*iter_json_rows(source))
+    if isinstance(source, (str, bytes)) and \
+            source.lstrip()[:1] in ("{", b"{"):
+        return SparqlResults(*iter_json_rows(source))
+    if isinstance(source, bytes):
+        source = source.decode("utf-8")
+    return SparqlResults(*iter_tsv_rows(source))
@@ -0,0 +1,176 @@
+"""
+A small inverted index over the titles and descriptions of the resources
+offered in the broker, for the "local_index" search mode.
+
+Instead of making the broker scan every resource with a regex, the words of
+the query are looked up here and the broker is only asked about the
+resources that match.
+"""
+import bisect
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from ckan.common import config
+
+from ckanext.ids.dataspaceconnector.connector import get_connector
+from ckanext.ids.metadatabroker import sparql_queries
+
+log = logging.getLogger("ckanext")
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str):
+    return [x.lower() for x in _TOKEN_RE.findall(text or "")]
+
+
+class InvertedIndex:
+    """
+    token -> resource URIs. The last word of a query also matches as a
+    prefix, so that partially typed words find something.
+    """
+
+    def __init__(self, documents: Iterable[Tuple[str, str]] = ()):
+        postings: Dict[str, Set[str]] = {}
+        document_tokens: Dict[str, Set[str]] = {}
+        for uri, text in documents:
+            tokens = set(tokenize(text))
+            document_tokens.setdefault(uri, set()).update(tokens)
+            for token in tokens:
+                postings.setdefault(token, set()).add(uri)
+        self.postings = postings
+        self.document_tokens = document_tokens
+        self.tokens = sorted(postings)
+
+    def add(self, uri: str, text: str):
+        """ Indexes the text of the resource, replacing its previous one """
+        self.remove(uri)
+        tokens = set(tokenize(text))
+        self.document_tokens[uri] = tokens
+        for token in tokens:
+            if token not in self.postings:
+                self.postings[token] = set()
+                bisect.insort(self.tokens, token)
+            self.postings[token].add(uri)
+
+    def remove(self, uri: str):
+        for token in self.document_tokens.pop(uri, ()):
+            uris = self.postings[token]
+            uris.discard(uri)
+            if len(uris) == 0:
+                del self.postings[token]
+                del self.tokens[bisect.bisect_left(self.tokens, token)]
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def _prefix_matches(self, prefix: str) -> Set[str]:
+        result = set()
+        i = bisect.bisect_left(self.tokens, prefix)
+        while i < len(self.tokens) and self.tokens[i].startswith(prefix):
+            result |= self.postings[self.tokens[i]]
+            i += 1
+        return result
+
+    def search(self, text: str) -> Set[str]:
+        tokens = tokenize(text)
+        if len(tokens) == 0:
+            return set()
+        result = None
+        for i, token in enumerate(tokens):
+            if i == len(tokens) - 1:
+                matches = self._prefix_matches(token)
+            else:
+                matches = self.postings.get(token, set())
+            result = matches if result is None else result & matches
+            if len(result) == 0:
+                break
+        return result
+
+
+class BrokerTextIndex:
+    """
+    Keeps an InvertedIndex of the broker catalog, built and then rebuilt in
+    a background thread every ckanext.ids.broker_text_index_ttl seconds.
+    """
+
+    def __init__(self):
+        self.index: Optional[InvertedIndex] = None
+        self.built = None
+        self.refresh_interval = int(config.get(
+            "ckanext.ids.broker_text_index_ttl", 300))
+        self._lock = threading.Lock()
+        self._refresher_pid = None
+
+    def harvest(self):
+        query = sparql_queries.harvest_query(
+            config.get("ckanext.ids.local_node_name"))
+        documents = []
+        for row in get_connector().query_broker_results(query).dicts():
+            documents.append((row["resultUri"],
+                              " ".join(str(row[x] or "") for x in
+                                       ("title", "description"))))
+        return InvertedIndex(documents)
+
+    def rebuild(self):
+        seen = self.built
+        with self._lock:
+            # Whoever held the lock before may have just rebuilt it
+            if self.built != seen:
+                return
+            started = time.monotonic()
+            index = self.harvest()
+            self.index = index
+            self.built = time.monotonic()
+        log.debug("Broker text index rebuilt with " + str(len(index)) +
+                  " tokens in " + str(round(self.built - started, 3)) + "s")
+
+    def _refresher_loop(self):
+        # The first build happens here too, not in the request of the first
+        # search
+        while True:
+            try:
+                self.rebuild()
+            except Exception as e:
+                log.error("Rebuilding the broker text index failed: " + str(e))
+            time.sleep(self.refresh_interval)
+
+    def search(self, text: str) -> Optional[Set[str]]:
+        """
+        URIs of the broker resources matching the text, or None if there
+        is no index (yet), in which case the caller should fall back to
+        another search mode.
+        """
+        self.start_refresher()
+        index = self.index
+        if index is None:
+            return None
+        return index.search(text)
+
+    def start_refresher(self):
+        # Checking the pid restarts the thread in forked workers
+        if self._refresher_pid == os.getpid():
+            return
+        with _text_index_lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+            threading.Thread(target=self._refresher_loop,
+                             name="broker-text-index", daemon=True).start()
+
+
+_text_index = None
+_text_index_lock = threading.Lock()
+
+
+def get_text_index() -> BrokerTextIndex:
+    global _text_index
+    if _text_index is None:
+        with _text_index_lock:
+            if _text_index is None:
+                _text_index = BrokerTextIndex()
+    return _text_index
@@ -5,6 +5,7 @@ from sqlalchemy import Table
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
 from sqlalchemy import types
+from sqlalchemy import Index
 from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.orm import relation
 
@@ -17,13 +18,25 @@ __all__ = [
     'IdsAgreement', 'ids_agreement_table',
     'IdsResource', 'ids_resource_table',
     'IdsSubscription', 'ids_subscription_table',
-    'WorkflowExecution', 'dbx_workflow_execution_table'
+    'WorkflowExecution', 'dbx_workflow_execution_table',
+    'BrokerResource', 'ids_broker_resource_table',
+    'BrokerResourceFacet', 'ids_broker_resource_facet_table',
+    'BrokerSyncState', 'ids_broker_sync_state_table',
+    'PushJob', 'ids_push_job_table',
+    'SyncRecord', 'ids_sync_record_table',
+    'BrokerPublication', 'ids_broker_publication_table'
 ]
 
 ids_agreement_table = None
 ids_resource_table = None
 ids_subscription_table = None
 dbx_workflow_execution_table = None
+ids_broker_resource_table = None
+ids_broker_resource_facet_table = None
+ids_broker_sync_state_table = None
+ids_push_job_table = None
+ids_sync_record_table = None
+ids_broker_publication_table = None
 
 
 def setup():
@@ -56,6 +69,23 @@ def setup():
         # Check if existing tables need to be updated
         inspector = Inspector.from_engine(engine)
 
+    if not ids_broker_resource_table.exists():
+        ids_broker_resource_table.create()
+        ids_broker_resource_facet_table.create()
+        log.debug("IDS broker mirror tables added.")
+    if not ids_broker_sync_state_table.exists():
+        ids_broker_sync_state_table.create()
+        log.debug("IDS broker sync state table added.")
+    if not ids_push_job_table.exists():
+        ids_push_job_table.create()
+        log.debug("IDS push job table added.")
+    if not ids_sync_record_table.exists():
+        ids_sync_record_table.create()
+        log.debug("IDS sync record table added.")
+    if not ids_broker_publication_table.exists():
+        ids_broker_publication_table.create()
+        log.debug("IDS broker publication table added.")
+
 
 class IdsDomainObject(DomainObject):
     '''Convenience methods for searching objects
@@ -172,6 +202,154 @@ class WorkflowExecution(IdsDomainObject):
         self.agreement_id = agreement.id
 
 
+class BrokerResource(IdsDomainObject):
+    '''A resource offered in the broker by another connector, as kept in the
+    local mirror of the broker catalog
+    '''
+    key_attr = 'uri'
+
+    def __repr__(self):
+        return '<BrokerResource uri=%s connector=%s>' % \
+            (self.uri, self.connector)
+
+    def __str__(self):
+        return self.__repr__().encode('ascii', 'ignore')
+
+    def __init__(self, uri=None, connector=None):
+        self.uri = uri
+        self.connector = connector
+
+    def as_binding(self):
+        """ the same shape as a row of the broker search query """
+        return {
+            "resultUri": self.uri,
+            "type": self.type,
+            "title": self.title,
+            "description": self.description,
+            "assettype": self.assettype,
+            "externalname": self.externalname,
+            "license": self.license,
+            "creationDate": self.creation_date
+        }
+
+
+class BrokerResourceFacet(IdsDomainObject):
+    '''A value of a facet property of a mirrored broker resource
+    '''
+    def __repr__(self):
+        return '<BrokerResourceFacet resource_uri=%s property=%s value=%s>' % \
+            (self.resource_uri, self.property, self.value)
+
+    def __str__(self):
+        return self.__repr__().encode('ascii', 'ignore')
+
+    def __init__(self, resource_uri=None, property=None, value=None):
+        self.resource_uri = resource_uri
+        self.property = property
+        self.value = value
+
+
+class BrokerSyncState(IdsDomainObject):
+    '''How far the mirror is synced with the resources of a connector: the
+    newest ids:modified seen (the watermark) and the figures of the last sync
+    '''
+    key_attr = 'connector'
+
+    def __repr__(self):
+        return '<BrokerSyncState connector=%s watermark=%s>' % \
+            (self.connector, self.watermark)
+
+    def __str__(self):
+        return self.__repr__().encode('ascii', 'ignore')
+
+    def __init__(self, connector=None):
+        self.connector = connector
+
+
+class PushJob(IdsDomainObject):
+    '''A push of a package to the local dataspace connector and the broker,
+    run as a background job
+    '''
+    def __repr__(self):
+        return '<PushJob id=%s package_id=%s status=%s>' % \
+            (self.id, self.package_id, self.status)
+
+    def __str__(self):
+        return self.__repr__().encode('ascii', 'ignore')
+
+    def __init__(self, id=None, package_id=None, user=None):
+        self.id = id
+        self.package_id = package_id
+        self.user_name = user
+
+    def as_dict(self):
+        def isoformat(value):
+            return value.isoformat() if value is not None else None
+        return {
+            "id": self.id,
+            "job_id": self.job_id,
+            "package_id": self.package_id,
+            "user": self.user_name,
+            "status": self.status,
+            "stage": self.stage,
+            "resources_total": self.resources_total,
+            "resources_done": self.resources_done,
+            "pushed": self.pushed,
+            "message": self.message,
+            "created": isoformat(self.created),
+            "started": isoformat(self.started),
+            "finished": isoformat(self.finished)
+        }
+
+
+class SyncRecord(IdsDomainObject):
+    '''What was last pushed of a package to the local dataspace connector and
+    to the broker, as hashes of the content of each object
+    '''
+    key_attr = 'package_id'
+
+    def __repr__(self):
+        return '<SyncRecord package_id=%s offer_iri=%s>' % \
+            (self.package_id, self.offer_iri)
+
+    def __str__(self):
+        return self.__repr__().encode('ascii', 'ignore')
+
+    def __init__(self, package_id=None):
+        self.package_id = package_id
+
+
+class BrokerPublication(IdsDomainObject):
+    '''An offer that the broker did not accept yet, retried later. After too
+    many attempts it stays here as dead
+    '''
+    key_attr = 'resource_uri'
+
+    def __repr__(self):
+        return '<BrokerPublication resource_uri=%s status=%s attempts=%s>' % \
+            (self.resource_uri, self.status, self.attempts)
+
+    def __str__(self):
+        return self.__repr__().encode('ascii', 'ignore')
+
+    def __init__(self, resource_uri=None, package_id=None):
+        self.resource_uri = resource_uri
+        self.package_id = package_id
+
+    def as_dict(self):
+        def isoformat(value):
+            return value.isoformat() if value is not None else None
+        return {
+            "resource_uri": self.resource_uri,
+            "package_id": self.package_id,
+            "status": self.status,
+            "attempts": self.attempts,
+            "next_attempt": isoformat(self.next_attempt),
+            "last_error": self.last_error,
+            "created": isoformat(self.created),
+            "updated": isoformat(self.updated)
+        }
+
 
 def define_ids_tables():
 
@@ -179,6 +357,12 @@ def define_ids_tables():
     global ids_resource_table
     global ids_subscription_table
     global dbx_workflow_execution_table
+    global ids_broker_resource_table
+    global ids_broker_resource_facet_table
+    global ids_broker_sync_state_table
+    global ids_push_job_table
+    global ids_sync_record_table
+    global ids_broker_publication_table
 
     ids_resource_table = Table(
         'ids_resource',
@@ -212,6 +396,98 @@ def define_ids_tables():
         Column('created', types.DateTime, default=datetime.datetime.utcnow)
     )
 
+    ids_broker_resource_table = Table(
+        'ids_broker_resource',
+        metadata,
+        Column('uri', types.UnicodeText, primary_key=True),
+        Column('connector', types.UnicodeText, index=True),
+        Column('type', types.UnicodeText),
+        Column('title', types.UnicodeText),
+        Column('description', types.UnicodeText),
+        Column('assettype', types.UnicodeText, index=True),
+        Column('externalname', types.UnicodeText),
+        Column('license', types.UnicodeText),
+        Column('creation_date', types.UnicodeText),
+        Column('modified', types.UnicodeText),
+        Column('synced', types.DateTime, default=datetime.datetime.utcnow)
+    )
+
+    ids_broker_resource_facet_table = Table(
+        'ids_broker_resource_facet',
+        metadata,
+        Column('id', types.Integer, primary_key=True, autoincrement=True),
+        Column('resource_uri', types.UnicodeText,
+               ForeignKey('ids_broker_resource.uri', ondelete='CASCADE'),
+               index=True),
+        Column('property', types.UnicodeText),
+        Column('value', types.UnicodeText),
+        Index('idx_ids_broker_resource_facet_value', 'property', 'value')
+    )
+
+    ids_broker_sync_state_table = Table(
+        'ids_broker_sync_state',
+        metadata,
+        Column('connector', types.UnicodeText, primary_key=True),
+        Column('watermark', types.UnicodeText),
+        # last sync, and last sync that also looked for deleted resources
+        Column('synced', types.DateTime),
+        Column('listed', types.DateTime),
+        Column('rows', types.Integer, default=0),
+        Column('deleted', types.Integer, default=0),
+        Column('duration', types.Float, default=0)
+    )
+
+    ids_push_job_table = Table(
+        'ids_push_job',
+        metadata,
+        Column('id', types.UnicodeText, primary_key=True),
+        # id of the RQ job
+        Column('job_id', types.UnicodeText),
+        Column('package_id', types.UnicodeText, index=True),
+        Column('user_name', types.UnicodeText),
+        # queued, running, finished or failed
+        Column('status', types.UnicodeText, default=u'queued'),
+        Column('stage', types.UnicodeText),
+        Column('resources_total', types.Integer, default=0),
+        Column('resources_done', types.Integer, default=0),
+        Column('pushed', types.Boolean),
+        Column('message', types.UnicodeText),
+        Column('created', types.DateTime, default=datetime.datetime.utcnow),
+        Column('started', types.DateTime),
+        Column('finished', types.DateTime)
+    )
+
+    ids_sync_record_table = Table(
+        'ids_sync_record',
+        metadata,
+        Column('package_id', types.UnicodeText, primary_key=True),
+        Column('offer_iri', types.UnicodeText),
+        Column('offer_hash', types.UnicodeText),
+        # JSON, resource id -> IRIs and hashes of its representation and
+        # artifact
+        Column('resource_hashes', types.UnicodeText),
+        # None until the offer is announced to the broker
+        Column('broker_hash', types.UnicodeText),
+        Column('synced', types.DateTime),
+        Column('announced', types.DateTime)
+    )
+
+    ids_broker_publication_table = Table(
+        'ids_broker_publication',
+        metadata,
+        Column('resource_uri', types.UnicodeText, primary_key=True),
+        Column('package_id', types.UnicodeText),
+        # to mark the sync record of the package once it is accepted
+        Column('broker_hash', types.UnicodeText),
+        # pending or dead
+        Column('status', types.UnicodeText, default=u'pending'),
+        Column('attempts', types.Integer, default=0),
+        Column('next_attempt', types.DateTime, index=True),
+        Column('last_error', types.UnicodeText),
+        Column('created', types.DateTime, default=datetime.datetime.utcnow),
+        Column('updated', types.DateTime, default=datetime.datetime.utcnow)
+    )
+
     mapper(
         IdsResource,
         ids_resource_table,
@@ -245,4 +521,28 @@ def define_ids_tables():
 
     mapper(WorkflowExecution,
            dbx_workflow_execution_table,
-           )
\ No newline at end of file
+           )
+
+    mapper(BrokerResource,
+           ids_broker_resource_table,
+           )
+
+    mapper(BrokerResourceFacet,
+           ids_broker_resource_facet_table,
+           )
+
+    mapper(BrokerSyncState,
+           ids_broker_sync_state_table,
+           )
+
+    mapper(PushJob,
+           ids_push_job_table,
+           )
+
+    mapper(SyncRecord,
+           ids_sync_record_table,
+           )
+
+    mapper(BrokerPublication,
+           ids_broker_publication_table,
+           )
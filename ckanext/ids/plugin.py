@@ -9,9 +9,11 @@ from ckan.common import config
 import ckan.model as model
 from ckan.lib.plugins import DefaultTranslation
 import ckanext.ids.blueprints as blueprints
+import ckanext.ids.cli as cli
 import ckanext.ids.swagger as swagger
 import ckanext.ids.validator as validator
 from ckanext.ids.metadatabroker.client import broker_package_search, strip_scheme
+from ckanext.ids.metadatabroker.mirror import mirror_enabled, mirror_populated, mirror_package_search
 from collections import OrderedDict, Counter
 from typing import Any
 
@@ -27,8 +29,8 @@ from ckanext.ids.recomm.recomm import recomm_recomm_services_sidebar
 #dtheiler end
 
 from ckanext.ids.helpers import check_if_contract_offer_exists, has_more_facets, get_facet_items_dict, string_to_json
-from ckanext.scheming.helpers import scheming_get_schema, scheming_field_by_name
-from ckanext.vocabularies.helpers import skos_choices_sparql_helper, skos_choices_get_label_by_value
+from ckanext.ids.schema_index import get_schema_index, reset_schema_indexes
+from ckanext.ids.vocabulary_labels import vocabulary_labels
 
 ## Take a look in https://github.com/ckan/ckan/issues/5865 and https://github.com/ckan/ckan/blob/master/ckanext/activity/logic/validators.py
 #from ckan.logic import validators as core_validators
@@ -261,6 +263,17 @@ class IdsResourcesPlugin(plugins.SingletonPlugin):
     def get_blueprint(self):
         return [blueprints.ids, swagger.swaggerui_blueprint]
 
+    plugins.implements(plugins.IConfigurable)
+
+    def configure(self, config_):
+        # The schemas are (re)loaded with the configuration
+        reset_schema_indexes()
+
+    plugins.implements(plugins.IClick)
+
+    def get_commands(self):
+        return cli.get_commands()
+
     plugins.implements(plugins.IFacets, inherit=True)
 
     # Here we define the facets fields that will be added when a package search is triggered.
@@ -337,11 +350,16 @@ class IdsResourcesPlugin(plugins.SingletonPlugin):
 
         fq = tuple(fqset)
 
-        results_from_broker = broker_package_search(q=search_query,
-                                                    fq=fq,
-                                                    start_offset=start,
-                                                    limit=limit,
-                                                    facet_fields=search_params.get("facet.field", None))
+        # With the local mirror the broker is not queried at all
+        if mirror_enabled() and mirror_populated():
+            package_search = mirror_package_search
+        else:
+            package_search = broker_package_search
+        results_from_broker = package_search(q=search_query,
+                                             fq=fq,
+                                             start_offset=start,
+                                             limit=limit,
+                                             facet_fields=search_params.get("facet.field", None))
 
         # log.debug(".\n\n\n---BROKER SEARCH RESULTS ARE   ")
         # log.debug(json.dumps([x["name"] for x in  results_from_broker],
@@ -373,17 +391,16 @@ class IdsResourcesPlugin(plugins.SingletonPlugin):
         return solr_results
 
     def retrieve_facet_labels(self, results: dict):
-        dataset_schema = scheming_get_schema("dataset", "dataset", True)
+        schema_index = get_schema_index("dataset")
         for facet_key in results:
             if facet_key == "license_id":
                 results["license_id"] = self.retrieve_facet_license_labels(results)["license_id"]
             else:
-                schema_field = scheming_field_by_name(dataset_schema["dataset_fields"], facet_key)
+                schema_field = schema_index.field_by_name(facet_key)
                 if schema_field["choices_helper"] == "skos_vocabulary_helper":
-                    skos_choices = skos_choices_sparql_helper(schema_field)
-                    for facet_item_index, facet_item in enumerate(results[facet_key]["items"]):
-                        display_name = skos_choices_get_label_by_value(skos_choices, facet_item["name"])
-                        results[facet_key]["items"][facet_item_index]["display_name"] = display_name
+                    labels = vocabulary_labels(schema_field)
+                    for facet_item in results[facet_key]["items"]:
+                        facet_item["display_name"] = labels.get(facet_item["name"], facet_item["name"])
 
         return results
 
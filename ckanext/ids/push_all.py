@@ -0,0 +1,227 @@
+"""
+Pushing every package with an offer to the dataspace connector again.
+
+After the dataspace connector lost its data or the broker its index, every
+offer has to be pushed again. push_all() streams the ids of the packages
+with an offer from the database and pushes them on
+ckanext.ids.push_all_concurrency threads. The broker is only told at the
+end, after a single announce of this connector, instead of once per
+package in the middle of the pushes.
+
+The packages are pushed in the order of their ids, and the last id up to
+which all of them are done is saved in the CKAN Redis as the checkpoint: an
+interrupted run continues from there with resume. It is run with
+`ckan ids push-all` or as a background job with push_all_job.
+"""
+import datetime
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Iterator, Optional
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+from ckan.common import config
+from ckan.lib.redis import connect_to_redis
+from flask import current_app
+
+from ckanext.ids.blueprints import push_to_dataspace_connector
+from ckanext.ids.dataspaceconnector.connector import get_connector
+from ckanext.ids.broker_publication import publish_to_broker
+
+log = logging.getLogger("ckanext")
+
+PUSH_ALL_CHECKPOINT_KEY = "ckanext-ids:push_all_checkpoint"
+PUSH_ALL_LOCK_KEY = "ckanext-ids:push_all_lock"
+
+
+def _concurrency() -> int:
+    return int(config.get("ckanext.ids.push_all_concurrency", 4))
+
+
+def _lock_timeout() -> int:
+    return int(config.get("ckanext.ids.push_all_timeout", 4 * 3600))
+
+
+def packages_with_offers(after: Optional[str] = None,
+                         chunk_size: int = 100) -> Iterator[str]:
+    """ Ids of the active packages with an offer IRI, in order """
+    query = model.Session.query(model.Package.id) \
+        .join(model.PackageExtra,
+              model.PackageExtra.package_id == model.Package.id) \
+        .filter(model.Package.state == u"active",
+                model.PackageExtra.key == u"offer_iri",
+                model.PackageExtra.value != u"") \
+        .order_by(model.Package.id)
+    if after is not None:
+        query = query.filter(model.Package.id > after)
+    for (package_id,) in query.execution_options(stream_results=True) \
+            .yield_per(chunk_size):
+        yield package_id
+
+
+def _load_checkpoint(redis_conn) -> Optional[Dict]:
+    checkpoint = redis_conn.get(PUSH_ALL_CHECKPOINT_KEY)
+    return json.loads(checkpoint) if checkpoint is not None else None
+
+
+def _save_checkpoint(redis_conn, checkpoint: Dict):
+    redis_conn.set(PUSH_ALL_CHECKPOINT_KEY, json.dumps(checkpoint))
+
+
+def _push_one(app, package_id: str, user: str, force: bool) -> Dict:
+    # Each thread has its own database session, and needs its own context
+    # for the actions
+    with app.test_request_context():
+        try:
+            context = {'model': model, 'session': model.Session,
+                       'user': user, 'ignore_auth': True}
+            data = toolkit.get_action("package_show")(context,
+                                                      {"id": package_id})
+            return push_to_dataspace_connector(data, user, force=force,
+                                               announce=False)
+        finally:
+            model.Session.remove()
+
+
+def _announce_one(package_id: str, announce: Dict) -> bool:
+    try:
+        # The rejected ones are retried in the background
+        return publish_to_broker(announce["offer_iri"], package_id,
+                                 announce["broker_hash"])
+    except Exception as e:
+        log.error("Sending the offer of package " + package_id +
+                  " to the broker failed: " + str(e))
+        return False
+    finally:
+        model.Session.remove()
+
+
+def _push_all(redis_conn, force: bool, resume: bool,
+              concurrency: int) -> Dict:
+    start = time.monotonic()
+    checkpoint = _load_checkpoint(redis_conn) if resume else None
+    if checkpoint is None:
+        checkpoint = {"after": None, "force": force, "pushed": 0,
+                      "failed": 0, "announced": 0,
+                      "started": datetime.datetime.utcnow().isoformat()}
+    else:
+        force = checkpoint["force"]
+        log.info("Resuming the push of all packages after " +
+                 str(checkpoint["after"]))
+    user = toolkit.get_action("get_site_user")({"ignore_auth": True},
+                                               {})["name"]
+    app = current_app._get_current_object()
+
+    # Packages in the order they were submitted, and those that are done, to
+    # know up to where all of them are
+    submitted = deque()
+    done = set()
+    failures = {}
+    announcements = {}
+    # pushed in this run, for the throughput
+    completed = 0
+    executor = ThreadPoolExecutor(max_workers=concurrency,
+                                  thread_name_prefix="push-all")
+    futures = {}
+
+    def collect(finished):
+        nonlocal completed
+        for future in finished:
+            package_id = futures.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"pushed": False, "message": str(e)}
+            if result.get("announce") is not None:
+                announcements[package_id] = result["announce"]
+            if result.get("pushed"):
+                checkpoint["pushed"] += 1
+            else:
+                checkpoint["failed"] += 1
+                failures[package_id] = result["message"]
+                log.error("Pushing package " + package_id + " failed: " +
+                          result["message"])
+            done.add(package_id)
+            completed += 1
+        after = None
+        while submitted and submitted[0] in done:
+            after = submitted.popleft()
+            done.discard(after)
+        if after is not None:
+            checkpoint["after"] = after
+            _save_checkpoint(redis_conn, checkpoint)
+
+    try:
+        for package_id in packages_with_offers(checkpoint["after"]):
+            # Don't read the ids much faster than they are pushed
+            if len(futures) >= 2 * concurrency:
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                collect(finished)
+            submitted.append(package_id)
+            futures[executor.submit(_push_one, app, package_id, user,
+                                    force)] = package_id
+        while futures:
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            collect(finished)
+    finally:
+        executor.shutdown(wait=True)
+    push_duration = time.monotonic() - start
+
+    # The announcements of the packages pushed before resuming are lost,
+    # their offers are sent to the broker on their next push
+    not_announced = 0
+    if announcements:
+        connector = get_connector()
+        connector.announce_to_broker()
+        with ThreadPoolExecutor(max_workers=concurrency,
+                                thread_name_prefix="push-all") as announcer:
+            results = list(announcer.map(_announce_one, announcements.keys(),
+                                         announcements.values()))
+        checkpoint["announced"] += sum(results)
+        not_announced = len(results) - sum(results)
+        for package_id, announced in zip(announcements, results):
+            if not announced:
+                failures[package_id] = "The broker rejected the offer, " \
+                                       "it is retried in the background"
+
+    duration = time.monotonic() - start
+    stats = {"pushed": checkpoint["pushed"],
+             "failed": checkpoint["failed"],
+             "announced": checkpoint["announced"],
+             "not_announced": not_announced,
+             "duration": round(duration, 3),
+             "push_duration": round(push_duration, 3),
+             "packages_per_second": round(completed / push_duration, 3)
+             if push_duration > 0 else None,
+             "failures": failures}
+    redis_conn.delete(PUSH_ALL_CHECKPOINT_KEY)
+    log.info("Pushed all packages: " +
+             json.dumps({k: v for k, v in stats.items() if k != "failures"}))
+    return stats
+
+
+def push_all(force: bool = False, resume: bool = False,
+             concurrency: Optional[int] = None) -> Optional[Dict]:
+    """
+    Pushes every package with an offer. Only one run at a time across the
+    workers; if another one is under way, returns None.
+    """
+    redis_conn = connect_to_redis()
+    if not redis_conn.set(PUSH_ALL_LOCK_KEY, str(os.getpid()), nx=True,
+                          ex=_lock_timeout()):
+        log.info("Push of all packages already running")
+        return None
+    try:
+        return _push_all(redis_conn, force, resume,
+                         concurrency or _concurrency())
+    finally:
+        redis_conn.delete(PUSH_ALL_LOCK_KEY)
+
+
+def push_all_job(force: bool = False, resume: bool = False):
+    """ Entry point for toolkit.enqueue_job """
+    return push_all(force, resume)
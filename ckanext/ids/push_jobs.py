@@ -0,0 +1,80 @@
+"""
+The status of the pushes of packages to the dataspace connector.
+
+A push creates and links several objects in the local dataspace connector for
+every resource and then announces the offer to the broker, which takes far
+too long to hold a web worker. With ckanext.ids.push_in_background (and a
+`ckan jobs worker` running) push_package only records a PushJob and
+enqueues the push as a background job; the job updates the record as it
+goes, and the UI polls /ids/actions/push_status/<id> for it.
+"""
+import datetime
+import logging
+from typing import Dict, Optional
+
+import ckan.model as model
+
+from ckanext.ids.model import PushJob
+
+log = logging.getLogger("ckanext")
+
+QUEUED = u"queued"
+RUNNING = u"running"
+FINISHED = u"finished"
+FAILED = u"failed"
+
+
+def create_push_job(push_id: str, package_id: str, user: str) -> PushJob:
+    push_job = PushJob(push_id, package_id, user)
+    push_job.status = QUEUED
+    push_job.resources_total = 0
+    push_job.resources_done = 0
+    model.Session.add(push_job)
+    model.Session.commit()
+    return push_job
+
+
+def update_push_job(push_id: Optional[str], **fields):
+    """
+    Sets the given columns of the push job and commits them at once, so that
+    they can be seen while the job goes on. Does nothing for pushes that
+    are not run as a job (push_id None)
+    """
+    if push_id is None:
+        return
+    push_job = PushJob.get(push_id)
+    if push_job is None:
+        log.warning("Push job " + push_id + " not found")
+        return
+    for name, value in fields.items():
+        setattr(push_job, name, value)
+    model.Session.commit()
+
+
+def start_push_job(push_id: Optional[str]):
+    update_push_job(push_id, status=RUNNING, stage=u"offer",
+                    started=datetime.datetime.utcnow())
+
+
+def finish_push_job(push_id: Optional[str], result: Dict):
+    update_push_job(push_id, status=FINISHED, stage=None,
+                    pushed=result["pushed"], message=result["message"],
+                    finished=datetime.datetime.utcnow())
+
+
+def fail_push_job(push_id: Optional[str], message: str):
+    # Whatever the push left in the session must not be committed with this
+    model.Session.rollback()
+    update_push_job(push_id, status=FAILED, pushed=False, message=message,
+                    finished=datetime.datetime.utcnow())
+
+
+def push_job_status(push_id: str) -> Optional[Dict]:
+    push_job = PushJob.get(push_id)
+    return push_job.as_dict() if push_job is not None else None
+
+
+def latest_push_job_status(package_id: str) -> Optional[Dict]:
+    push_job = PushJob.filter(package_id=package_id) \
+        .order_by(PushJob.created.desc()).first()
+    return push_job.as_dict() if push_job is not None else None
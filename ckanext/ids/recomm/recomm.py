@@ -1,4 +1,4 @@
-from ckanext.ids.dataspaceconnector.connector import Connector
+from ckanext.ids.dataspaceconnector.connector import get_connector
 from ckanext.ids.metadatabroker.client import graphs_to_ckan_result_format
 
 import ckan.plugins as plugins
@@ -438,7 +438,7 @@ def recomm_store_view_interaction(
 def recomm_retrieve_entity(
     entityId: str):
     
-    local_connector = Connector()
+    local_connector = get_connector()
     
     try:
         entityGraphs = local_connector.ask_broker_for_description(element_uri=entityId)
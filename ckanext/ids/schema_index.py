@@ -0,0 +1,80 @@
+"""
+Lookups into the scheming schemas of the asset types.
+
+scheming_field_by_name and friends scan the list of fields of the schema on
+every call. The broker search does that for every facet and every row, so
+the fields are indexed here once per asset type. The indexes are built
+again with reset_schema_indexes() when the configuration (and so the
+schemas) is loaded.
+"""
+import logging
+import threading
+from typing import Dict, Optional
+
+from ckanext.scheming.helpers import scheming_get_schema
+
+log = logging.getLogger("ckanext")
+
+# Fields of a package that are not copied from the description of a broker
+# resource, see graphs_to_ckan_result_format
+EXCLUDED_FIELDS = frozenset([
+    'id',
+    'title',
+    'name',
+    'notes',
+    'tag_string',
+    'license_id',
+    'owner_org',
+])
+
+
+class SchemaIndex:
+
+    def __init__(self, schema: Dict):
+        self.schema = schema
+        fields = schema.get("dataset_fields", [])
+        self.by_name = {}
+        self.by_display_property = {}
+        for field in fields:
+            self.by_name.setdefault(field["field_name"], field)
+            # The first field with the property wins, as in a linear scan
+            if field.get("display_property") is not None:
+                self.by_display_property.setdefault(field["display_property"],
+                                                    field)
+        self.copied_fields = tuple(x["field_name"] for x in fields
+                                   if x["field_name"] not in EXCLUDED_FIELDS)
+
+    def field_by_name(self, field_name: str) -> Optional[Dict]:
+        return self.by_name.get(field_name)
+
+    def field_by_display_property(self, display_property: str) \
+            -> Optional[Dict]:
+        return self.by_display_property.get(display_property)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_schema_index(asset_type: str = "dataset") -> SchemaIndex:
+    index = _indexes.get(asset_type)
+    if index is None:
+        schema = scheming_get_schema("dataset", asset_type, True)
+        if schema is None:
+            # Not known (yet), don't remember that
+            return SchemaIndex({})
+        index = SchemaIndex(schema)
+        with _indexes_lock:
+            _indexes[asset_type] = index
+    return index
+
+
+def reset_schema_indexes(asset_types=("dataset", "service", "application")):
+    """
+    Drops the indexes and builds them again for the given asset types
+    """
+    with _indexes_lock:
+        _indexes.clear()
+    for asset_type in asset_types:
+        get_schema_index(asset_type)
+    log.debug("Schema indexes built for " + ", ".join(_indexes.keys()))
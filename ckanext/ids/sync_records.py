@@ -0,0 +1,93 @@
+"""
+What was last pushed of each package, to push only what changed.
+
+A push used to send the offer, every representation and every artifact
+again, link them again and announce the offer to the broker, even if the
+package had not changed since the last time. The SyncRecord of a package
+keeps a hash of the content sent for each of those objects, so that the
+ones with the same content (and IRI) are left alone, and the broker is only
+told again when what it shows of the offer changed.
+"""
+import datetime
+import hashlib
+import json
+import logging
+from typing import Dict, Optional
+
+import ckan.model as model
+
+from ckanext.ids.model import SyncRecord
+
+log = logging.getLogger("ckanext")
+
+
+def content_hash(content) -> str:
+    return hashlib.sha1(json.dumps(content, sort_keys=True,
+                                   default=str).encode("utf-8")).hexdigest()
+
+
+class PackageSync:
+    """
+    The record of the last push of a package, as read before a new one.
+    With force all of it is ignored and everything is pushed again.
+    """
+
+    def __init__(self, package_id: str, force: bool = False):
+        self.package_id = package_id
+        record = None if force else SyncRecord.get(package_id)
+        self.offer_iri = record.offer_iri if record else None
+        self.offer_hash = record.offer_hash if record else None
+        self.broker_hash = record.broker_hash if record else None
+        self.resource_hashes = json.loads(record.resource_hashes) \
+            if record and record.resource_hashes else {}
+
+    def offer_unchanged(self, offer_iri: Optional[str],
+                        offer_hash: str) -> bool:
+        return offer_iri is not None and offer_iri == self.offer_iri and \
+            offer_hash == self.offer_hash
+
+    def resource_synced(self, offer_iri: Optional[str],
+                        resource_id: Optional[str]) -> Dict:
+        """
+        IRIs and hashes of what was pushed of the resource, only if it was
+        linked to the same offer
+        """
+        if resource_id is None or offer_iri is None or \
+                offer_iri != self.offer_iri:
+            return {}
+        return self.resource_hashes.get(resource_id, {})
+
+    def broker_unchanged(self, broker_hash: str) -> bool:
+        return broker_hash == self.broker_hash
+
+
+def store_sync_record(package_id: str, offer_iri: str, offer_hash: str,
+                      resource_hashes: Dict, broker_hash: Optional[str],
+                      announced: bool = False):
+    """
+    broker_hash is the one of what the broker knows of the offer, None if
+    it does not know it (yet)
+    """
+    record = SyncRecord.get(package_id)
+    if record is None:
+        record = SyncRecord(package_id)
+        model.Session.add(record)
+    now = datetime.datetime.utcnow()
+    if announced:
+        record.announced = now
+    record.offer_iri = offer_iri
+    record.offer_hash = offer_hash
+    record.resource_hashes = json.dumps(resource_hashes)
+    record.broker_hash = broker_hash
+    record.synced = now
+    model.Session.commit()
+
+
+def mark_announced(package_id: str, broker_hash: str):
+    """ The offer of the package was sent to the broker after its push """
+    record = SyncRecord.get(package_id)
+    if record is None:
+        return
+    record.broker_hash = broker_hash
+    record.announced = datetime.datetime.utcnow()
+    model.Session.commit()
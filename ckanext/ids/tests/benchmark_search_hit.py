@@ -0,0 +1,118 @@
+"""
+Compares building the moot CKAN results of a page of broker hits the way
+it was done before, deep copying empty_result and building every field,
+with the LazySearchHits of ckanext.ids.metadatabroker.client. Both are timed
+for what the search listing reads of a hit and for reading all of it, as
+json.dumps does. It imports the client, so it needs CKAN installed (but no
+running site or broker); run it with
+
+    python -m ckanext.ids.tests.benchmark_search_hit
+
+It is not collected by pytest.
+"""
+import datetime
+import json
+import time
+import timeit
+import urllib.parse
+from copy import deepcopy
+
+from ckanext.ids.metadatabroker import client
+from ckanext.ids.metadatabroker.providers import get_provider_registry
+
+PROCESS_EXTERNAL_URL = "http://localhost:5000/ids/processExternal?uri="
+
+
+def result_rows(rows: int):
+    return [("https://provider%d.example/api/offers/%d" % (i % 5, i),
+             "Asset %d" % i, "A description of asset %d" % i,
+             "https://provider%d.example:8080/api/ids/data" % (i % 5),
+             "https://creativecommons.org/licenses/by/4.0/",
+             "2022-02-02T16:32:58.653Z",
+             "https://www.trusts-data.eu/ontology/Dataset")
+            for i in range(rows)]
+
+
+def eager_result(resultUri, title, description, externalName, license,
+                 creationDate, assetType, now=None):
+    # What create_moot_ckan_result did for every row before the hits were
+    # built from shallow copies
+    organization_name = externalName.split("/")[2].split(":")[0]
+    providing_base_url = "/".join(organization_name.split("/")[:3])
+    packagemeta = deepcopy(client.empty_result)
+    packagemeta.update(client._moot_result)
+    packagemeta["id"] = resultUri
+    packagemeta["license_id"] = license
+    packagemeta["license_url"] = license
+    packagemeta["license_title"] = license.split("/")[-1]
+    packagemeta["metadata_created"] = creationDate
+    packagemeta["metadata_modified"] = \
+        now or datetime.datetime.now().isoformat()
+    packagemeta["name"] = title
+    packagemeta["title"] = title
+    packagemeta["description"] = description
+    packagemeta["type"] = assetType.split("/")[-1].lower()
+    packagemeta["external_provider_name"] = organization_name
+    packagemeta["to_process_external"] = PROCESS_EXTERNAL_URL + \
+        urllib.parse.quote_plus(resultUri)
+    packagemeta["provider_base_url"] = providing_base_url
+    packagemeta["notes"] = description
+    packagemeta["url"] = providing_base_url
+    packagemeta[packagemeta["type"] + "count"] = 1
+    organization = get_provider_registry().organization(organization_name)
+    packagemeta["organization"] = organization
+    packagemeta["owner_org"] = organization["id"]
+    packagemeta["resources"] = client._moot_resources(
+        resultUri, title, description,
+        now or datetime.datetime.now().isoformat())
+    packagemeta["relationships_as_object"] = []
+    packagemeta["relationships_as_subject"] = []
+    packagemeta["tags"] = []
+    packagemeta["groups"] = []
+    return packagemeta
+
+
+def eager_page(rows, now=None):
+    return [eager_result(*row, now=now) for row in rows]
+
+
+def lazy_page(rows, now=None):
+    now = now or datetime.datetime.now().isoformat()
+    return [client._build_moot_ckan_result(
+        *row, now=now, process_external_url=PROCESS_EXTERNAL_URL)
+        for row in rows]
+
+
+def read_listing(hits):
+    # The fields the search listing shows of a hit
+    for hit in hits:
+        (hit["title"], hit["notes"], hit["organization"]["title"],
+         hit["license_title"], hit["type"], hit.get("tags"))
+
+
+def read_all(hits):
+    json.dumps(hits)
+
+
+def main():
+    # The organizations are made up from the host names, without the broker
+    get_provider_registry().loaded = time.monotonic()
+    for rows in (20, 100, 1000):
+        page = result_rows(rows)
+        now = datetime.datetime.now().isoformat()
+        eager, lazy = eager_page(page, now), lazy_page(page, now)
+        assert json.loads(json.dumps(eager)) == json.loads(json.dumps(lazy))
+        number = max(1, 2000 // rows)
+        for name, read in (("listing", read_listing), ("all", read_all)):
+            timings = [
+                ("eager", timeit.timeit(lambda: read(eager_page(page)),
+                                        number=number)),
+                ("lazy", timeit.timeit(lambda: read(lazy_page(page)),
+                                       number=number))]
+            print("%5d rows, %-7s: " % (rows, name) + ", ".join(
+                "%s %.1f us/row" % (label, 1e6 * seconds / number / rows)
+                for label, seconds in timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Compares the parsing of broker SPARQL results by rdflib's TSVResultParser
+with ckanext.ids.metadatabroker.sparql_results, on result pages shaped like
+the ones of the search query. Needs no CKAN, run it with
+
+    python -m ckanext.ids.tests.benchmark_sparql_results
+
+It is not collected by pytest.
+"""
+import io
+import timeit
+
+from rdflib.plugins.sparql.results.tsvresults import TSVResultParser
+
+from ckanext.ids.metadatabroker.sparql_results import parse_sparql_results, \
+    iter_tsv_rows
+
+HEADER = "?resultUri\t?title\t?description\t?assettype\t?externalname\t" \
+         "?license\t?creationDate\n"
+
+
+def result_page(rows: int) -> str:
+    lines = [HEADER]
+    for i in range(rows):
+        lines.append(
+            "<https://provider.example/api/offers/%d>\t"
+            "\"Asset %d\"\t\"A description of asset %d, with \\\"quotes\\\"\"@en\t"
+            "<https://www.trusts-data.eu/ontology/Dataset>\t\t"
+            "<https://creativecommons.org/licenses/by/4.0/>\t"
+            "\"2022-02-02T16:32:58.653Z\"^^"
+            "<http://www.w3.org/2001/XMLSchema#dateTime>\n" % (i, i, i))
+    return "".join(lines)
+
+
+def rdflib_rows(text):
+    result = TSVResultParser().parse(io.StringIO(text))
+    return [tuple(None if b.get(v) is None else str(b.get(v))
+                  for v in result.vars) for b in result.bindings]
+
+
+def own_rows(text):
+    return list(parse_sparql_results(text))
+
+
+def streamed_rows(lines):
+    return list(iter_tsv_rows(iter(lines))[1])
+
+
+def main():
+    for rows in (20, 100, 1000):
+        text = result_page(rows)
+        lines = text.encode("utf-8").splitlines()
+        assert rdflib_rows(text) == own_rows(text) == streamed_rows(lines)
+        number = max(1, 2000 // rows)
+        timings = [
+            ("rdflib", timeit.timeit(lambda: rdflib_rows(text),
+                                     number=number)),
+            ("text", timeit.timeit(lambda: own_rows(text), number=number)),
+            ("lines", timeit.timeit(lambda: streamed_rows(lines),
+                                    number=number))]
+        print("%5d rows: " % rows + ", ".join(
+            "%s %.2f ms" % (name, 1000 * seconds / number)
+            for name, seconds in timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""
+Tests for the backoff of broker_publication.py.
+"""
+import pytest
+
+from ckanext.ids import broker_publication
+from ckanext.ids.broker_publication import backoff
+
+
+@pytest.mark.ckan_config("ckanext.ids.broker_publication_backoff", "5")
+@pytest.mark.ckan_config("ckanext.ids.broker_publication_backoff_max",
+                         "3600")
+@pytest.mark.parametrize("attempts, delay", [
+    (0, 5), (1, 5), (2, 10), (3, 20), (8, 640), (10, 2560), (11, 3600),
+    (50, 3600)])
+def test_backoff_bounds(attempts, delay):
+    for _ in range(100):
+        assert delay / 2 <= backoff(attempts) <= delay
+
+
+@pytest.mark.ckan_config("ckanext.ids.broker_publication_backoff", "5")
+@pytest.mark.ckan_config("ckanext.ids.broker_publication_backoff_max",
+                         "3600")
+def test_backoff_jitter_spans_half_the_delay(monkeypatch):
+    monkeypatch.setattr(broker_publication.random, "uniform",
+                        lambda low, high: low)
+    assert backoff(3) == 10
+    monkeypatch.setattr(broker_publication.random, "uniform",
+                        lambda low, high: high)
+    assert backoff(3) == 20
+
+
+@pytest.mark.ckan_config("ckanext.ids.broker_publication_backoff", "1")
+@pytest.mark.ckan_config("ckanext.ids.broker_publication_backoff_max", "60")
+def test_backoff_configured():
+    assert all(0.5 <= backoff(1) <= 1 for _ in range(100))
+    assert all(30 <= backoff(20) <= 60 for _ in range(100))
+
+
+@pytest.mark.ckan_config("ckanext.ids.broker_publication_backoff", "5")
+@pytest.mark.ckan_config("ckanext.ids.broker_publication_backoff_max",
+                         "3600")
+def test_backoff_never_overflows():
+    assert 1800 <= backoff(5000) <= 3600
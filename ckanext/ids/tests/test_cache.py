@@ -0,0 +1,95 @@
+"""
+Tests for metadatabroker/cache.py. For the cache keys, equivalent searches
+have to share an entry, different ones must not.
+"""
+from ckanext.ids.metadatabroker.cache import BrokerCache, \
+    search_cache_key, count_cache_key, facet_cache_key
+
+FACET_PROPERTIES = (("theme", "https://w3id.org/idsa/core/theme"),
+                    ("TimeFrame", "ids:temporalCoverage"))
+
+
+def test_search_key_default_search_is_no_search():
+    assert search_cache_key(None, [], [], 0, 20) == \
+        search_cache_key("", [], [], 0, 20) == \
+        search_cache_key("*:*", None, None, "0", "20")
+
+
+def test_search_key_ignores_the_order_of_filters_and_facets():
+    assert search_cache_key("energy", ["theme:a", "TimeFrame:2020"],
+                            ["theme", "license_id"], 0, 20) == \
+        search_cache_key("energy", ["TimeFrame:2020", "theme:a"],
+                         ["license_id", "theme"], None, "20")
+
+
+def test_search_key_depends_on_the_search_and_the_page():
+    key = search_cache_key("energy", ["theme:a"], ["theme"], 0, 20)
+    assert key != search_cache_key("grid", ["theme:a"], ["theme"], 0, 20)
+    assert key != search_cache_key("energy", ["theme:b"], ["theme"], 0, 20)
+    assert key != search_cache_key("energy", ["theme:a"], [], 0, 20)
+    assert key != search_cache_key("energy", ["theme:a"], ["theme"], 20, 20)
+    assert key != search_cache_key("energy", ["theme:a"], ["theme"], 0, 40)
+
+
+def test_search_key_is_hashable_and_stable():
+    key = search_cache_key("energy", ["theme:a"], ["theme"], 0, 20)
+    assert hash(key) == hash(search_cache_key("energy", ("theme:a",),
+                                              ("theme",), 0, 20))
+    assert {key: 1}[search_cache_key("energy", ["theme:a"], ["theme"],
+                                     0, 20)] == 1
+
+
+def test_count_key_does_not_depend_on_the_page():
+    assert count_cache_key("energy", ["theme:a"], ["theme"]) == \
+        search_cache_key("energy", ["theme:a"], ["theme"], 40, 20)[:3]
+
+
+def test_facet_key_only_depends_on_the_facet_filters():
+    key = facet_cache_key("energy", ["theme:a", "+dataset_type:dataset"],
+                          FACET_PROPERTIES, "dataset")
+    assert key == facet_cache_key("energy", ["theme:a", "res_format:CSV"],
+                                  FACET_PROPERTIES, "dataset")
+    assert key == facet_cache_key("energy", ["theme:a"], FACET_PROPERTIES,
+                                  "dataset")
+
+
+def test_facet_key_ignores_the_order_of_filters():
+    assert facet_cache_key(None, ["theme:a", "TimeFrame:2020"],
+                           FACET_PROPERTIES, "dataset") == \
+        facet_cache_key("*:*", ["TimeFrame:2020", "theme:a"],
+                        FACET_PROPERTIES, "dataset")
+
+
+def test_facet_key_depends_on_the_search():
+    key = facet_cache_key("energy", ["theme:a"], FACET_PROPERTIES, "dataset")
+    assert key != facet_cache_key("grid", ["theme:a"], FACET_PROPERTIES,
+                                  "dataset")
+    assert key != facet_cache_key("energy", ["theme:b"], FACET_PROPERTIES,
+                                  "dataset")
+    assert key != facet_cache_key("energy", ["theme:a"], FACET_PROPERTIES,
+                                  "service")
+    assert key != facet_cache_key("energy", ["theme:a"],
+                                  FACET_PROPERTIES[:1], "dataset")
+
+
+def test_cache():
+    cache = BrokerCache("test", maxsize=2, ttl=60)
+    cache.set("a", {"count": 1})
+    value = cache.get("a")
+    assert value == {"count": 1}
+    value["count"] = 2
+    assert cache.get("a") == {"count": 1}
+    assert cache.get("b") is None
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 1
+
+
+def test_cache_of_size_zero_is_off():
+    for size in (0, -1):
+        cache = BrokerCache("off", maxsize=size, ttl=60)
+        cache.set("a", {"count": 1})
+        assert cache.get("a") is None
+        stats = cache.stats()
+        assert stats["size"] == 0
+        assert stats["maxsize"] == 0
+        assert stats["misses"] == 1
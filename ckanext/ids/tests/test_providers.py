@@ -0,0 +1,75 @@
+"""
+Tests for the retries of the provider registry of metadatabroker/providers.py.
+"""
+import time
+
+import pytest
+
+from ckanext.ids.metadatabroker import providers
+from ckanext.ids.metadatabroker.providers import ProviderRegistry
+from ckanext.ids.metadatabroker.sparql_results import SparqlResults
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = ProviderRegistry()
+    registry.ttl = 3600
+    registry.retry_interval = 30
+
+    def load():
+        raise RuntimeError("broker down")
+
+    monkeypatch.setattr(registry, "load", load)
+    return registry
+
+
+def test_failed_load_is_retried_before_the_ttl(registry):
+    registry._refresh()
+    assert registry.failures == 1
+    assert 0 < registry.retry_at - time.monotonic() <= 30
+    registry._refresh()
+    assert 30 < registry.retry_at - time.monotonic() <= 60
+
+
+def test_retries_wait_at_most_the_ttl(registry):
+    for _ in range(100):
+        registry._refresh()
+    assert registry.retry_at - time.monotonic() <= 3600
+
+
+def test_no_reload_before_the_retry(registry, monkeypatch):
+    registry._refresh()
+    started = []
+
+    class Thread:
+        def __init__(self, target, name, daemon):
+            self.target = target
+
+        def start(self):
+            started.append(self.target)
+
+    monkeypatch.setattr(providers.threading, "Thread", Thread)
+    registry._refresh_if_stale()
+    assert started == []
+    registry.retry_at = time.monotonic() - 1
+    registry._refresh_if_stale()
+    assert started == [registry._refresh]
+
+
+class FakeConnector:
+    def query_broker_results(self, query):
+        return SparqlResults(
+            ["conn", "title", "description", "curator", "maintainer",
+             "accessUrl"],
+            iter([("https://provider.example/connector", "Provider", None,
+                   None, None, "https://provider.example/api/ids/data")]))
+
+
+def test_successful_load_resets_the_retries(registry, monkeypatch):
+    registry._refresh()
+    monkeypatch.delattr(registry, "load")
+    monkeypatch.setattr(providers, "get_connector", lambda: FakeConnector())
+    registry._refresh()
+    assert registry.failures == 0
+    assert registry.retry_at is None
+    assert registry.organization("provider.example")["title"] == "Provider"
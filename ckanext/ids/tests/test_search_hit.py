@@ -0,0 +1,109 @@
+"""
+Tests for metadatabroker/search_hit.py.
+"""
+import copy
+import json
+
+from ckanext.ids.metadatabroker.cache import search_cache
+from ckanext.ids.metadatabroker.search_hit import LazySearchHit
+
+
+def _hit(calls=None):
+    calls = [] if calls is None else calls
+
+    def resources():
+        calls.append("resources")
+        return [{"name": "resource"}]
+
+    return LazySearchHit({"id": "http://broker/resource", "title": "Title"},
+                         {"resources": resources, "tags": list})
+
+
+def test_lazy_fields_are_built_once_when_read():
+    calls = []
+    hit = _hit(calls)
+    assert calls == []
+    assert hit["resources"] == [{"name": "resource"}]
+    assert hit["resources"] is hit["resources"]
+    assert calls == ["resources"]
+
+
+def test_keys_do_not_build_the_lazy_fields():
+    calls = []
+    hit = _hit(calls)
+    assert set(hit) == {"id", "title", "resources", "tags"}
+    assert set(hit.keys()) == set(hit)
+    assert len(hit) == 4
+    assert "resources" in hit
+    assert "missing" not in hit
+    assert calls == []
+
+
+def test_is_a_dict():
+    hit = _hit()
+    assert isinstance(hit, dict)
+    assert hit.get("tags") == []
+    assert hit.get("missing", "default") == "default"
+    assert dict(hit)["resources"] == [{"name": "resource"}]
+    assert {**_hit()}["tags"] == []
+
+
+def test_json_dumps_builds_every_field():
+    hit = _hit()
+    assert json.loads(json.dumps(hit)) == {
+        "id": "http://broker/resource", "title": "Title",
+        "resources": [{"name": "resource"}], "tags": []}
+    assert json.loads(json.dumps(_hit(), sort_keys=True)) == \
+        json.loads(json.dumps(hit))
+
+
+def test_items_and_values_build_every_field():
+    hit = _hit()
+    assert dict(hit.items())["resources"] == [{"name": "resource"}]
+    assert [] in list(_hit().values())
+    assert _hit() == _hit().copy()
+    assert type(_hit().copy()) is dict
+    assert copy.deepcopy(_hit()) == _hit()
+
+
+def test_set_pop_and_delete():
+    calls = []
+    hit = _hit(calls)
+    hit["resources"] = []
+    assert hit["resources"] == []
+    assert hit.pop("tags") == []
+    assert "tags" not in hit
+    assert hit.pop("tags", None) is None
+    del hit["title"]
+    assert set(hit) == {"id", "resources"}
+    hit.update(tags=["x"])
+    assert hit.setdefault("tags", []) == ["x"]
+    assert calls == []
+
+
+def test_deep_copy_keeps_the_lazy_fields_lazy():
+    calls = []
+    hit = _hit(calls)
+    hit["tags"].append("built")
+    copied = copy.deepcopy(hit)
+    assert isinstance(copied, LazySearchHit)
+    assert calls == []
+    assert copied["tags"] == ["built"]
+    assert copied["tags"] is not hit["tags"]
+    assert copied["resources"] == [{"name": "resource"}]
+    assert calls == ["resources"]
+    assert copy.copy(_hit())["tags"] == []
+
+
+def test_search_cache_keeps_the_hits_lazy():
+    calls = []
+    page = {"count": 2, "results": [_hit(calls), _hit(calls)]}
+    key = ("test_search_cache_keeps_the_hits_lazy",)
+    search_cache.set(key, page)
+    cached = search_cache.get(key)
+    assert calls == []
+    assert [type(x) for x in cached["results"]] == [LazySearchHit] * 2
+    assert cached["results"][0]["title"] == "Title"
+    assert calls == []
+    assert cached["results"][0]["resources"] == [{"name": "resource"}]
+    assert calls == ["resources"]
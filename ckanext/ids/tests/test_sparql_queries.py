@@ -0,0 +1,163 @@
+"""
+Tests for metadatabroker/sparql_queries.py.
+
+The escaped terms are checked by running them through rdflib's SPARQL
+engine: whatever the user typed has to come back as the same value, and
+must never change the structure of the query.
+"""
+import pytest
+from rdflib import Graph
+from rdflib.plugins.sparql import prepareQuery
+
+from ckanext.ids.metadatabroker import sparql_queries
+
+FACET_PROPERTIES = (("theme", "https://w3id.org/idsa/core/theme"),
+                    ("TimeFrame", "ids:temporalCoverage"))
+
+INJECTIONS = [
+    'x" . } DELETE WHERE { ?s ?p ?o } #',
+    'x") } UNION { ?resultUri ?p ?o } FILTER ("',
+    "x' } #",
+    'back\\slash\\',
+    'line\nbreak\r\ttab',
+    '\\" ) } #',
+    'unicode é中',
+]
+
+
+def _bound_value(term: str):
+    query = "SELECT ?x WHERE { BIND (" + term + " AS ?x) }"
+    return str(list(Graph().query(query))[0][0])
+
+
+@pytest.mark.parametrize("value", INJECTIONS + ["", "plain"])
+def test_string_literal_keeps_the_value(value):
+    assert _bound_value(sparql_queries.string_literal(value)) == value
+
+
+@pytest.mark.parametrize("value", INJECTIONS + ["a.b", "(a|b)*", "[x]^$?+"])
+def test_regex_literal_matches_the_text_literally(value):
+    term = sparql_queries.regex_literal(value)
+    query = "ASK { FILTER (regex(" + sparql_queries.string_literal(value) + \
+            ", " + term + ", \"i\")) }"
+    assert Graph().query(query).askAnswer
+
+
+def test_regex_literal_escapes_the_special_characters():
+    query = "ASK { FILTER (regex(\"abc\", " + \
+            sparql_queries.regex_literal(".*") + ")) }"
+    assert not Graph().query(query).askAnswer
+
+
+@pytest.mark.parametrize("value", [
+    "https://broker.example/resource/1",
+    "<https://broker.example/resource/1>",
+    " https://broker.example/resource/1 ",
+])
+def test_iri(value):
+    assert sparql_queries.iri(value) == "<https://broker.example/resource/1>"
+
+
+@pytest.mark.parametrize("value", [
+    "",
+    "<>",
+    "https://x> . ?s ?p ?o . <https://y",
+    "https://x> } DELETE WHERE { ?s ?p ?o } #",
+    "https://x y",
+    'https://x"y',
+    "https://x{y}",
+    "https://x\\y",
+    "https://x\ny",
+    "https://x|y^`",
+])
+def test_iri_rejects_what_would_end_it(value):
+    with pytest.raises(ValueError):
+        sparql_queries.iri(value)
+
+
+def test_lucene_literal():
+    assert sparql_queries.lucene_literal("energy  grid") == \
+        '"energy AND grid"'
+    assert sparql_queries.lucene_literal("a:b (c)") == \
+        '"a\\\\:b AND \\\\(c\\\\)"'
+
+
+@pytest.mark.parametrize("value", INJECTIONS)
+def test_lucene_literal_is_a_single_literal(value):
+    literal = sparql_queries.lucene_literal(value)
+    words = _bound_value(literal).split(" AND ")
+    assert len(words) == len(value.split())
+
+
+@pytest.mark.parametrize("name", ["theme", "Time_Frame"])
+def test_variable(name):
+    assert sparql_queries.variable(name) == "?" + name
+
+
+@pytest.mark.parametrize("name", ["", "a b", "x . ?s ?p ?o", "x}"])
+def test_variable_rejects_other_names(name):
+    with pytest.raises(ValueError):
+        sparql_queries.variable(name)
+
+
+@pytest.mark.parametrize("value", ["ids:theme x", "theme", "a:b . ?s"])
+def test_property_term_rejects_other_terms(value):
+    with pytest.raises(ValueError):
+        sparql_queries.property_term(value)
+
+
+def test_facet_value_term():
+    assert sparql_queries.facet_value_term('"https://x/theme"') == \
+        "<https://x/theme>"
+    assert sparql_queries.facet_value_term("2020") == "2020"
+    assert sparql_queries.facet_value_term('a" } #') == '"a\\" } #"'
+
+
+def test_facet_filters_reject_injected_iris():
+    with pytest.raises(ValueError):
+        sparql_queries.facet_filters(
+            ('theme:"https://x> } DELETE WHERE { ?s ?p ?o } #"',),
+            FACET_PROPERTIES)
+
+
+def test_facet_filters_ignore_other_facets():
+    assert sparql_queries.facet_filters(("res_format:CSV",),
+                                        FACET_PROPERTIES) == ""
+
+
+def test_type_filter_rejects_injected_types():
+    with pytest.raises(ValueError):
+        sparql_queries.type_filter("dataset> . ?s ?p ?o")
+
+
+@pytest.mark.parametrize("text_mode", [sparql_queries.TEXT_MODE_REGEX,
+                                       sparql_queries.TEXT_MODE_TEXT_INDEX])
+@pytest.mark.parametrize("fts_query", INJECTIONS)
+def test_queries_with_injections_still_parse(fts_query, text_mode):
+    fq = ('theme:"https://w3id.org/idsa/code/ENERGY"', 'TimeFrame:x" }')
+    for query in (
+            sparql_queries.results_query(
+                "dataset", fts_query, fq, FACET_PROPERTIES, 'node" }', 20,
+                0, text_mode=text_mode),
+            sparql_queries.count_query(
+                "dataset", fts_query, fq, FACET_PROPERTIES, 'node" }',
+                text_mode=text_mode),
+            sparql_queries.facets_query(
+                "dataset", fts_query, fq, FACET_PROPERTIES, 'node" }',
+                text_mode=text_mode)):
+        prepareQuery(query)
+
+
+def test_local_index_query_parses():
+    prepareQuery(sparql_queries.results_query(
+        None, "energy", (), FACET_PROPERTIES, "node", 20, 0,
+        text_mode=sparql_queries.TEXT_MODE_LOCAL_INDEX,
+        text_matches=("https://broker.example/resource/1",)))
+
+
+def test_modified_query():
+    query = sparql_queries.modified_query("https://broker.example/r/1")
+    assert "<https://broker.example/r/1> ids:modified" in query
+    prepareQuery(query)
+    with pytest.raises(ValueError):
+        sparql_queries.modified_query("https://x> ?p ?o . <https://y")
@@ -0,0 +1,116 @@
+"""
+Tests for metadatabroker/sparql_results.py: the rows have to be the same as
+the lexical values of the terms rdflib parses from the same results.
+"""
+import io
+import json
+
+import pytest
+import rdflib
+from rdflib.plugins.sparql.results.jsonresults import JSONResultParser
+from rdflib.plugins.sparql.results.tsvresults import TSVResultParser
+
+from ckanext.ids.metadatabroker.sparql_results import parse_sparql_results, \
+    iter_tsv_rows, tsv_term_value
+
+TSV_RESULTS = (
+    "?resultUri\t?title\t?description\t?license\t?count\n"
+    "<https://broker.example/resource/1>\t\"Energy\"\t"
+    "\"Grid \\\"load\\\"\\tdata\\nby hour\"@en\t"
+    "<https://creativecommons.org/licenses/by/4.0/>\t3\n"
+    "<https://broker.example/resource/2>\t\"Unbound license\"\t"
+    "\"\u00e9t\u00e9 \\\\ summer\"\t\t"
+    "\"42\"^^<http://www.w3.org/2001/XMLSchema#integer>\n"
+    "<https://broker.example/resource/3>\t\t\t\t\n")
+
+JSON_RESULTS = json.dumps({
+    "head": {"vars": ["resultUri", "title", "description", "modified"]},
+    "results": {"bindings": [
+        {"resultUri": {"type": "uri",
+                       "value": "https://broker.example/resource/1"},
+         "title": {"type": "literal", "value": "Energy",
+                   "xml:lang": "en"},
+         "description": {"type": "literal",
+                         "value": "Grid \"load\"\tdata\nby hour"},
+         "modified": {"type": "literal", "value": "2022-02-02T16:32:58Z",
+                      "datatype":
+                          "http://www.w3.org/2001/XMLSchema#dateTime"}},
+        {"resultUri": {"type": "uri",
+                       "value": "https://broker.example/resource/2"},
+         "title": {"type": "literal", "value": "Unbound description"}},
+    ]}})
+
+
+def _rdflib_rows(result):
+    return [tuple(None if b.get(v) is None else str(b.get(v))
+                  for v in result.vars) for b in result.bindings]
+
+
+def test_tsv_same_rows_as_rdflib():
+    expected = TSVResultParser().parse(io.StringIO(TSV_RESULTS))
+    results = parse_sparql_results(TSV_RESULTS)
+    assert results.variables == [str(v) for v in expected.vars]
+    assert list(results) == _rdflib_rows(expected)
+
+
+def test_tsv_unbound_cells_are_none():
+    rows = list(parse_sparql_results(TSV_RESULTS).dicts())
+    assert rows[1]["license"] is None
+    assert rows[2] == {"resultUri": "https://broker.example/resource/3",
+                       "title": None, "description": None, "license": None,
+                       "count": None}
+
+
+@pytest.mark.parametrize("newline", [b"\n", b"\r\n"])
+def test_tsv_streamed_lines_same_as_text(newline):
+    lines = iter(TSV_RESULTS.encode("utf-8").replace(b"\n", newline)
+                 .split(b"\n"))
+    variables, rows = iter_tsv_rows(lines)
+    results = parse_sparql_results(TSV_RESULTS)
+    assert variables == results.variables
+    assert list(rows) == list(results)
+
+
+def test_tsv_bytes_same_as_text():
+    assert list(parse_sparql_results(TSV_RESULTS.encode("utf-8"))) == \
+        list(parse_sparql_results(TSV_RESULTS))
+
+
+def test_json_same_rows_as_rdflib(monkeypatch):
+    # The values are the lexical forms sent by the broker, e.g. a dateTime
+    # is not normalized
+    monkeypatch.setattr(rdflib, "NORMALIZE_LITERALS", False)
+    expected = JSONResultParser().parse(io.StringIO(JSON_RESULTS))
+    for results in (parse_sparql_results(JSON_RESULTS),
+                    parse_sparql_results(JSON_RESULTS.encode("utf-8")),
+                    parse_sparql_results(JSON_RESULTS,
+                                         "application/sparql-results+json")):
+        assert results.variables == [str(v) for v in expected.vars]
+        assert list(results) == _rdflib_rows(expected)
+
+
+def test_json_unbound_cells_are_none():
+    rows = list(parse_sparql_results(JSON_RESULTS).dicts())
+    assert rows[1]["description"] is None
+    assert rows[1]["modified"] is None
+
+
+def test_empty_results():
+    results = parse_sparql_results("?resultUri\t?title\n")
+    assert results.variables == ["resultUri", "title"]
+    assert list(results) == []
+
+
+@pytest.mark.parametrize("term, value", [
+    ("", None),
+    ("<https://x/y>", "https://x/y"),
+    ('"a"', "a"),
+    ('"a"@de', "a"),
+    ('"1"^^<http://www.w3.org/2001/XMLSchema#integer>', "1"),
+    ('"say \\"hi\\""', 'say "hi"'),
+    ('"\\u00e9t\\u00e9"', "\u00e9t\u00e9"),
+    ("true", "true"),
+    ("-1.5e3", "-1.5e3"),
+])
+def test_tsv_term_value(term, value):
+    assert tsv_term_value(term) == value
@@ -0,0 +1,89 @@
+"""
+Tests for the change detection of sync_records.py.
+"""
+import datetime
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from ckanext.ids import sync_records
+from ckanext.ids.sync_records import PackageSync, content_hash
+
+OFFER = "https://connector.example/api/offers/1"
+
+
+def test_content_hash_ignores_the_order_of_keys():
+    assert content_hash({"title": "a", "keywords": ["x", "y"]}) == \
+        content_hash({"keywords": ["x", "y"], "title": "a"})
+
+
+def test_content_hash_changes_with_the_content():
+    content = {"title": "a", "keywords": ["x", "y"]}
+    assert content_hash(content) != content_hash({"title": "b",
+                                                  "keywords": ["x", "y"]})
+    assert content_hash(content) != content_hash({"title": "a",
+                                                  "keywords": ["y", "x"]})
+    assert content_hash(content) != content_hash({"title": "a"})
+
+
+def test_content_hash_of_values_json_cannot_hold():
+    created = datetime.datetime(2022, 2, 2, 16, 32, 58)
+    assert content_hash({"created": created}) == \
+        content_hash({"created": str(created)})
+    assert len(content_hash({"created": created})) == 40
+
+
+@pytest.fixture
+def sync_record(monkeypatch):
+    record = SimpleNamespace(
+        offer_iri=OFFER, offer_hash="offer-hash", broker_hash="broker-hash",
+        resource_hashes=json.dumps({"resource-1": {
+            "representation": "representation-hash"}}))
+    records = {"package-1": record}
+    monkeypatch.setattr(sync_records, "SyncRecord",
+                        SimpleNamespace(get=records.get))
+    return record
+
+
+def test_unchanged_package(sync_record):
+    sync = PackageSync("package-1")
+    assert sync.offer_unchanged(OFFER, "offer-hash")
+    assert sync.broker_unchanged("broker-hash")
+    assert sync.resource_synced(OFFER, "resource-1") == {
+        "representation": "representation-hash"}
+
+
+def test_changed_package(sync_record):
+    sync = PackageSync("package-1")
+    assert not sync.offer_unchanged(OFFER, "other-hash")
+    assert not sync.offer_unchanged(OFFER + "2", "offer-hash")
+    assert not sync.offer_unchanged(None, "offer-hash")
+    assert not sync.broker_unchanged("other-hash")
+    assert sync.resource_synced(OFFER, "resource-2") == {}
+    assert sync.resource_synced(OFFER, None) == {}
+
+
+def test_resources_of_another_offer_are_not_synced(sync_record):
+    sync = PackageSync("package-1")
+    assert sync.resource_synced(OFFER + "2", "resource-1") == {}
+    assert sync.resource_synced(None, "resource-1") == {}
+
+
+def test_force_ignores_the_record(sync_record):
+    sync = PackageSync("package-1", force=True)
+    assert not sync.offer_unchanged(OFFER, "offer-hash")
+    assert not sync.broker_unchanged("broker-hash")
+    assert sync.resource_synced(OFFER, "resource-1") == {}
+
+
+def test_package_never_pushed(sync_record):
+    sync = PackageSync("package-2")
+    assert not sync.offer_unchanged(OFFER, "offer-hash")
+    assert not sync.broker_unchanged("broker-hash")
+    assert sync.resource_synced(OFFER, "resource-1") == {}
+
+
+def test_record_without_resources(sync_record):
+    sync_record.resource_hashes = None
+    assert PackageSync("package-1").resource_synced(OFFER, "resource-1") == {}
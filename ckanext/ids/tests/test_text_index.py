@@ -0,0 +1,99 @@
+"""
+Tests for metadatabroker/text_index.py.
+"""
+from ckanext.ids.metadatabroker.text_index import InvertedIndex, \
+    BrokerTextIndex, tokenize
+
+R1 = "https://broker.example/resource/1"
+R2 = "https://broker.example/resource/2"
+R3 = "https://broker.example/resource/3"
+
+
+def _index():
+    return InvertedIndex([(R1, "Energy consumption of households"),
+                          (R2, "Household energy prices, 2020"),
+                          (R3, "Traffic counts")])
+
+
+def test_tokenize():
+    assert tokenize("Énergie, grid-load 2020!") == \
+        ["énergie", "grid", "load", "2020"]
+    assert tokenize(None) == []
+
+
+def test_search_needs_every_word():
+    index = _index()
+    assert index.search("energy") == {R1, R2}
+    assert index.search("ENERGY prices") == {R2}
+    assert index.search("energy traffic") == set()
+    assert index.search("") == set()
+    assert index.search("unknown") == set()
+
+
+def test_last_word_matches_as_prefix():
+    index = _index()
+    assert index.search("house") == {R1, R2}
+    assert index.search("househ energy") == set()
+    assert index.search("energy househ") == {R1, R2}
+
+
+def test_add():
+    index = _index()
+    index.add("https://broker.example/resource/4", "Wind energy forecast")
+    assert index.search("energy") == {R1, R2,
+                                      "https://broker.example/resource/4"}
+    assert index.search("wind") == {"https://broker.example/resource/4"}
+    assert index.tokens == sorted(index.postings)
+
+
+def test_add_replaces_the_text():
+    index = _index()
+    index.add(R3, "Bicycle counts")
+    assert index.search("traffic") == set()
+    assert index.search("bicycle counts") == {R3}
+    assert "traffic" not in index.tokens
+
+
+def test_remove():
+    index = _index()
+    index.remove(R2)
+    assert index.search("energy") == {R1}
+    assert index.search("prices") == set()
+    assert "prices" not in index.postings
+    assert index.tokens == sorted(index.postings)
+    index.remove("https://broker.example/unknown")
+    assert len(index) == len(index.postings)
+
+
+def test_search_without_index_falls_back(monkeypatch):
+    text_index = BrokerTextIndex()
+    monkeypatch.setattr(text_index, "start_refresher", lambda: None)
+    assert text_index.search("energy") is None
+    text_index.index = _index()
+    assert text_index.search("energy") == {R1, R2}
+
+
+def test_rebuild_skips_when_rebuilt_while_waiting(monkeypatch):
+    text_index = BrokerTextIndex()
+    harvests = []
+
+    def harvest():
+        harvests.append(1)
+        return _index()
+
+    monkeypatch.setattr(text_index, "harvest", harvest)
+    text_index.rebuild()
+    assert len(harvests) == 1
+    assert text_index.index is not None
+
+    class RebuiltByTheHolder:
+        # The thread that held the lock rebuilt the index meanwhile
+        def __enter__(self):
+            text_index.built += 1
+
+        def __exit__(self, *args):
+            return False
+
+    monkeypatch.setattr(text_index, "_lock", RebuiltByTheHolder())
+    text_index.rebuild()
+    assert len(harvests) == 1
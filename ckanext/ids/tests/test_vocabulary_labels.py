@@ -0,0 +1,79 @@
+"""
+Tests for the sharing of the labels through Redis in vocabulary_labels.py.
+"""
+import json
+import time
+
+import pytest
+
+from ckanext.ids import vocabulary_labels as labels_module
+
+FIELD = {"skos_choices_sparql_endpoint": "https://vocabularies.example/sparql",
+         "skos_choices_concept_scheme": "https://vocabularies.example/theme"}
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        value = self.values.get(key)
+        return value[0] if value is not None else None
+
+    def ttl(self, key):
+        return self.values[key][1] if key in self.values else -2
+
+    def set(self, key, value, ex=None):
+        self.values[key] = (value, ex)
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(labels_module, "connect_to_redis", lambda: redis)
+    monkeypatch.setattr(labels_module, "_labels", {})
+    monkeypatch.setattr(labels_module, "_labels_ttl", lambda: 3600)
+    return redis
+
+
+@pytest.fixture
+def fetches(monkeypatch):
+    fetches = []
+
+    def fetch_labels(field):
+        fetches.append(field)
+        return {"https://vocabularies.example/theme/energy": "Energy"}
+
+    monkeypatch.setattr(labels_module, "_fetch_labels", fetch_labels)
+    return fetches
+
+
+def _key():
+    return labels_module._vocabulary_key(FIELD)
+
+
+def test_labels_are_fetched_once_and_shared(redis, fetches):
+    labels = labels_module.vocabulary_labels(FIELD)
+    assert labels == {"https://vocabularies.example/theme/energy": "Energy"}
+    assert len(fetches) == 1
+    labels_module._labels.clear()
+    assert labels_module.vocabulary_labels(FIELD) == labels
+    assert len(fetches) == 1
+
+
+def test_refresh_uses_the_labels_another_worker_reloaded(redis, fetches):
+    redis.set(labels_module._redis_key(_key()),
+              json.dumps({"https://vocabularies.example/theme/x": "X"}),
+              ex=3000)
+    labels_module._refresh(_key(), FIELD)
+    assert fetches == []
+    loaded, labels = labels_module._labels[_key()]
+    assert labels == {"https://vocabularies.example/theme/x": "X"}
+    # As old here as in Redis
+    assert 590 <= time.monotonic() - loaded <= 610
+
+
+def test_refresh_fetches_when_redis_expired_too(redis, fetches):
+    labels_module._refresh(_key(), FIELD)
+    assert len(fetches) == 1
+    assert redis.get(labels_module._redis_key(_key())) is not None
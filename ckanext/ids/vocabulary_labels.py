@@ -0,0 +1,126 @@
+"""
+Labels of the concepts of the SKOS vocabularies behind the facets.
+
+skos_choices_sparql_helper asks the vocabulary's SPARQL endpoint for every
+concept each time it is called, and skos_choices_get_label_by_value looks
+the label up in a list. Here each vocabulary is loaded once into a dict of
+concept URI -> label, shared with the other workers through the CKAN Redis,
+and refreshed in the background after ckanext.ids.vocabulary_labels_ttl
+seconds, so labelling the facets of a search needs no round-trip at all.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from typing import Dict
+
+from ckan.common import config
+from ckan.lib.redis import connect_to_redis
+from ckanext.vocabularies.helpers import skos_choices_sparql_helper
+
+log = logging.getLogger("ckanext")
+
+VOCABULARY_LABELS_KEY = "ckanext-ids:vocabulary_labels:"
+
+# What identifies the vocabulary in a scheming field
+_VOCABULARY_FIELD_KEYS = ("skos_choices_sparql_endpoint",
+                          "skos_choices_concept_scheme",
+                          "skos_choices_local_resource",
+                          "skos_choices_dsc_resource",
+                          "skos_choices_is_poolparty")
+
+# vocabulary key -> (loaded at, labels)
+_labels = {}
+_refreshing = set()
+_labels_lock = threading.Lock()
+
+
+def _labels_ttl() -> int:
+    return int(config.get("ckanext.ids.vocabulary_labels_ttl", 3600))
+
+
+def _vocabulary_key(field: Dict) -> str:
+    return json.dumps([field.get(x) for x in _VOCABULARY_FIELD_KEYS])
+
+
+def _redis_key(vocabulary_key: str) -> str:
+    return VOCABULARY_LABELS_KEY + \
+        hashlib.sha1(vocabulary_key.encode("utf-8")).hexdigest()
+
+
+def _fetch_labels(field: Dict) -> Dict[str, str]:
+    choices = skos_choices_sparql_helper(field) or []
+    return {x["value"]: x["label"] for x in choices}
+
+
+def _load_from_redis(vocabulary_key: str):
+    """
+    The labels another worker shared, kept here as loaded when that worker
+    stored them, so that they go stale here when they expire in Redis
+    """
+    redis_key = _redis_key(vocabulary_key)
+    try:
+        redis_conn = connect_to_redis()
+        labels = redis_conn.get(redis_key)
+        remaining = redis_conn.ttl(redis_key)
+    except Exception as e:
+        log.debug("Could not read the vocabulary labels: " + str(e))
+        return None
+    if labels is None:
+        return None
+    labels = json.loads(labels)
+    age = _labels_ttl() - remaining if remaining is not None and \
+        remaining > 0 else 0
+    with _labels_lock:
+        _labels[vocabulary_key] = (time.monotonic() - max(age, 0), labels)
+    return labels
+
+
+def _store(vocabulary_key: str, labels: Dict[str, str]):
+    with _labels_lock:
+        _labels[vocabulary_key] = (time.monotonic(), labels)
+    try:
+        connect_to_redis().set(_redis_key(vocabulary_key), json.dumps(labels),
+                               ex=_labels_ttl())
+    except Exception as e:
+        log.debug("Could not share the vocabulary labels: " + str(e))
+
+
+def _refresh(vocabulary_key: str, field: Dict):
+    try:
+        # Another worker may have reloaded them already
+        if _load_from_redis(vocabulary_key) is None:
+            _store(vocabulary_key, _fetch_labels(field))
+    except Exception as e:
+        log.error("Refreshing the vocabulary labels failed: " + str(e))
+    finally:
+        with _labels_lock:
+            _refreshing.discard(vocabulary_key)
+
+
+def vocabulary_labels(field: Dict) -> Dict[str, str]:
+    """
+    concept URI -> label of the vocabulary of a scheming field with
+    choices_helper: skos_vocabulary_helper
+    """
+    vocabulary_key = _vocabulary_key(field)
+    entry = _labels.get(vocabulary_key)
+    if entry is not None:
+        loaded, labels = entry
+        if time.monotonic() - loaded > _labels_ttl():
+            # Stale labels are still good enough while they are reloaded
+            with _labels_lock:
+                if vocabulary_key in _refreshing:
+                    return labels
+                _refreshing.add(vocabulary_key)
+            threading.Thread(target=_refresh, args=(vocabulary_key, field),
+                             name="vocabulary-labels", daemon=True).start()
+        return labels
+
+    labels = _load_from_redis(vocabulary_key)
+    if labels is not None:
+        return labels
+    labels = _fetch_labels(field)
+    _store(vocabulary_key, labels)
+    return labels